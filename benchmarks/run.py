@@ -0,0 +1,288 @@
+from __future__ import print_function, division
+import os
+import sys
+import json
+import time
+import shutil
+import fnmatch
+import platform
+import tempfile
+import argparse
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import nets
+import utils
+import mnist
+import kmeans_init
+import training_functions
+
+# Benchmarks of hot paths on synthetic data (nothing is downloaded)
+# Every benchmark is a function returning (run, items): run() is timed (median of repeats after warm-up),
+# items per call give throughput; results are written as JSON and may be compared with a baseline
+# from the same machine - slower results beyond the threshold are reported as regressions
+
+_benchmarks = []
+
+
+def benchmark(name):
+    def register(setup):
+        _benchmarks.append((name, setup))
+        return setup
+    return register
+
+
+# Forward and backward of every architecture (reconstruction and clustering outputs)
+def _net(architecture, img_size, batch_size):
+    def setup():
+        torch.manual_seed(0)
+        model = getattr(nets, architecture)(img_size, num_clusters=10)
+        model.train()
+        inputs = torch.randn(batch_size, img_size[2], img_size[0], img_size[1])
+        with torch.no_grad():
+            if model(inputs[:1])[0].shape != inputs[:1].shape:
+                raise ValueError('architecture too deep for image size')
+
+        def run():
+            model.zero_grad()
+            outputs, clusters, _ = model(inputs)
+            (torch.mean((outputs - inputs) ** 2) + clusters.sum()).backward()
+        return run, batch_size
+    return setup
+
+
+for _architecture in ['CAE_3', 'CAE_bn3', 'CAE_4', 'CAE_bn4', 'CAE_5', 'CAE_bn5']:
+    for _img_size, _batch_size in [([28, 28, 1], 256), ([128, 128, 3], 32)]:
+        benchmark('nets/{0}/{1}x{2}x{3}'.format(_architecture, *_img_size))(_net(_architecture, _img_size, _batch_size))
+
+
+# Clustering layer forward and backward across numbers of clusters K and embedding sizes D
+def _clustering(num_clusters, dim, batch_size=256):
+    def setup():
+        torch.manual_seed(0)
+        layer = nets.ClusterlingLayer(dim, num_clusters)
+        x = torch.randn(batch_size, dim, requires_grad=True)
+
+        def run():
+            layer.zero_grad()
+            layer(x).sum().backward()
+        return run, batch_size
+    return setup
+
+
+for _k in [10, 100, 1000]:
+    for _d in [10, 64, 256]:
+        benchmark('clustering_layer/K{0}/D{1}'.format(_k, _d))(_clustering(_k, _d))
+
+
+def _soft_assignments(n, k):
+    q = np.random.RandomState(0).rand(n, k).astype(np.float32)
+    return q / q.sum(axis=1, keepdims=True)
+
+
+@benchmark('target/N60000/K10')
+def _target_10():
+    q = _soft_assignments(60000, 10)
+    return lambda: training_functions.target(q), len(q)
+
+
+@benchmark('target/N60000/K100')
+def _target_100():
+    q = _soft_assignments(60000, 100)
+    return lambda: training_functions.target(q), len(q)
+
+
+# Loader of synthetic images with labels (batches assembled by the data loader)
+def _loader(n, img_size, batch_size=256):
+    generator = torch.Generator().manual_seed(0)
+    images = torch.randn(n, img_size[2], img_size[0], img_size[1], generator=generator)
+    labels = torch.randint(10, (n,), generator=generator)
+    dataset = torch.utils.data.TensorDataset(images, labels)
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False)
+
+
+@benchmark('calculate_predictions/CAE_3/28x28x1')
+def _predictions():
+    torch.manual_seed(0)
+    model = nets.CAE_3([28, 28, 1], num_clusters=10)
+    dataloader = _loader(10000, [28, 28, 1])
+    params = {'device': torch.device('cpu'), 'memmap_dir': None}
+    return lambda: training_functions.calculate_predictions(model, dataloader, params), len(dataloader.dataset)
+
+
+def _embeddings(n=20000, k=10, dim=10):
+    rng = np.random.RandomState(0)
+    centres = rng.randn(k, dim) * 4
+    return (centres[rng.randint(k, size=n)] + rng.randn(n, dim)).astype(np.float32)
+
+
+@benchmark('kmeans/full/N20000')
+def _kmeans_full():
+    x = _embeddings()
+    return lambda: kmeans_init.full(x, 10, seed=0), len(x)
+
+
+@benchmark('kmeans/minibatch/N20000')
+def _kmeans_minibatch():
+    x = _embeddings()
+    return lambda: kmeans_init.minibatch((x[i:i + 256] for i in range(0, len(x), 256)), 10, seed=0), len(x)
+
+
+@benchmark('kmeans/reservoir/N20000')
+def _kmeans_reservoir():
+    x = _embeddings()
+    return lambda: kmeans_init.reservoir((x[i:i + 256] for i in range(0, len(x), 256)), 10, sample_size=5000,
+                                         seed=0), len(x)
+
+
+def _labels(n=70000, k=10):
+    rng = np.random.RandomState(0)
+    labels_true = rng.randint(k, size=n)
+    # Predictions agree with labels for about a half of samples
+    labels_pred = np.where(rng.rand(n) < 0.5, labels_true, rng.randint(k, size=n))
+    return labels_true, labels_pred
+
+
+for _metric in ['nmi', 'ari', 'acc']:
+    def _metric_setup(metric=_metric):
+        labels_true, labels_pred = _labels()
+        return lambda: getattr(utils.metrics, metric)(labels_true, labels_pred), len(labels_true)
+    benchmark('metrics/' + _metric + '/N70000')(_metric_setup)
+
+
+# MNIST-like files (processed/training.pt and test.pt) with random images in a temporary directory
+_mnist_root = None
+
+
+def _mnist_files(n_train=20000, n_test=2000):
+    global _mnist_root
+    if _mnist_root is None:
+        _mnist_root = tempfile.mkdtemp(prefix='dcec_benchmark_')
+        os.makedirs(os.path.join(_mnist_root, 'processed'))
+        generator = torch.Generator().manual_seed(0)
+        for file, n in [('training.pt', n_train), ('test.pt', n_test)]:
+            data = torch.randint(256, (n, 28, 28), dtype=torch.uint8, generator=generator)
+            labels = torch.randint(10, (n,), generator=generator)
+            torch.save((data, labels), os.path.join(_mnist_root, 'processed', file))
+    return _mnist_root
+
+
+# One epoch through data loader (in the main process)
+def _epoch(dataloader):
+    def run():
+        for _ in dataloader:
+            pass
+    return run
+
+
+@benchmark('mnist/MNIST/epoch')
+def _mnist():
+    from torchvision import transforms
+    dataset = mnist.MNIST(_mnist_files(), train=True, transform=transforms.ToTensor())
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=256, shuffle=False)
+    return _epoch(dataloader), len(dataset)
+
+
+@benchmark('mnist/MNISTMemmap/epoch')
+def _mnist_memmap():
+    dataset = mnist.MNISTMemmap(_mnist_files(), train=True)
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=256, shuffle=False, collate_fn=utils.batch_collate)
+    return _epoch(dataloader), len(dataset)
+
+
+def measure(run, items, repeat=5, warmup=1):
+    for _ in range(warmup):
+        run()
+    times = []
+    for _ in range(repeat):
+        since = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - since)
+    seconds = float(np.median(times))
+    return {'seconds': seconds, 'min_seconds': float(np.min(times)), 'items': items,
+            'items_per_second': items / seconds if seconds > 0 else None, 'repeat': repeat}
+
+
+# Description of the machine - results are comparable only on the same one
+def machine():
+    return {'platform': platform.platform(), 'processor': platform.processor(), 'machine': platform.machine(),
+            'cpu_count': os.cpu_count(), 'threads': torch.get_num_threads(), 'python': platform.python_version(),
+            'torch': torch.__version__, 'numpy': np.__version__}
+
+
+def run_all(patterns, repeat, warmup):
+    results = {}
+    for name, setup in _benchmarks:
+        if patterns and not any(fnmatch.fnmatch(name, p) for p in patterns):
+            continue
+        try:
+            run, items = setup()
+        except Exception as e:
+            # e.g. deep architectures on small images
+            print('{0:<40}\tskipped ({1})'.format(name, str(e).splitlines()[0][:60]))
+            continue
+        result = measure(run, items, repeat, warmup)
+        results[name] = result
+        print('{0:<40}\t{1:10.2f} ms\t{2:12.1f} items/s'.format(name, result['seconds'] * 1000,
+                                                               result['items_per_second'] or 0))
+        sys.stdout.flush()
+    return results
+
+
+# Benchmarks slower than baseline by more than threshold (relative) - list of (name, ratio)
+def compare(results, baseline, threshold):
+    if baseline.get('machine') != machine():
+        print('Warning: baseline was recorded on a different machine or software versions')
+    regressions = []
+    print('\n{0:<40}\t{1:>10}\t{2:>10}\t{3:>7}'.format('Benchmark', 'Baseline', 'Current', 'Ratio'))
+    for name, result in results.items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        ratio = result['seconds'] / base['seconds']
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append((name, ratio))
+            flag = '\tREGRESSION'
+        elif ratio < 1 - threshold:
+            flag = '\timproved'
+        print('{0:<40}\t{1:8.2f}ms\t{2:8.2f}ms\t{3:7.2f}{4}'.format(name, base['seconds'] * 1000,
+                                                                   result['seconds'] * 1000, ratio, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmarks of DCEC hot paths on synthetic data')
+    parser.add_argument('--only', default=[], nargs='+', help='benchmarks matching patterns (e.g. "nets/*" "metrics/*")')
+    parser.add_argument('--repeat', default=5, type=int, help='timed repeats of each benchmark (median is reported)')
+    parser.add_argument('--warmup', default=1, type=int, help='untimed runs before measuring')
+    parser.add_argument('--output', default=None, help='JSON file with results')
+    parser.add_argument('--compare', default=None, help='JSON baseline (earlier --output on the same machine)')
+    parser.add_argument('--threshold', default=0.1, type=float, help='relative slowdown reported as regression')
+    parser.add_argument('--list', action='store_true', help='list benchmarks and exit')
+    args = parser.parse_args()
+
+    if args.list:
+        for name, _ in _benchmarks:
+            print(name)
+        sys.exit(0)
+
+    results = run_all(args.only, args.repeat, args.warmup)
+    if _mnist_root is not None:
+        shutil.rmtree(_mnist_root, ignore_errors=True)
+    output = {'machine': machine(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=1)
+        print('Results written to: ' + args.output)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('\n{} regression(s) over {:.0f}%'.format(len(regressions), 100 * args.threshold))
+            sys.exit(1)
+        print('\nNo regressions over {:.0f}%'.format(100 * args.threshold))
@@ -0,0 +1,164 @@
+from __future__ import print_function, division
+import math
+import time
+import torch
+
+# Approximate nearest-centroid search for large numbers of clusters (inverted file index)
+# Centroids (clustering layer weights) are grouped into cells by a coarse K-means, a query is compared
+# with the centroids of the nprobe nearest cells only (nprobe - recall versus speed)
+# Soft assignments q use Student's t kernel as the clustering layer, the normaliser over all clusters is
+# exact for probed cells and estimated for the others from cell size, centre and spread
+
+
+class CentroidIndex:
+    def __init__(self, weight, alpha=1.0, num_cells=None, iterations=10, seed=0):
+        weight = weight.detach().float()
+        self.alpha = alpha
+        self.num_clusters = weight.size(0)
+        if num_cells is None:
+            num_cells = max(1, int(round(math.sqrt(self.num_clusters))))
+        num_cells = min(num_cells, self.num_clusters)
+
+        # Coarse quantiser - K-means of centroids
+        generator = torch.Generator(device='cpu').manual_seed(seed)
+        cells = weight[torch.randperm(self.num_clusters, generator=generator)[:num_cells].to(weight.device)].clone()
+        for _ in range(iterations):
+            assign = _distances(weight, cells).argmin(dim=1)
+            counts = torch.bincount(assign, minlength=num_cells)
+            sums = torch.zeros_like(cells).index_add_(0, assign, weight)
+            # Empty cells keep their centres
+            filled = counts > 0
+            cells[filled] = sums[filled] / counts[filled].unsqueeze(1).to(weight.dtype)
+        assign = _distances(weight, cells).argmin(dim=1)
+
+        # Cells as contiguous blocks of reordered centroids (CSR layout)
+        self.order = torch.argsort(assign, stable=True)
+        self.centroids = weight[self.order].contiguous()
+        self.centroids_sq = torch.sum(self.centroids * self.centroids, dim=1)
+        self.sizes = torch.bincount(assign, minlength=num_cells)
+        self.offsets = torch.cat([self.sizes.new_zeros(1), torch.cumsum(self.sizes, dim=0)]).tolist()
+        self.cells = cells
+        self.max_size = int(self.sizes.max())
+        # Mean squared distance of centroids from their cell centre
+        spread = torch.sum((weight - cells[assign]) ** 2, dim=1)
+        self.spread = torch.zeros(num_cells, device=weight.device).index_add_(0, assign, spread) / \
+            self.sizes.clamp(min=1).to(spread.dtype)
+
+    @property
+    def num_cells(self):
+        return self.cells.size(0)
+
+    # Top-k clusters of queries x - (indices, q), both of size batch x k
+    def search(self, x, k=1, nprobe=8):
+        x = x.detach().float()
+        nprobe = min(nprobe, self.num_cells)
+        k = min(k, self.num_clusters)
+        x_sq = torch.sum(x * x, dim=1, keepdim=True)
+        cell_dist = _distances(x, self.cells, x_sq)
+        _, probes = torch.topk(cell_dist, nprobe, dim=1, largest=False)
+
+        # Distances to centroids of probed cells, slot (probe, position in cell)
+        dist = x.new_full((x.size(0), nprobe, self.max_size), float('inf'))
+        index = torch.full((x.size(0), nprobe, self.max_size), -1, dtype=torch.int64, device=x.device)
+        for cell in torch.unique(probes).tolist():
+            start, end = self.offsets[cell], self.offsets[cell + 1]
+            if start == end:
+                continue
+            rows, slots = (probes == cell).nonzero(as_tuple=True)
+            d = torch.addmm(x_sq[rows] + self.centroids_sq[start:end], x[rows], self.centroids[start:end].t(),
+                            alpha=-2).clamp_(min=0)
+            dist[rows, slots, :end - start] = d
+            index[rows, slots, :end - start] = self.order[start:end]
+        dist = dist.view(x.size(0), -1)
+        index = index.view(x.size(0), -1)
+
+        kernel = self._kernel(dist)
+        # Normaliser - probed centroids exactly, other cells estimated (size x kernel at expected distance)
+        estimate = self.sizes.to(x.dtype) * self._kernel(cell_dist + self.spread)
+        estimate.scatter_(1, probes, 0)
+        norm = torch.sum(kernel, dim=1, keepdim=True) + torch.sum(estimate, dim=1, keepdim=True)
+
+        top_dist, top = torch.topk(dist, k, dim=1, largest=False)
+        return torch.gather(index, 1, top), self._kernel(top_dist) / norm
+
+    def _kernel(self, dist):
+        return torch.pow(1.0 + dist / self.alpha, -(self.alpha + 1.0) / 2.0)
+
+
+# Squared euclidean distances between rows of x and y
+def _distances(x, y, x_sq=None):
+    if x_sq is None:
+        x_sq = torch.sum(x * x, dim=1, keepdim=True)
+    return torch.addmm(x_sq + torch.sum(y * y, dim=1), x, y.t(), alpha=-2).clamp_(min=0)
+
+
+# Exact top-k of the clustering layer - (indices, q)
+def exact_search(clustering, x, k=1):
+    with torch.no_grad():
+        q = clustering(x, log=False)
+    q, index = torch.topk(q, k, dim=1)
+    return index, q
+
+
+if __name__ == "__main__":
+
+    import argparse
+    import numpy as np
+    import nets
+
+    parser = argparse.ArgumentParser(description='Accuracy and latency of centroid index against clustering layer')
+    parser.add_argument('--num_clusters', default=4096, type=int, help='number of clusters (synthetic centroids)')
+    parser.add_argument('--dim', default=None, type=int, help='embedding size (default: number of clusters as in nets)')
+    parser.add_argument('--net', default=None, help='trained net - centroids taken from its clustering layer')
+    parser.add_argument('--store', default=None, help='embedding store with queries (see embedding_store)')
+    parser.add_argument('--queries', default=4096, type=int, help='number of queries')
+    parser.add_argument('--batch_size', default=256, type=int, help='queries per search')
+    parser.add_argument('--k', default=10, type=int, help='number of clusters returned')
+    parser.add_argument('--nprobe', default=[1, 2, 4, 8, 16, 32], nargs='+', type=int, help='probed cells')
+    parser.add_argument('--num_cells', default=None, type=int, help='number of cells (default: sqrt of clusters)')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    if args.net is not None:
+        weight = torch.load(args.net, map_location='cpu')['clustering.weight']
+    else:
+        # Centroids around a smaller number of modes, queries near random centroids
+        dim = args.dim if args.dim is not None else args.num_clusters
+        modes = torch.randn(max(1, args.num_clusters // 64), dim) * 4
+        weight = modes[torch.randint(len(modes), (args.num_clusters,))] + torch.randn(args.num_clusters, dim)
+    clustering = nets.ClusterlingLayer(weight.size(1), weight.size(0))
+    clustering.set_weight(weight)
+
+    if args.store is not None:
+        import embedding_store
+        queries = torch.from_numpy(np.array(embedding_store.EmbeddingStore(args.store).embeddings[:args.queries]))
+    else:
+        queries = weight[torch.randint(weight.size(0), (args.queries,))] + 0.5 * torch.randn(args.queries, weight.size(1))
+    batches = queries.split(args.batch_size)
+
+    since = time.time()
+    index = CentroidIndex(weight, alpha=clustering.alpha, num_cells=args.num_cells)
+    print('Clusters: {0}\tEmbedding size: {1}\tCells: {2}\tBuilt in {3:.2f}s'.format(
+        weight.size(0), weight.size(1), index.num_cells, time.time() - since))
+
+    since = time.time()
+    exact = [exact_search(clustering, b, args.k) for b in batches]
+    exact_time = (time.time() - since) / len(batches)
+    exact_index = torch.cat([e[0] for e in exact])
+    exact_q = torch.cat([e[1] for e in exact])
+    print('Exact:\tLatency: {0:.2f} ms/batch'.format(exact_time * 1000))
+
+    for nprobe in args.nprobe:
+        since = time.time()
+        found = [index.search(b, args.k, nprobe) for b in batches]
+        search_time = (time.time() - since) / len(batches)
+        found_index = torch.cat([f[0] for f in found])
+        found_q = torch.cat([f[1] for f in found])
+        recall_1 = (found_index[:, 0] == exact_index[:, 0]).float().mean().item()
+        recall_k = np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(exact_index.tolist(), found_index.tolist())])
+        # Error of q of the nearest cluster (if found)
+        hit = found_index[:, 0] == exact_index[:, 0]
+        q_error = ((found_q[hit, 0] - exact_q[hit, 0]).abs() / exact_q[hit, 0]).mean().item() if hit.any() else float('nan')
+        print('nprobe {0}:\tRecall@1: {1:.4f}\tRecall@{2}: {3:.4f}\tRelative q error: {4:.4f}\t'
+              'Latency: {5:.2f} ms/batch\tSpeedup: {6:.1f}x'.format(nprobe, recall_1, args.k, recall_k, q_error,
+                                                                    search_time * 1000, exact_time / search_time))
@@ -0,0 +1,78 @@
+import os
+import random
+import queue
+import threading
+import numpy as np
+import torch
+
+
+# Asynchronous checkpoint writer
+# State is copied to host memory on the calling thread and written to disk by a background thread,
+# at most one checkpoint waits in the queue (bounded memory)
+class Checkpointer:
+    def __init__(self, path):
+        self.path = path
+        self.error = None
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, state):
+        self._check()
+        self.queue.put(_copy_to_host(state))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+    def _run(self):
+        while True:
+            state = self.queue.get()
+            if state is None:
+                break
+            try:
+                # Replaced atomically, a killed job never leaves a partial checkpoint
+                tmp = self.path + '.tmp'
+                torch.save(state, tmp)
+                os.replace(tmp, self.path)
+            except Exception as e:
+                self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError('Writing checkpoint {} failed'.format(self.path)) from self.error
+
+
+# Load training state saved by Checkpointer
+def load(path, device='cpu'):
+    return torch.load(path, map_location=device, weights_only=False)
+
+
+# Random number generators states (python, numpy, torch, cuda)
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+# Copy of the state detached from training (tensors moved to cpu, arrays copied)
+def _copy_to_host(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, np.ndarray):
+        return np.array(obj)
+    if isinstance(obj, dict):
+        return {k: _copy_to_host(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_copy_to_host(v) for v in obj)
+    return obj
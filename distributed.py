@@ -0,0 +1,202 @@
+import os
+import contextlib
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.utils.data
+import metrics
+
+# Data-parallel training over processes launched with torchrun (gloo backend, works on CPU)
+# Each rank trains on its own shard of the dataset (params['shard']), gradients are averaged by
+# DistributedDataParallel (params['ddp']) and statistics over the whole dataset are all-reduced
+# All helpers do nothing in a single process (params['world_size'] not set or 1)
+
+
+# Join the process group of torchrun - (rank, world size)
+def init():
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1 and not dist.is_initialized():
+        dist.init_process_group('gloo')
+    if dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def enabled(params):
+    return params.get('world_size', 1) > 1
+
+
+def is_main(params):
+    return params.get('rank', 0) == 0
+
+
+# Samples rank, rank + world_size, ... - shards of all ranks have the same length (the shorter ones
+# are padded with their first samples), valid - number of samples of the shard without padding
+# Sample index i is kept in row i // world_size of arrays of the shard (see rows)
+# With shuffle the shard is permuted each epoch (set_epoch) with generator seeded by seed + epoch,
+# so the order of an epoch is the same in resumed runs and on all ranks; shuffle is switched off for
+# inference passes (see ordered), the data loader and its workers stay the same
+class ShardSampler(torch.utils.data.Sampler):
+    def __init__(self, total, rank=0, world_size=1, shuffle=False, seed=0):
+        self.total = total
+        self.rank = rank
+        self.world_size = world_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.length = (total + world_size - 1) // world_size
+        self.valid = self.valid_of(rank)
+
+    def valid_of(self, rank):
+        return len(range(rank, self.total, self.world_size))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        indices = list(range(self.rank, self.total, self.world_size))
+        indices = indices + indices[:self.length - len(indices)]
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            indices = [indices[i] for i in torch.randperm(len(indices), generator=generator).tolist()]
+        return iter(indices)
+
+    def __len__(self):
+        return self.length
+
+
+# The same data loader reading the shard of this rank (shuffled each epoch if shuffle is set)
+# Only one loader is built - inference passes read it in order with ordered
+def shard(dataloader, params, shuffle=False, seed=0):
+    if not enabled(params) and not shuffle:
+        return dataloader
+    sampler = ShardSampler(len(dataloader.dataset), params.get('rank', 0), params.get('world_size', 1), shuffle, seed)
+    params['shard'] = sampler
+    return torch.utils.data.DataLoader(dataloader.dataset, batch_size=dataloader.batch_size, sampler=sampler,
+                                       num_workers=dataloader.num_workers,
+                                       persistent_workers=dataloader.persistent_workers,
+                                       pin_memory=dataloader.pin_memory, prefetch_factor=dataloader.prefetch_factor,
+                                       collate_fn=dataloader.collate_fn)
+
+
+# Rows of shard arrays holding samples of given indices (tensor)
+def rows(indices, params):
+    if not enabled(params):
+        return indices
+    return indices // params['world_size']
+
+
+# Data loader reads its shard in order within the block - outputs of inference passes are kept by row
+# The sampler is iterated in the training process when an iteration starts, so persistent workers are reused;
+# the loader must not be iterated at the same time (a persistent loader has one iterator, reset by a new pass)
+@contextlib.contextmanager
+def ordered(dataloader):
+    sampler = dataloader.sampler
+    shuffle = getattr(sampler, 'shuffle', False)
+    if shuffle:
+        sampler.shuffle = False
+    try:
+        yield dataloader
+    finally:
+        if shuffle:
+            sampler.shuffle = True
+
+
+# Epoch of shuffled sampler of data loader
+def set_epoch(dataloader, epoch):
+    if hasattr(dataloader.sampler, 'set_epoch'):
+        dataloader.sampler.set_epoch(epoch)
+
+
+# Number of rows of shard arrays holding real (not padding) samples
+def valid(params):
+    if not enabled(params):
+        return None
+    return params['shard'].valid
+
+
+# Sum (or max) of numpy array over ranks
+def all_reduce(array, params, op='sum'):
+    if not enabled(params):
+        return array
+    tensor = torch.from_numpy(np.ascontiguousarray(array))
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM if op == 'sum' else dist.ReduceOp.MAX)
+    return tensor.numpy()
+
+
+# Rows of shard arrays of all ranks (without padding) on rank 0, None on other ranks
+def gather_rows(array, params):
+    if not enabled(params):
+        return array
+    tensor = torch.from_numpy(np.ascontiguousarray(array))
+    if is_main(params):
+        parts = [torch.empty_like(tensor) for _ in range(params['world_size'])]
+        dist.gather(tensor, parts, dst=0)
+        return np.concatenate([p[:params['shard'].valid_of(r)].numpy() for r, p in enumerate(parts)], axis=0)
+    dist.gather(tensor, dst=0)
+    return None
+
+
+# Picklable object of rank 0 on all ranks
+def broadcast_object(obj, params):
+    if not enabled(params):
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, 0)
+    return objects[0]
+
+
+# Tensor of rank 0 on all ranks (in place)
+def broadcast(tensor, params):
+    if enabled(params):
+        dist.broadcast(tensor, 0)
+    return tensor
+
+
+# Parameters and buffers of rank 0 on all ranks
+def broadcast_model(model, params, buffers_only=False):
+    if not enabled(params):
+        return
+    with torch.no_grad():
+        tensors = list(model.buffers()) if buffers_only else list(model.state_dict().values())
+        for tensor in tensors:
+            dist.broadcast(tensor, 0)
+
+
+# DistributedDataParallel wrapper of model for training forwards (None in a single process)
+# The wrapped module is the model itself - weights, checkpoints and inference use it directly
+# Clustering layer gets no gradients in pretraining, hence unused parameters are searched for
+def wrap(model, params):
+    if not enabled(params):
+        return None
+    device = params['device']
+    return torch.nn.parallel.DistributedDataParallel(model, device_ids=[device] if device.type == 'cuda' else None,
+                                                     find_unused_parameters=True)
+
+
+# Per-rank file (training state of shards) - rank 0 keeps the original name
+def rank_file(path, params):
+    if is_main(params):
+        return path
+    base, ext = os.path.splitext(path)
+    return '{}_rank{}{}'.format(base, params['rank'], ext)
+
+
+# Clustering metrics (NMI, ARI, ACC) of the whole dataset from all-reduced contingency table
+def evaluate(labels, preds, num_clusters, params):
+    if not enabled(params):
+        return metrics.evaluate(labels, preds)
+    return metrics.evaluate_table(contingency(labels, preds, num_clusters, params))
+
+
+# Contingency table (true classes x clusters) of all ranks
+def contingency(labels, preds, num_clusters, params):
+    labels = np.asarray(labels, dtype=np.int64)
+    preds = np.asarray(preds, dtype=np.int64)
+    num_labels = int(all_reduce(np.array([labels.max() + 1 if labels.size else 0]), params, op='max')[0])
+    table = np.bincount(labels * num_clusters + preds, minlength=num_labels * num_clusters)
+    return all_reduce(table.reshape(num_labels, num_clusters), params)
+
+
+def close(params):
+    if enabled(params):
+        dist.destroy_process_group()
@@ -0,0 +1,106 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+
+# Persistent store of embeddings, soft assignments and sample ids of an inference pass
+# Directory with raw append-only column files (ids.bin, embeddings.bin, q.bin) and meta.json
+# meta.json holds the number of committed rows and the hash of the model that wrote them -
+# readers map only committed rows, so a store being written is always consistent
+
+
+# Hash of model weights (names, shapes, dtypes and values in state_dict order)
+def model_hash(model):
+    h = hashlib.sha1()
+    for k, v in model.state_dict().items():
+        v = v.detach().cpu()
+        h.update('{}\0{}\0{}\n'.format(k, v.dtype, tuple(v.shape)).encode())
+        h.update(v.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+# Column files: name, dtype, row shape
+def _columns(meta):
+    return [('ids', np.int64, ()), ('embeddings', np.float32, (meta['embedding_dim'],)),
+            ('q', np.float32, (meta['num_clusters'],))]
+
+
+def _write_meta(path, meta):
+    tmp = os.path.join(path, 'meta.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(path, 'meta.json'))
+
+
+# Writer - a new store replaces the previous one (files are unlinked, open readers keep their data)
+class EmbeddingWriter:
+    def __init__(self, path, model, embedding_dim, num_clusters, commit_rows=65536):
+        self.path = path
+        self.commit_rows = commit_rows
+        os.makedirs(path, exist_ok=True)
+        self.meta = {'model_hash': model_hash(model), 'embedding_dim': int(embedding_dim),
+                     'num_clusters': int(num_clusters), 'count': 0}
+        _write_meta(path, self.meta)
+        self.files = {}
+        for name, _, _ in _columns(self.meta):
+            file = os.path.join(path, name + '.bin')
+            if os.path.exists(file):
+                os.remove(file)
+            self.files[name] = open(file, 'ab')
+        self.pending = 0
+
+    def append(self, ids, embeddings, q):
+        columns = {'ids': ids, 'embeddings': embeddings, 'q': q}
+        for name, dtype, _ in _columns(self.meta):
+            self.files[name].write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+        self.pending += len(ids)
+        if self.pending >= self.commit_rows:
+            self.commit()
+
+    # Rows written so far become visible to readers
+    def commit(self):
+        for f in self.files.values():
+            f.flush()
+        self.meta['count'] += self.pending
+        self.pending = 0
+        _write_meta(self.path, self.meta)
+
+    def close(self):
+        self.commit()
+        for f in self.files.values():
+            f.close()
+
+
+# Reader - columns are memory-mapped (copy on write), slices and chunks are views without copying
+class EmbeddingStore:
+    def __init__(self, path, model=None):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.model_hash = self.meta['model_hash']
+        if model is not None and self.stale(model):
+            raise RuntimeError('Embedding store {} was written by a different model'.format(path))
+        count = self.meta['count']
+        for name, dtype, shape in _columns(self.meta):
+            if count == 0:
+                column = np.empty((0,) + shape, dtype=dtype)
+            else:
+                column = np.memmap(os.path.join(path, name + '.bin'), dtype=dtype, mode='c', shape=(count,) + shape)
+            setattr(self, name, column)
+
+    # Store does not correspond to the weights of model
+    def stale(self, model):
+        return model_hash(model) != self.model_hash
+
+    def __len__(self):
+        return self.meta['count']
+
+    # (ids, embeddings, q) views of consecutive rows, numpy arrays or torch tensors sharing memory
+    def chunks(self, chunk_size=65536, tensors=False):
+        for start in range(0, len(self), chunk_size):
+            chunk = (self.ids[start:start + chunk_size], self.embeddings[start:start + chunk_size],
+                     self.q[start:start + chunk_size])
+            if tensors:
+                chunk = tuple(torch.from_numpy(c) for c in chunk)
+            yield chunk
@@ -0,0 +1,114 @@
+from statistics import NormalDist
+import numpy as np
+import metrics
+import distributed
+
+# Evaluation on a fixed stratified subsample - label change (stop criterion) and clustering metrics
+# are estimated from a fraction of samples together with confidence intervals
+# Strata are the true classes, the sample of each class is proportional to its size (at least one sample)
+# In multi-process runs every rank samples its own shard, per-class counts and tables are summed over ranks
+
+
+# Sorted rows of a stratified sample of labels (fraction of each class drawn without replacement)
+def stratified_sample(labels, fraction, seed=0):
+    labels = np.asarray(labels, dtype=np.int64)
+    if labels.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    rng = np.random.RandomState(seed)
+    order = np.argsort(labels, kind='stable')
+    counts = np.bincount(labels)
+    rows = []
+    for start, count in zip(np.cumsum(counts) - counts, counts):
+        if count == 0:
+            continue
+        size = min(count, max(1, int(round(fraction * count))))
+        rows.append(order[start + rng.choice(count, size, replace=False)])
+    return np.sort(np.concatenate(rows))
+
+
+class SubsampleEvaluator:
+    def __init__(self, labels, fraction, params, confidence=0.95, bootstrap=50, seed=0):
+        self.params = params
+        labels = np.asarray(labels[:distributed.valid(params)], dtype=np.int64)
+        num_labels = int(distributed.all_reduce(np.array([labels.max() + 1 if labels.size else 0]), params,
+                                                op='max')[0])
+        self.rows = stratified_sample(labels, fraction, seed + params.get('rank', 0))
+        self.all_labels = labels
+        self.labels = labels[self.rows]
+        # Samples per class in the dataset and in the subsample
+        self.totals = distributed.all_reduce(np.bincount(labels, minlength=num_labels), params)
+        self.sizes = distributed.all_reduce(np.bincount(self.labels, minlength=num_labels), params)
+        self.confidence = confidence
+        self.z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        self.bootstrap = bootstrap
+        # Own generator (the same on all ranks) - the global random state of training is not touched
+        self.rng = np.random.RandomState(seed)
+
+    # Number of samples evaluated (all ranks)
+    def size(self):
+        return int(self.sizes.sum())
+
+    # Fraction of samples that changed cluster - (estimate, lower bound, upper bound)
+    # Only samples of updated (boolean mask of rows) are counted if given, strata are restricted to them
+    def label_change(self, preds, preds_prev, updated=None):
+        rows, labels, sizes, totals = self.rows, self.labels, self.sizes, self.totals
+        if updated is not None:
+            updated = np.asarray(updated)[:len(self.all_labels)]
+            keep = updated[rows]
+            rows, labels = rows[keep], labels[keep]
+            sizes = distributed.all_reduce(np.bincount(labels, minlength=len(self.sizes)), self.params)
+            totals = distributed.all_reduce(np.bincount(self.all_labels[updated], minlength=len(self.sizes)),
+                                            self.params)
+        changed = np.asarray(preds)[rows] != np.asarray(preds_prev)[rows]
+        changed = distributed.all_reduce(np.bincount(labels, weights=changed, minlength=len(self.sizes)),
+                                         self.params)
+        return stratified_proportion(changed, sizes, totals, self.z)
+
+    # NMI, ARI and ACC of the dataset estimated from the subsample - (estimates, lower bounds, upper bounds)
+    # Metrics of the subsample table are biased (NMI upwards), the bias is estimated by stratified bootstrap
+    # (classes resampled separately) and subtracted; intervals are basic bootstrap ones (2 * metric - percentiles)
+    def metrics(self, preds, num_clusters):
+        preds = np.asarray(preds, dtype=np.int64)[self.rows]
+        table = np.bincount(self.labels * num_clusters + preds, minlength=len(self.sizes) * num_clusters)
+        table = distributed.all_reduce(table.reshape(len(self.sizes), num_clusters), self.params)
+        plugin = np.array(metrics.evaluate_table(self._scale(table)))
+        if self.bootstrap <= 0:
+            estimates = tuple(plugin.tolist())
+            return estimates, estimates, estimates
+        samples = np.array([metrics.evaluate_table(self._scale(self._resample(table)))
+                            for _ in range(self.bootstrap)])
+        alpha = 1 - self.confidence
+        # Ranges of NMI, ARI and ACC
+        lowest, highest = np.array([0.0, -1.0, 0.0]), 1.0
+        estimates = np.clip(2 * plugin - samples.mean(axis=0), lowest, highest)
+        low = np.clip(2 * plugin - np.percentile(samples, 100 * (1 - alpha / 2), axis=0), lowest, highest)
+        high = np.clip(2 * plugin - np.percentile(samples, 100 * alpha / 2, axis=0), lowest, highest)
+        # The estimate is always within its interval (bias larger than the spread of resamples widens it)
+        low, high = np.minimum(low, estimates), np.maximum(high, estimates)
+        return tuple(estimates.tolist()), tuple(low.tolist()), tuple(high.tolist())
+
+    # Contingency table of the dataset estimated from the one of the subsample (rows weighted by class sizes)
+    def _scale(self, table):
+        return table * (self.totals / np.maximum(self.sizes, 1))[:, None]
+
+    def _resample(self, table):
+        resampled = np.zeros_like(table)
+        for row in np.flatnonzero(self.sizes):
+            resampled[row] = self.rng.multinomial(self.sizes[row], table[row] / float(self.sizes[row]))
+        return resampled
+
+
+# Proportion in population from stratified sample - (estimate, lower bound, upper bound)
+# Normal approximation with finite population correction; proportions in variance are adjusted (k + 1) / (n + 2),
+# so the interval does not collapse to a point when no (or every) sample of a class is counted
+def stratified_proportion(counts, sizes, totals, z):
+    mask = sizes > 0
+    counts, sizes, totals = counts[mask], sizes[mask].astype(np.float64), totals[mask].astype(np.float64)
+    if sizes.size == 0:
+        return 0.0, 0.0, 1.0
+    weights = totals / totals.sum()
+    estimate = float(np.sum(weights * counts / sizes))
+    adjusted = (counts + 1) / (sizes + 2)
+    variance = np.sum(weights ** 2 * adjusted * (1 - adjusted) / sizes * (1 - sizes / totals))
+    half = z * float(np.sqrt(variance))
+    return estimate, max(0.0, estimate - half), min(1.0, estimate + half)
@@ -0,0 +1,141 @@
+from __future__ import print_function, division
+import copy
+import time
+import torch
+import nets
+
+# Export of the encoder with clustering layer (torch.export program saved to .pt2 file)
+# The exported model returns (soft assignments q, embedding) and is loaded without nets.py:
+#   model = torch.export.load(path).module()
+
+
+# Export model (CAE or FoldedCAE) to file - the batch dimension is dynamic
+def export_model(model, img_size, path, device='cpu'):
+    # Decoder layers (deconvolutions, deembedding, layers with _2 suffix) are not saved
+    model = copy.deepcopy(model)
+    for name in list(model._modules) + list(model._buffers):
+        if name.startswith(('deconv', 'deembedding')) or name.endswith('_2'):
+            delattr(model, name)
+    # Saved in standard layout (channels_last of activations comes from the exported graph)
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        tensor.data = tensor.data.contiguous()
+    encoder = nets.ClusteringEncoder(model).to(device).eval()
+    example = torch.randn(2, img_size[2], img_size[0], img_size[1], device=device)
+    batch = torch.export.Dim('batch', min=1)
+    with torch.no_grad():
+        program = torch.export.export(encoder, (example,), dynamic_shapes={'x': {0: batch}})
+    torch.export.save(program, path)
+    return program
+
+
+# Load exported model
+def load(path):
+    return torch.export.load(path).module()
+
+
+# Maximal absolute differences of exported outputs from eager ones (q, embedding)
+def parity(model, exported, inputs):
+    encoder = nets.ClusteringEncoder(model).eval()
+    with torch.no_grad():
+        q, extra_out = encoder(inputs)
+        q_exp, extra_out_exp = exported(inputs)
+    return (q - q_exp).abs().max().item(), (extra_out - extra_out_exp).abs().max().item()
+
+
+# Images per second of forward passes
+def throughput(fn, inputs, iterations=20, warmup=3):
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn(inputs)
+        since = time.time()
+        for _ in range(iterations):
+            fn(inputs)
+    return iterations * inputs.size(0) / (time.time() - since)
+
+
+if __name__ == "__main__":
+
+    import argparse
+    import os
+
+    # Translate string entries to bool for parser
+    def str2bool(v):
+        if v.lower() in ('yes', 'true', 't', 'y', '1'):
+            return True
+        elif v.lower() in ('no', 'false', 'f', 'n', '0'):
+            return False
+        else:
+            raise argparse.ArgumentTypeError('Boolean value expected.')
+
+    architectures = ['CAE_3', 'CAE_bn3', 'CAE_4', 'CAE_bn4', 'CAE_5', 'CAE_bn5']
+
+    parser = argparse.ArgumentParser(description='Export DCEC encoder with clustering layer')
+    parser.add_argument('--net_architecture', default='CAE_3', choices=architectures, help='network architecture used')
+    parser.add_argument('--net', default=None, help='path of trained weights (nets/(net_architecture_name)_(index).pt)')
+    parser.add_argument('--output', default=None, help='exported file (default: weights path with .pt2 extension)')
+    parser.add_argument('--img_size', default=[28, 28, 1], nargs=3, type=int, help='size of images')
+    parser.add_argument('--num_clusters', default=10, type=int, help='number of clusters')
+    parser.add_argument('--leaky', default=True, type=str2bool)
+    parser.add_argument('--neg_slope', default=0.01, type=float)
+    parser.add_argument('--activations', default=False, type=str2bool)
+    parser.add_argument('--bias', default=True, type=str2bool)
+    parser.add_argument('--batch_size', default=256, type=int, help='batch size for parity check and throughput')
+    parser.add_argument('--fold', default=True, type=str2bool,
+                        help='export inference version with Batch Norms folded into convolutions (channels_last)')
+    parser.add_argument('--tol', default=1e-4, type=float, help='maximal difference from eager outputs')
+    parser.add_argument('--benchmark', default=False, type=str2bool,
+                        help='parity and throughput of all architectures (random weights, nothing is saved)')
+    parser.add_argument('--compile', default=False, type=str2bool, help='include torch.compile in throughput')
+    args = parser.parse_args()
+
+    def build(name):
+        return getattr(nets, name)(args.img_size, num_clusters=args.num_clusters, leaky=args.leaky,
+                                   neg_slope=args.neg_slope, activations=args.activations, bias=args.bias).eval()
+
+    inputs = torch.randn(args.batch_size, args.img_size[2], args.img_size[0], args.img_size[1])
+
+    if args.benchmark:
+        names = architectures
+    else:
+        names = [args.net_architecture]
+
+    for name in names:
+        model = build(name)
+        if not args.benchmark:
+            if args.net is None:
+                parser.error('--net is required for export')
+            model.load_state_dict(torch.load(args.net, map_location='cpu'))
+            path = args.output if args.output is not None else os.path.splitext(args.net)[0] + '.pt2'
+        else:
+            # Deeper architectures need bigger images
+            try:
+                with torch.no_grad():
+                    model.encode(inputs[:1])
+            except RuntimeError:
+                print('{0}:\tSkipped - image size too small for the architecture'.format(name))
+                continue
+            path = os.path.join('nets', name + '_benchmark.pt2')
+            os.makedirs('nets', exist_ok=True)
+        # Batch Norms folded into convolutions, channels_last
+        folded = nets.FoldedCAE(model)
+        export_model(folded if args.fold else model, args.img_size, path)
+        exported = load(path)
+
+        # Exported model has to reproduce eager outputs
+        diff_q, diff_emb = parity(model, exported, inputs)
+        print('{0}:\tParity - max difference q: {1:.2e}\tembedding: {2:.2e}'.format(name, diff_q, diff_emb))
+        if max(diff_q, diff_emb) > args.tol:
+            raise RuntimeError('Exported {} differs from eager model'.format(name))
+
+        results = [('eager', throughput(nets.ClusteringEncoder(model).eval(), inputs)),
+                   ('folded', throughput(nets.ClusteringEncoder(folded), inputs)),
+                   ('exported', throughput(exported, inputs))]
+        if args.compile:
+            results.append(('compiled', throughput(torch.compile(nets.ClusteringEncoder(model).eval()), inputs)))
+        print('{0}:\tThroughput (images/s) - '.format(name) +
+              '\t'.join('{0}: {1:.1f}'.format(mode, value) for mode, value in results))
+
+        if args.benchmark:
+            os.remove(path)
+        else:
+            print('Exported to: ' + path)
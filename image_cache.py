@@ -0,0 +1,170 @@
+from __future__ import print_function
+import torch.utils.data as data
+from torchvision import datasets, transforms
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import torch
+
+
+class CachedImageFolder(data.Dataset):
+    """``ImageFolder`` dataset decoded and resized once into a uint8 sharded on-disk cache.
+
+    The first run decodes every image, resizes it to ``img_size`` and writes it to
+    ``cache_root/<key>/shard_XXXXX.npy``. The key covers the source paths, their
+    modification times and ``img_size``, so changed data or sizes get a new cache.
+    Later runs read straight from the memory-mapped shards. Normalisation is applied
+    once per batch when indexing with a sequence of indices (``__getitems__``).
+
+    Args:
+        root (string): Root directory of dataset (``ImageFolder`` structure).
+        img_size (list): Size of images [height, width, depth].
+        cache_root (string, optional): Directory where decoded caches are kept.
+        shard_size (int, optional): Number of images per shard file.
+        mean (sequence, optional): Means for normalisation of each channel.
+        std (sequence, optional): Standard deviations for normalisation of each channel.
+        workers (int, optional): Number of processes decoding images when building the cache.
+    """
+
+    def __init__(self, root, img_size, cache_root='cache', shard_size=4096,
+                 mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), workers=0):
+        self.root = os.path.expanduser(root)
+        self.img_size = list(img_size)
+        self.shard_size = shard_size
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+
+        # ImageFolder is only used to list files and classes, images are not decoded here
+        folder = datasets.ImageFolder(self.root)
+        self.classes = folder.classes
+        self.samples = folder.samples
+        self.targets = torch.tensor(folder.targets, dtype=torch.int64)
+
+        self.cache_dir = os.path.join(cache_root, self._cache_key())
+        if not os.path.exists(os.path.join(self.cache_dir, 'meta.json')):
+            self._build(workers)
+        self._open()
+
+    def _cache_key(self):
+        key = hashlib.sha1(json.dumps([os.path.abspath(self.root), self.img_size[0:2]]).encode())
+        for path, _ in self.samples:
+            st = os.stat(path)
+            key.update('{}\0{}\0{}\n'.format(os.path.relpath(path, self.root), st.st_mtime_ns, st.st_size).encode())
+        return key.hexdigest()
+
+    def _build(self, workers):
+        """Decode and resize all images into uint8 shards."""
+        print('Building image cache in ' + self.cache_dir)
+        # Built in a temporary directory and renamed, so concurrent runs never see partial caches
+        tmp_dir = self.cache_dir + '.{}.tmp'.format(os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        decoder = _DecodedImages(self.samples, self.img_size)
+        loader = torch.utils.data.DataLoader(decoder, batch_size=256, num_workers=workers)
+        shard = None
+        pos = 0
+        for images in loader:
+            for img in images:
+                if pos % self.shard_size == 0:
+                    if shard is not None:
+                        shard.flush()
+                    n = min(self.shard_size, len(self.samples) - pos)
+                    shard = np.lib.format.open_memmap(
+                        os.path.join(tmp_dir, 'shard_{:05d}.npy'.format(pos // self.shard_size)),
+                        mode='w+', dtype=np.uint8, shape=(n,) + tuple(img.shape))
+                shard[pos % self.shard_size] = img.numpy()
+                pos += 1
+        if shard is not None:
+            shard.flush()
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({'root': os.path.abspath(self.root), 'img_size': self.img_size, 'length': pos,
+                       'shard_size': self.shard_size}, f)
+        try:
+            os.rename(tmp_dir, self.cache_dir)
+        except OSError:
+            # Another process finished the same cache first
+            shutil.rmtree(tmp_dir)
+
+    def _open(self):
+        num_shards = (len(self.samples) + self.shard_size - 1) // self.shard_size
+        self.shards = [np.load(os.path.join(self.cache_dir, 'shard_{:05d}.npy'.format(i)), mmap_mode='r')
+                       for i in range(num_shards)]
+
+    # Memory maps are reopened in worker processes instead of being pickled as arrays
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['shards']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __getitem__(self, index):
+        """
+        Args:
+            index (int or sequence of ints): Index or batch of indices
+
+        Returns:
+            tuple: (image, target, index) where target is index of the target class
+            and index is the position of the sample in the dataset. For a batch of
+            indices images, targets and indices are stacked tensors.
+        """
+        if not isinstance(index, (int, np.integer)):
+            return self.__getitems__(index)
+        img, target, _ = self.__getitems__([index])
+        return img[0], target[0], index
+
+    def __getitems__(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        shard_idx = indices // self.shard_size
+        offsets = indices % self.shard_size
+        batch = np.empty((len(indices),) + self.shards[0].shape[1:], dtype=np.uint8)
+        for s in np.unique(shard_idx):
+            mask = shard_idx == s
+            batch[mask] = self.shards[s][offsets[mask]]
+
+        # Scaling and normalisation once per batch
+        img = torch.from_numpy(batch).float().div_(255)
+        img = img.sub_(self.mean).div_(self.std)
+        indices = torch.from_numpy(indices)
+        return img, self.targets[indices], indices
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __repr__(self):
+        fmt_str = 'Dataset ' + self.__class__.__name__ + '\n'
+        fmt_str += '    Number of datapoints: {}\n'.format(self.__len__())
+        fmt_str += '    Root Location: {}\n'.format(self.root)
+        fmt_str += '    Cache Location: {}'.format(self.cache_dir)
+        return fmt_str
+
+
+class IndexedImageFolder(datasets.ImageFolder):
+    """``ImageFolder`` returning the position of each sample with it (images are decoded on the fly).
+
+    Items are ``(image, target, index)`` as in ``CachedImageFolder``, so training can
+    look up per-sample state by index whatever the sampling order.
+    """
+
+    def __getitem__(self, index):
+        img, target = super(IndexedImageFolder, self).__getitem__(index)
+        return img, target, index
+
+
+# Images decoded and resized to uint8 tensors (used to build the cache)
+class _DecodedImages(data.Dataset):
+    def __init__(self, samples, img_size):
+        self.samples = samples
+        self.transform = transforms.Compose([
+            transforms.Resize(img_size[0:2]),
+            transforms.PILToTensor(),
+        ])
+
+    def __getitem__(self, index):
+        return self.transform(datasets.folder.default_loader(self.samples[index][0]))
+
+    def __len__(self):
+        return len(self.samples)
@@ -0,0 +1,106 @@
+import os
+import time
+import numpy as np
+import concurrent.futures
+import multiprocessing
+from threadpoolctl import threadpool_limits
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+# Initialisers of cluster centres from latent space representations
+# Each returns (centres, inertia, time in seconds)
+
+
+# Full K-means - n_init restarts spread across a process pool, best inertia is kept
+def full(embeddings, num_clusters, n_init=20, workers=None, seed=None):
+    since = time.time()
+    seeds = np.random.default_rng(seed).integers(0, 2 ** 31 - 1, size=n_init)
+    if workers is None:
+        workers = min(n_init, os.cpu_count() or 1)
+
+    if workers <= 1:
+        results = [_fit(embeddings, num_clusters, s) for s in seeds]
+    else:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        # Spawned workers - forking a process with initialised OpenMP/torch thread pools is not safe
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                    mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=_init_worker,
+                                                    initargs=(embeddings, threads)) as pool:
+            results = list(pool.map(_restart, [num_clusters] * n_init, seeds))
+
+    inertia, centres = min(results, key=lambda r: r[0])
+    return centres, inertia, time.time() - since
+
+
+# Mini-batch K-means consuming batches of embeddings as they come (nothing is materialised)
+# Inertia is accumulated per batch against the centres updated with that batch
+def minibatch(batches, num_clusters, seed=None):
+    since = time.time()
+    km = MiniBatchKMeans(n_clusters=num_clusters, random_state=seed)
+    init_size = max(3 * num_clusters, 1024)
+    buffer = []
+    buffered = 0
+    inertia = 0.0
+    for embeddings in batches:
+        # Initial centres need more samples than a single batch may hold
+        if buffer is not None:
+            buffer.append(embeddings)
+            buffered += len(embeddings)
+            if buffered < init_size:
+                continue
+            embeddings = np.concatenate(buffer, axis=0)
+            buffer = None
+        km.partial_fit(embeddings)
+        inertia += -km.score(embeddings)
+    if buffer:
+        embeddings = np.concatenate(buffer, axis=0)
+        km.partial_fit(embeddings)
+        inertia += -km.score(embeddings)
+    return km.cluster_centers_, inertia, time.time() - since
+
+
+# K-means++ seeding and K-means on a uniform reservoir sample of the streamed embeddings
+def reservoir(batches, num_clusters, sample_size=50000, n_init=20, workers=None, seed=None):
+    since = time.time()
+    rng = np.random.default_rng(seed)
+    sample = None
+    seen = 0
+    for embeddings in batches:
+        if sample is None:
+            sample = np.empty((sample_size, embeddings.shape[1]), dtype=embeddings.dtype)
+        # Fill the reservoir first
+        n = min(len(embeddings), max(sample_size - seen, 0))
+        sample[seen:seen + n] = embeddings[:n]
+        # Algorithm R - sample at position p replaces a random slot with probability sample_size / (p + 1)
+        rest = embeddings[n:]
+        if len(rest):
+            slots = rng.integers(0, np.arange(seen + n, seen + len(embeddings)) + 1)
+            keep = slots < sample_size
+            sample[slots[keep]] = rest[keep]
+        seen += len(embeddings)
+    sample = sample[:min(seen, sample_size)]
+
+    centres, inertia, _ = full(sample, num_clusters, n_init=n_init, workers=workers, seed=rng.integers(2 ** 31 - 1))
+    return centres, inertia, time.time() - since
+
+
+# Process pool helpers - data is sent once per worker
+_data = None
+_limits = None
+
+
+def _init_worker(embeddings, threads):
+    global _data, _limits
+    _data = embeddings
+    _limits = threadpool_limits(threads)
+
+
+def _restart(num_clusters, seed):
+    return _fit(_data, num_clusters, seed)
+
+
+# Single restart - K-means++ seeding followed by Lloyd's iterations
+def _fit(embeddings, num_clusters, seed):
+    km = KMeans(n_clusters=num_clusters, init='k-means++', n_init=1, random_state=seed)
+    km.fit(embeddings)
+    return km.inertia_, km.cluster_centers_
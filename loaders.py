@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import platform
+import torch
+
+# Data loaders of all phases built from one configuration: worker processes, prefetch depth (batches per worker),
+# pinned memory (only with CUDA) and batch size
+# The configuration is fixed or tuned by a short startup probe reading a few batches of the dataset with each
+# candidate; the choice is cached per machine and dataset (JSON file), so later runs skip the probe
+
+
+# Data loader of dataset with configuration (persistent workers, reused by all phases)
+def build(dataset, config, collate_fn=None, sampler=None, persistent=True):
+    workers = config['workers']
+    return torch.utils.data.DataLoader(dataset, batch_size=config['batch_size'], shuffle=False, sampler=sampler,
+                                       num_workers=workers, persistent_workers=persistent and workers > 0,
+                                       pin_memory=config.get('pin_memory', False),
+                                       prefetch_factor=config.get('prefetch', 2) if workers > 0 else None,
+                                       collate_fn=collate_fn)
+
+
+# Configuration without tuning
+def default(batch_size, workers=4):
+    return {'batch_size': batch_size, 'workers': workers, 'prefetch': 2, 'pin_memory': torch.cuda.is_available()}
+
+
+# Candidate configurations - worker counts up to the CPUs available to the process, prefetch depths, batch sizes
+def candidates(batch_sizes, max_workers, prefetch=(2, 4, 8)):
+    workers = [0]
+    while workers[-1] < max_workers:
+        workers.append(min(max(1, 2 * workers[-1]), max_workers))
+    configs = []
+    for batch_size in batch_sizes:
+        for w in workers:
+            for p in (prefetch if w > 0 else prefetch[:1]):
+                configs.append({'batch_size': batch_size, 'workers': w, 'prefetch': p,
+                                'pin_memory': torch.cuda.is_available()})
+    return configs
+
+
+# Samples per second reading batches of dataset (the first batch, with start of workers, is not timed)
+def probe(dataset, config, collate_fn=None, batches=20):
+    loader = build(dataset, config, collate_fn, persistent=False)
+    iterator = iter(loader)
+    try:
+        next(iterator)
+        samples = 0
+        start = time.perf_counter()
+        for _ in range(batches):
+            try:
+                data = next(iterator)
+            except StopIteration:
+                break
+            samples += len(data[0])
+        seconds = time.perf_counter() - start
+    finally:
+        del iterator
+    return samples / seconds if seconds > 0 else 0.0
+
+
+# Configuration with the highest throughput - the cheapest one (fewest workers, smallest prefetch) within
+# tolerance of the best is taken, extra workers only take memory and CPUs from training
+# Results are cached in cache_file under the machine, dataset key and candidates
+def tune(dataset, key, configs, collate_fn=None, cache_file=None, batches=20, tolerance=0.05, report=None):
+    cache_key = '|'.join([machine(), key, json.dumps(configs, sort_keys=True)])
+    cache = _read(cache_file)
+    if cache_key in cache:
+        return cache[cache_key]['config'], True
+
+    results = []
+    for config in configs:
+        rate = probe(dataset, config, collate_fn, batches)
+        results.append(dict(config, samples_per_second=rate))
+        if report is not None:
+            report('Loader probe:\tBatch size: {0}\tWorkers: {1}\tPrefetch: {2}\tSamples/s: {3:.1f}'.format(
+                config['batch_size'], config['workers'], config['prefetch'], rate))
+    best = max(r['samples_per_second'] for r in results)
+    chosen = min((r for r in results if r['samples_per_second'] >= (1 - tolerance) * best),
+                 key=lambda r: (r['workers'], r['prefetch'], -r['batch_size']))
+    config = {k: chosen[k] for k in ('batch_size', 'workers', 'prefetch', 'pin_memory')}
+
+    if cache_file is not None:
+        # Re-read - other runs may have added their choices meanwhile, file replaced atomically
+        cache = _read(cache_file)
+        cache[cache_key] = {'config': config, 'results': results, 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+        directory = os.path.dirname(cache_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = '{}.{}.tmp'.format(cache_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(cache, f, indent=1)
+        os.replace(tmp, cache_file)
+    return config, False
+
+
+# Machine the choice is valid for
+def machine():
+    return '{0}/{1}/{2} CPUs/torch {3}'.format(platform.node(), platform.machine(), os.cpu_count(), torch.__version__)
+
+
+def _read(cache_file):
+    if cache_file is None or not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
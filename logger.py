@@ -0,0 +1,155 @@
+import atexit
+import queue
+import threading
+import numpy as np
+import torch
+import utils
+
+# Asynchronous training log - text lines, scalars and images are put on a bounded queue and written by
+# a background thread to pluggable backends (report file and console, tensorboard, ...)
+# Text is never dropped (the caller waits if the queue is full), scalars and images are dropped instead
+# Tensors are copied on their device and converted on the background thread - logging does not sync the device
+
+
+# Backend interface - subclasses override what they support
+class Backend:
+    def text(self, line):
+        pass
+
+    def scalar(self, tag, value, step):
+        pass
+
+    def image(self, tag, img, step):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# Report file (and console)
+class FileBackend(Backend):
+    def __init__(self, f, console=True):
+        self.f = f
+        self.console = console
+
+    def text(self, line):
+        if self.console:
+            print(line)
+        self.f.write(line + '\n')
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+# Tensorboard (SummaryWriter)
+class TensorboardBackend(Backend):
+    def __init__(self, writer):
+        self.writer = writer
+
+    def scalar(self, tag, value, step):
+        self.writer.add_scalar(tag, value, step)
+
+    def image(self, tag, img, step):
+        self.writer.add_image(tag, img, step)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+
+# Used in place of report file (utils.print_both) and SummaryWriter (add_scalar, add_image)
+class AsyncLogger:
+    def __init__(self, backends, maxsize=1024):
+        self.backends = list(backends)
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        # Lines queued before an unhandled exception are still written
+        atexit.register(self._drain)
+
+    # Line printed to console and written to report
+    def print(self, line):
+        self._check()
+        self.queue.put(('text', line))
+
+    # File-like write of report text
+    def write(self, text):
+        self.print(text[:-1] if text.endswith('\n') else text)
+
+    def add_scalar(self, tag, value, step=None):
+        if isinstance(value, torch.Tensor):
+            value = value.detach().clone()
+        self._put(('scalar', tag, value, step))
+
+    # Images (first of each batch) of tensors placed side by side
+    def add_images(self, tag, tensors, step=None):
+        self._put(('image', tag, [t.detach()[:1].clone() for t in tensors], step))
+
+    # Wait until everything queued so far is written
+    def flush(self):
+        self._check()
+        self.queue.join()
+        for backend in self.backends:
+            backend.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.dropped:
+            self.print('Log entries dropped (queue full):\t' + str(self.dropped))
+        self.queue.put(None)
+        self.thread.join()
+        self.closed = True
+        for backend in self.backends:
+            backend.close()
+        self._check()
+
+    def _drain(self):
+        if not self.closed and self.thread.is_alive():
+            self.queue.join()
+
+    def _put(self, entry):
+        self._check()
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            entry = self.queue.get()
+            try:
+                if entry is None:
+                    break
+                if entry[0] == 'text':
+                    for backend in self.backends:
+                        backend.text(entry[1])
+                elif entry[0] == 'scalar':
+                    _, tag, value, step = entry
+                    value = float(value)
+                    for backend in self.backends:
+                        backend.scalar(tag, value, step)
+                else:
+                    _, tag, tensors, step = entry
+                    img = np.concatenate([utils.tensor2img(t) for t in tensors], axis=1)
+                    for backend in self.backends:
+                        backend.image(tag, img, step)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError('Writing training log failed') from self.error
@@ -0,0 +1,100 @@
+import numpy as np
+import torch
+from scipy.optimize import linear_sum_assignment
+
+# Clustering metrics (NMI, ARI, ACC) computed from a single contingency table
+# Labels may be numpy arrays, torch tensors or lists
+
+
+# Contingency table (true classes x predicted clusters) built with one bincount
+def contingency(labels_true, labels_pred):
+    labels_true, n_true = _encode(labels_true)
+    labels_pred, n_pred = _encode(labels_pred)
+    assert labels_true.size == labels_pred.size
+    table = np.bincount(labels_true * n_pred + labels_pred, minlength=n_true * n_pred)
+    return table.reshape(n_true, n_pred)
+
+
+# All metrics from one shared table: (NMI, ARI, ACC)
+def evaluate(labels_true, labels_pred):
+    return evaluate_table(contingency(labels_true, labels_pred))
+
+
+def evaluate_table(table):
+    return nmi_table(table), ari_table(table), acc_table(table)
+
+
+def nmi(labels_true, labels_pred):
+    return nmi_table(contingency(labels_true, labels_pred))
+
+
+def ari(labels_true, labels_pred):
+    return ari_table(contingency(labels_true, labels_pred))
+
+
+def acc(labels_true, labels_pred):
+    return acc_table(contingency(labels_true, labels_pred))
+
+
+# Accuracy under the best one-to-one matching of clusters to classes (Hungarian algorithm)
+def acc_table(table):
+    n = table.sum()
+    if n == 0:
+        return 0.0
+    rows, cols = linear_sum_assignment(table, maximize=True)
+    return float(table[rows, cols].sum()) / float(n)
+
+
+# Normalized mutual information with arithmetic mean normalisation (as in scikit-learn)
+def nmi_table(table):
+    table = table[table.sum(axis=1) > 0][:, table.sum(axis=0) > 0]
+    # No clustering since the data is not split
+    if table.shape[0] == table.shape[1] <= 1:
+        return 1.0
+    n = float(table.sum())
+    n_true = table.sum(axis=1).astype(np.float64)
+    n_pred = table.sum(axis=0).astype(np.float64)
+    rows, cols = np.nonzero(table)
+    counts = table[rows, cols].astype(np.float64)
+    mi = np.sum(counts / n * (np.log(counts) + np.log(n) - np.log(n_true[rows]) - np.log(n_pred[cols])))
+    mi = max(mi, 0.0)
+    if mi == 0.0:
+        return 0.0
+    h_true = -np.sum(n_true / n * np.log(n_true / n))
+    h_pred = -np.sum(n_pred / n * np.log(n_pred / n))
+    return float(mi / max((h_true + h_pred) / 2, np.finfo('float64').eps))
+
+
+# Adjusted Rand index from the pair confusion matrix
+# Tables of counts or weighted (float) tables, e.g. estimated from a subsample
+def ari_table(table):
+    if np.issubdtype(table.dtype, np.floating):
+        table, number = table.astype(np.float64), float
+    else:
+        table, number = table.astype(np.int64), int
+    n = number(table.sum())
+    sum_squares = number((table ** 2).sum())
+    sum_true = number((table.sum(axis=1) ** 2).sum())
+    sum_pred = number((table.sum(axis=0) ** 2).sum())
+    # Python integers - products of pair counts overflow int64 for millions of samples
+    tp = sum_squares - n
+    fp = sum_pred - sum_squares
+    fn = sum_true - sum_squares
+    tn = n ** 2 - fp - fn - sum_squares
+    # Special cases: empty data or full agreement
+    if fn == 0 and fp == 0:
+        return 1.0
+    return 2. * (tp * tn - fn * fp) / ((tp + fn) * (fn + tn) + (tp + fp) * (fp + tn))
+
+
+# Labels as int64 codes 0..n-1 (non-negative integer labels are used directly)
+def _encode(labels):
+    if isinstance(labels, torch.Tensor):
+        labels = labels.detach().cpu().numpy()
+    labels = np.asarray(labels).ravel()
+    if labels.size and np.issubdtype(labels.dtype, np.integer) and labels.min() >= 0 \
+            and labels.max() < 2 * labels.size:
+        labels = labels.astype(np.int64, copy=False)
+        return labels, int(labels.max()) + 1
+    uniques, labels = np.unique(labels, return_inverse=True)
+    return labels.astype(np.int64, copy=False), max(len(uniques), 1)
@@ -0,0 +1,107 @@
+import threading
+import concurrent.futures
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import metrics
+import distributed
+import utils
+
+# Clustering metrics (NMI, ARI, ACC) computed off the training critical path
+# Labels and predictions are copied into shared memory and evaluated by a worker process, results are
+# logged to the report and tensorboard when they complete - training waits for them only when closing
+# In multi-process runs the contingency table is all-reduced on the training thread (collective), then
+# only the table is evaluated by the workers of rank 0
+
+
+class MetricsPool:
+    def __init__(self, params, workers=1):
+        self.params = params
+        self.txt_file = params['txt_file']
+        self.writer = params['writer']
+        self.pool = None
+        if distributed.is_main(params):
+            # Spawned workers - forking a process with initialised OpenMP/torch thread pools is not safe
+            self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                               mp_context=multiprocessing.get_context('spawn'))
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.error = None
+        # Metrics of the latest target update evaluated so far
+        self.latest = None
+        self.latest_step = -1
+
+    # Metrics of predictions logged as name in report and at step in tensorboard
+    def submit(self, labels, preds, num_clusters, step, name):
+        self._check()
+        valid = distributed.valid(self.params)
+        labels, preds = labels[:valid], preds[:valid]
+        block = None
+        if distributed.enabled(self.params):
+            table = distributed.contingency(labels, preds, num_clusters, self.params)
+            if self.pool is None:
+                return
+            future = self.pool.submit(metrics.evaluate_table, table)
+        else:
+            block = _share(labels, preds)
+            future = self.pool.submit(_evaluate_shared, block.name, len(labels))
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(lambda f: self._done(f, step, name, block))
+
+    # Wait for all results - returns metrics of the latest update
+    def close(self):
+        if self.pool is not None:
+            concurrent.futures.wait(list(self.pending))
+            self.pool.shutdown()
+            self.pool = None
+        self._check()
+        return self.latest
+
+    def _done(self, future, step, name, block):
+        try:
+            if block is not None:
+                block.close()
+                block.unlink()
+            nmi, ari, acc = future.result()
+            with self.lock:
+                if step > self.latest_step:
+                    self.latest, self.latest_step = (nmi, ari, acc), step
+            utils.print_both(self.txt_file, 'Metrics ({0}):\tNMI: {1:.5f}\tARI: {2:.5f}\tAcc {3:.5f}'.format(name, nmi,
+                                                                                                      ari, acc))
+            if self.writer is not None:
+                self.writer.add_scalar('/NMI', nmi, step)
+                self.writer.add_scalar('/ARI', ari, step)
+                self.writer.add_scalar('/Acc', acc, step)
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.lock:
+                self.pending.discard(future)
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError('Computing clustering metrics failed') from self.error
+
+
+# Labels and predictions (valid rows) in a new shared memory block - rows 0 and 1 of int64 array
+def _share(labels, preds):
+    n = len(labels)
+    block = shared_memory.SharedMemory(create=True, size=max(1, 2 * n * 8))
+    array = np.ndarray((2, n), dtype=np.int64, buffer=block.buf)
+    array[0] = labels
+    array[1] = preds
+    del array
+    return block
+
+
+# Worker - metrics of arrays in shared memory (the block is released by the training process)
+def _evaluate_shared(name, n):
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        array = np.ndarray((2, n), dtype=np.int64, buffer=block.buf)
+        result = metrics.evaluate(array[0], array[1])
+        del array
+        return result
+    finally:
+        block.close()
@@ -75,7 +75,8 @@ class MNIST(data.Dataset):
             index (int): Index
 
         Returns:
-            tuple: (image, target) where target is index of the target class.
+            tuple: (image, target, index) where target is index of the target class
+            and index is the position of the sample in the dataset.
         """
         if self.train:
             img, target = self.train_data[index], self.train_labels[index]
@@ -95,7 +96,7 @@ class MNIST(data.Dataset):
         if self.target_transform is not None:
             target = self.target_transform(target)
 
-        return img, target
+        return img, target, index
 
     def __len__(self):
         if self.train:
@@ -168,6 +169,153 @@ class MNIST(data.Dataset):
         return fmt_str
 
 
+class MNISTMemmap(MNIST):
+    """Tensor-native `MNIST <http://yann.lecun.com/exdb/mnist/>`_ Dataset.
+
+    Images of both splits are kept in a single uint8 memory-mapped array
+    (``processed/memmap_training.npy``, created once from the processed files) and
+    served without PIL. Indexing with a sequence of indices (``__getitems__`` or a
+    ``BatchSampler`` passed as ``sampler``) returns a whole batch as a float tensor,
+    scaled to [0, 1] once per batch.
+
+    Args:
+        root (string): Root directory of dataset where ``processed/training.pt``
+            and  ``processed/test.pt`` exist.
+        train (bool, optional): If True, creates dataset from ``training.pt``,
+            otherwise from ``test.pt``.
+        download (bool, optional): If true, downloads the dataset from the internet and
+            puts it in root directory. If dataset is already downloaded, it is not
+            downloaded again.
+        transform (callable, optional): A function/transform that takes in a float
+            tensor (single image or batch) and returns a transformed version.
+            E.g, ``transforms.Normalize``
+        target_transform (callable, optional): A function/transform that takes in the
+            target (or tensor of targets) and transforms it.
+    """
+
+    def __init__(self, root, train=True, transform=None, target_transform=None, download=False, small=False, full=False):
+        self.root = os.path.expanduser(root)
+        self.transform = transform
+        self.target_transform = target_transform
+        self.train = train  # training set or test set
+        self.full = full
+
+        if full:
+            self.train = True
+
+        if download:
+            self.download()
+
+        if not self._check_exists():
+            raise RuntimeError('Dataset not found.' +
+                               ' You can use download=True to download it')
+
+        if not self._check_memmap_exists():
+            self._create_memmap()
+
+        meta = np.load(self._memmap_path('_labels.npz'))
+        labels, n_train = meta['labels'], int(meta['n_train'])
+
+        # Splits are slices of the single array, so no copies are made
+        self.train_slice = slice(0, len(labels) if full else n_train)
+        self.test_slice = slice(n_train, len(labels))
+        if small:
+            self.train_slice = slice(0, 1400 if full else 1200)
+            self.test_slice = slice(n_train, n_train + 200)
+        self.train_labels = torch.from_numpy(labels[self.train_slice])
+        self.test_labels = torch.from_numpy(labels[self.test_slice])
+        self._open()
+
+    def _open(self):
+        images = np.load(self._memmap_path('.npy'), mmap_mode='r')
+        self.train_data = images[self.train_slice]
+        self.test_data = images[self.test_slice]
+
+    # Memory maps are reopened in worker processes instead of being pickled as arrays
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['train_data'], state['test_data']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __getitem__(self, index):
+        """
+        Args:
+            index (int or sequence of ints): Index or batch of indices
+
+        Returns:
+            tuple: (image, target, index) where target is index of the target class
+            and index is the position of the sample in the dataset. For a batch of
+            indices images, targets and indices are stacked tensors.
+        """
+        if not isinstance(index, (int, np.integer)):
+            return self.__getitems__(index)
+
+        if self.train:
+            img, target = self.train_data[index], self.train_labels[index]
+        else:
+            img, target = self.test_data[index], self.test_labels[index]
+
+        img = torch.from_numpy(np.array(img)).unsqueeze(0).float().div_(255)
+
+        if self.transform is not None:
+            img = self.transform(img)
+
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+
+        return img, target, index
+
+    def __getitems__(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.train:
+            data, labels = self.train_data, self.train_labels
+        else:
+            data, labels = self.test_data, self.test_labels
+
+        # Single gather from the memory map and one scaling for the whole batch
+        img = torch.from_numpy(data[indices]).unsqueeze(1).float().div_(255)
+        target = labels[torch.from_numpy(indices)]
+
+        if self.transform is not None:
+            img = self.transform(img)
+
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+
+        return img, target, torch.from_numpy(indices)
+
+    def _memmap_path(self, suffix):
+        return os.path.join(self.root, self.processed_folder,
+                            'memmap_' + os.path.splitext(self.training_file)[0] + suffix)
+
+    def _check_memmap_exists(self):
+        return os.path.exists(self._memmap_path('.npy')) and os.path.exists(self._memmap_path('_labels.npz'))
+
+    def _create_memmap(self):
+        """Write train and test images to a single uint8 memory-mapped array."""
+        train_data, train_labels = torch.load(os.path.join(self.root, self.processed_folder, self.training_file))
+        test_data, test_labels = torch.load(os.path.join(self.root, self.processed_folder, self.test_file))
+        n_train = len(train_data)
+        shape = (n_train + len(test_data),) + tuple(train_data.shape[1:])
+
+        # Written to temporary files first, so concurrent runs never see partial arrays
+        tmp = '.{}.tmp'.format(os.getpid())
+        images = np.lib.format.open_memmap(self._memmap_path(tmp + '.npy'), mode='w+', dtype=np.uint8, shape=shape)
+        images[:n_train] = train_data.numpy()
+        images[n_train:] = test_data.numpy()
+        images.flush()
+        del images
+        labels = np.concatenate((train_labels.numpy(), test_labels.numpy()), axis=0).astype(np.int64)
+        with open(self._memmap_path(tmp + '_labels.npz'), 'wb') as f:
+            np.savez(f, labels=labels, n_train=n_train)
+        os.replace(self._memmap_path(tmp + '.npy'), self._memmap_path('.npy'))
+        os.replace(self._memmap_path(tmp + '_labels.npz'), self._memmap_path('_labels.npz'))
+
+
 class FashionMNIST(MNIST):
     """`Fashion-MNIST <https://github.com/zalandoresearch/fashion-mnist>`_ Dataset.
 
@@ -290,6 +438,20 @@ class EMNIST(MNIST):
         print('Done!')
 
 
+class FashionMNISTMemmap(FashionMNIST, MNISTMemmap):
+    """Tensor-native `Fashion-MNIST <https://github.com/zalandoresearch/fashion-mnist>`_ Dataset.
+
+    See :class:`MNISTMemmap` and :class:`FashionMNIST` for arguments.
+    """
+
+
+class EMNISTMemmap(EMNIST, MNISTMemmap):
+    """Tensor-native `EMNIST <https://www.nist.gov/itl/iad/image-group/emnist-dataset/>`_ Dataset.
+
+    See :class:`MNISTMemmap` and :class:`EMNIST` for arguments.
+    """
+
+
 def get_int(b):
     return int(codecs.encode(b, 'hex'), 16)
 
@@ -313,3 +475,4 @@ def read_image_file(path):
         images = []
         parsed = np.frombuffer(data, dtype=np.uint8, offset=16)
         return torch.from_numpy(parsed).view(length, num_rows, num_cols)
+
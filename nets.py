@@ -3,24 +3,28 @@ import torch.nn as nn
 import copy
 
 # Clustering layer definition (see DCEC article for equations)
+# Returns log of soft assignments q (numerically stable KL), q itself with log=False
 class ClusterlingLayer(nn.Module):
-    def __init__(self, in_features=10, out_features=10, alpha=1.0):
+    def __init__(self, in_features=10, out_features=10, alpha=1.0, chunk_size=4096):
         super(ClusterlingLayer, self).__init__()
         self.in_features = in_features
         self.out_features = out_features
         self.alpha = alpha
+        self.chunk_size = chunk_size
         self.weight = nn.Parameter(torch.Tensor(self.out_features, self.in_features))
         self.weight = nn.init.xavier_uniform_(self.weight)
 
-    def forward(self, x):
-        x = x.unsqueeze(1) - self.weight
-        x = torch.mul(x, x)
-        x = torch.sum(x, dim=2)
-        x = 1.0 + (x / self.alpha)
-        x = 1.0 / x
-        x = x ** ((self.alpha +1.0) / 2.0)
-        x = torch.t(x) / torch.sum(x, dim=1)
-        x = torch.t(x)
+    def forward(self, x, log=True):
+        # Always computed in fp32, also inside mixed precision (autocast) regions
+        with torch.autocast(x.device.type, enabled=False):
+            x = x.float()
+            if torch.is_grad_enabled() and (x.requires_grad or self.weight.requires_grad):
+                x = ClusteringFunction.apply(x, self.weight, self.alpha, self.chunk_size)
+            else:
+                x = _log_kernel(x, self.weight, self.alpha, self.chunk_size)
+                x = x - torch.logsumexp(x, dim=1, keepdim=True)
+        if not log:
+            x = torch.exp(x)
         return x
 
     def extra_repr(self):
@@ -28,505 +32,285 @@ class ClusterlingLayer(nn.Module):
             self.in_features, self.out_features, self.alpha
         )
 
+    # Copied in place - optimizers (and their checkpoints) keep referencing the same parameter
     def set_weight(self, tensor):
-        self.weight = nn.Parameter(tensor)
+        with torch.no_grad():
+            self.weight.copy_(tensor)
 
 
-# Convolutional autoencoder directly from DCEC article
-class CAE_3(nn.Module):
-    def __init__(self, input_shape=[128,128,3], num_clusters=10, filters=[32, 64, 128], leaky=True, neg_slope=0.01, activations=False, bias=True):
-        super(CAE_3, self).__init__()
-        self.activations = activations
-        # bias = True
-        self.pretrained = False
-        self.num_clusters = num_clusters
-        self.input_shape = input_shape
-        self.filters = filters
-        self.conv1 = nn.Conv2d(input_shape[2], filters[0], 5, stride=2, padding=2, bias=bias)
-        if leaky:
-            self.relu = nn.LeakyReLU(negative_slope=neg_slope)
-        else:
-            self.relu = nn.ReLU(inplace=False)
-        self.conv2 = nn.Conv2d(filters[0], filters[1], 5, stride=2, padding=2, bias=bias)
-        self.conv3 = nn.Conv2d(filters[1], filters[2], 3, stride=2, padding=0, bias=bias)
-        lin_features_len = ((input_shape[0]//2//2-1) // 2) * ((input_shape[0]//2//2-1) // 2) * filters[2]
-        self.embedding = nn.Linear(lin_features_len, num_clusters, bias=bias)
-        self.deembedding = nn.Linear(num_clusters, lin_features_len, bias=bias)
-        out_pad = 1 if input_shape[0] // 2 // 2 % 2 == 0 else 0
-        self.deconv3 = nn.ConvTranspose2d(filters[2], filters[1], 3, stride=2, padding=0, output_padding=out_pad, bias=bias)
-        out_pad = 1 if input_shape[0] // 2 % 2 == 0 else 0
-        self.deconv2 = nn.ConvTranspose2d(filters[1], filters[0], 5, stride=2, padding=2, output_padding=out_pad, bias=bias)
-        out_pad = 1 if input_shape[0] % 2 == 0 else 0
-        self.deconv1 = nn.ConvTranspose2d(filters[0], input_shape[2], 5, stride=2, padding=2, output_padding=out_pad, bias=bias)
-        self.clustering = ClusterlingLayer(num_clusters, num_clusters)
-        # ReLU copies for graph representation in tensorboard
-        self.relu1_1 = copy.deepcopy(self.relu)
-        self.relu2_1 = copy.deepcopy(self.relu)
-        self.relu3_1 = copy.deepcopy(self.relu)
-        self.relu1_2 = copy.deepcopy(self.relu)
-        self.relu2_2 = copy.deepcopy(self.relu)
-        self.relu3_2 = copy.deepcopy(self.relu)
-        self.sig = nn.Sigmoid()
-        self.tanh = nn.Tanh()
+# Unnormalised log of Student's t kernel: -(alpha + 1) / 2 * log(1 + ||x - mu||^2 / alpha)
+# Distances come from ||x||^2 + ||mu||^2 - 2 x.mu, clusters are processed in chunks (no B x K x D tensor)
+def _log_kernel(x, weight, alpha, chunk_size):
+    x_sq = torch.sum(x * x, dim=1, keepdim=True)
+    out = x.new_empty(x.size(0), weight.size(0))
+    for start in range(0, weight.size(0), chunk_size):
+        w = weight[start:start + chunk_size]
+        dist = torch.addmm(x_sq + torch.sum(w * w, dim=1), x, w.t(), alpha=-2).clamp_(min=0)
+        out[:, start:start + chunk_size] = torch.log1p(dist / alpha).mul_(-(alpha + 1.0) / 2.0)
+    return out
 
-    def forward(self, x):
-        x = self.conv1(x)
-        x = self.relu1_1(x)
-        x = self.conv2(x)
-        x = self.relu2_1(x)
-        x = self.conv3(x)
-        if self.activations:
-            x = self.sig(x)
-        else:
-            x = self.relu3_1(x)
-        x = x.view(x.size(0), -1)
-        x = self.embedding(x)
-        extra_out = x
-        clustering_out = self.clustering(x)
-        x = self.deembedding(x)
-        x = self.relu1_2(x)
-        x = x.view(x.size(0), self.filters[2], ((self.input_shape[0]//2//2-1) // 2), ((self.input_shape[0]//2//2-1) // 2))
-        x = self.deconv3(x)
-        x = self.relu2_2(x)
-        x = self.deconv2(x)
-        x = self.relu3_2(x)
-        x = self.deconv1(x)
-        if self.activations:
-            x = self.tanh(x)
-        return x, clustering_out, extra_out
 
+# Fused forward and backward of the clustering layer - only B x K tensors are kept for backward
+class ClusteringFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, weight, alpha, chunk_size):
+        log_q = _log_kernel(x, weight, alpha, chunk_size)
+        log_q = log_q - torch.logsumexp(log_q, dim=1, keepdim=True)
+        ctx.save_for_backward(x, weight, log_q)
+        ctx.alpha = alpha
+        ctx.chunk_size = chunk_size
+        return log_q
 
-# Convolutional autoencoder from DCEC article with Batch Norms and Leaky ReLUs
-class CAE_bn3(nn.Module):
-    def __init__(self, input_shape=[128,128,3], num_clusters=10, filters=[32, 64, 128], leaky=True, neg_slope=0.01, activations=False, bias=True):
-        super(CAE_bn3, self).__init__()
-        self.activations=activations
-        self.pretrained = False
-        self.num_clusters = num_clusters
-        self.input_shape = input_shape
-        self.filters = filters
-        self.conv1 = nn.Conv2d(input_shape[2], filters[0], 5, stride=2, padding=2, bias=bias)
-        self.bn1_1 = nn.BatchNorm2d(filters[0])
-        if leaky:
-            self.relu = nn.LeakyReLU(negative_slope=neg_slope)
-        else:
-            self.relu = nn.ReLU(inplace=False)
-        self.conv2 = nn.Conv2d(filters[0], filters[1], 5, stride=2, padding=2, bias=bias)
-        self.bn2_1 = nn.BatchNorm2d(filters[1])
-        self.conv3 = nn.Conv2d(filters[1], filters[2], 3, stride=2, padding=0, bias=bias)
-        lin_features_len = ((input_shape[0]//2//2-1) // 2) * ((input_shape[0]//2//2-1) // 2) * filters[2]
-        self.embedding = nn.Linear(lin_features_len, num_clusters, bias=bias)
-        self.deembedding = nn.Linear(num_clusters, lin_features_len, bias=bias)
-        out_pad = 1 if input_shape[0] // 2 // 2 % 2 == 0 else 0
-        self.deconv3 = nn.ConvTranspose2d(filters[2], filters[1], 3, stride=2, padding=0, output_padding=out_pad, bias=bias)
-        out_pad = 1 if input_shape[0] // 2 % 2 == 0 else 0
-        self.bn3_2 = nn.BatchNorm2d(filters[1])
-        self.deconv2 = nn.ConvTranspose2d(filters[1], filters[0], 5, stride=2, padding=2, output_padding=out_pad, bias=bias)
-        out_pad = 1 if input_shape[0] % 2 == 0 else 0
-        self.bn2_2 = nn.BatchNorm2d(filters[0])
-        self.deconv1 = nn.ConvTranspose2d(filters[0], input_shape[2], 5, stride=2, padding=2, output_padding=out_pad, bias=bias)
-        self.clustering = ClusterlingLayer(num_clusters, num_clusters)
-        # ReLU copies for graph representation in tensorboard
-        self.relu1_1 = copy.deepcopy(self.relu)
-        self.relu2_1 = copy.deepcopy(self.relu)
-        self.relu3_1 = copy.deepcopy(self.relu)
-        self.relu1_2 = copy.deepcopy(self.relu)
-        self.relu2_2 = copy.deepcopy(self.relu)
-        self.relu3_2 = copy.deepcopy(self.relu)
-        self.sig = nn.Sigmoid()
-        self.tanh = nn.Tanh()
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, weight, log_q = ctx.saved_tensors
+        alpha, chunk_size = ctx.alpha, ctx.chunk_size
+        # Gradient through log-softmax
+        grad_kernel = grad_output - torch.exp(log_q) * torch.sum(grad_output, dim=1, keepdim=True)
+        grad_x = torch.zeros_like(x)
+        grad_weight = torch.zeros_like(weight)
+        x_sq = torch.sum(x * x, dim=1, keepdim=True)
+        for start in range(0, weight.size(0), chunk_size):
+            w = weight[start:start + chunk_size]
+            dist = torch.addmm(x_sq + torch.sum(w * w, dim=1), x, w.t(), alpha=-2).clamp_(min=0)
+            # Gradient w.r.t. squared distances, then d(dist)/dx = 2(x - mu), d(dist)/dmu = 2(mu - x)
+            grad_dist = grad_kernel[:, start:start + chunk_size] * (-(alpha + 1.0) / 2.0) / (alpha + dist)
+            grad_x += 2 * (x * torch.sum(grad_dist, dim=1, keepdim=True) - grad_dist.mm(w))
+            grad_weight[start:start + chunk_size] = 2 * (w * torch.sum(grad_dist, dim=0).unsqueeze(1) -
+                                                         grad_dist.t().mm(x))
+        return grad_x, grad_weight, None, None
+
+
+# Encoder with clustering layer of a CAE - returns (soft assignments q, embedding)
+# Decoder is not run (used for inference passes and exported models)
+class ClusteringEncoder(nn.Module):
+    def __init__(self, model):
+        super(ClusteringEncoder, self).__init__()
+        self.model = model
 
     def forward(self, x):
-        x = self.conv1(x)
-        x = self.relu1_1(x)
-        x = self.bn1_1(x)
-        x = self.conv2(x)
-        x = self.relu2_1(x)
-        x = self.bn2_1(x)
-        x = self.conv3(x)
-        if self.activations:
-            x = self.sig(x)
-        else:
-            x = self.relu3_1(x)
-        x = x.view(x.size(0), -1)
-        x = self.embedding(x)
-        extra_out = x
-        clustering_out = self.clustering(x)
-        x = self.deembedding(x)
-        x = self.relu1_2(x)
-        x = x.view(x.size(0), self.filters[2], ((self.input_shape[0]//2//2-1) // 2), ((self.input_shape[0]//2//2-1) // 2))
-        x = self.deconv3(x)
-        x = self.relu2_2(x)
-        x = self.bn3_2(x)
-        x = self.deconv2(x)
-        x = self.relu3_2(x)
-        x = self.bn2_2(x)
-        x = self.deconv1(x)
-        if self.activations:
-            x = self.tanh(x)
-        return x, clustering_out, extra_out
+        extra_out = self.model.encode(x)
+        return self.model.clustering(extra_out, log=False), extra_out
 
 
-# Convolutional autoencoder with 4 convolutional blocks
-class CAE_4(nn.Module):
-    def __init__(self, input_shape=[128,128,3], num_clusters=10, filters=[32, 64, 128, 256], leaky=True, neg_slope=0.01, activations=False, bias=True):
-        super(CAE_4, self).__init__()
+# Convolutional autoencoder built from a list of filters (one convolutional block per filter)
+# Encoder: conv - ReLU - BN (optional) blocks with 5x5 kernels, the last block 3x3 without padding, then embedding
+# Decoder mirrors the encoder with transposed convolutions
+# Layer names (conv{i}, bn{i}_1, deconv{i}, bn{i}_2, ...) and their order match weights of the original classes
+class CAE(nn.Module):
+    def __init__(self, input_shape=[128,128,3], num_clusters=10, filters=[32, 64, 128], leaky=True, neg_slope=0.01, activations=False, bias=True, bn=False):
+        super(CAE, self).__init__()
         self.activations = activations
         self.pretrained = False
         self.num_clusters = num_clusters
         self.input_shape = input_shape
         self.filters = filters
+        self.depth = len(filters)
+        self.bn = bn
         if leaky:
             self.relu = nn.LeakyReLU(negative_slope=neg_slope)
         else:
             self.relu = nn.ReLU(inplace=False)
 
-        self.conv1 = nn.Conv2d(input_shape[2], filters[0], 5, stride=2, padding=2, bias=bias)
-        self.conv2 = nn.Conv2d(filters[0], filters[1], 5, stride=2, padding=2, bias=bias)
-        self.conv3 = nn.Conv2d(filters[1], filters[2], 5, stride=2, padding=2, bias=bias)
-        self.conv4 = nn.Conv2d(filters[2], filters[3], 3, stride=2, padding=0, bias=bias)
+        channels = [input_shape[2]] + list(filters)
+        for i in range(1, self.depth + 1):
+            if i < self.depth:
+                setattr(self, 'conv%d' % i, nn.Conv2d(channels[i - 1], channels[i], 5, stride=2, padding=2, bias=bias))
+                if bn:
+                    setattr(self, 'bn%d_1' % i, nn.BatchNorm2d(channels[i]))
+            else:
+                setattr(self, 'conv%d' % i, nn.Conv2d(channels[i - 1], channels[i], 3, stride=2, padding=0, bias=bias))
 
-        lin_features_len = ((input_shape[0] // 2 // 2 // 2 - 1) // 2) * ((input_shape[0] // 2 // 2 // 2 - 1) // 2) * \
-                           filters[3]
+        # Spatial size of the last feature map
+        self.lin_size = (input_shape[0] // 2 ** (self.depth - 1) - 1) // 2
+        lin_features_len = self.lin_size * self.lin_size * filters[-1]
         self.embedding = nn.Linear(lin_features_len, num_clusters, bias=bias)
         self.deembedding = nn.Linear(num_clusters, lin_features_len, bias=bias)
-        out_pad = 1 if input_shape[0] // 2 // 2 // 2 % 2 == 0 else 0
-        self.deconv4 = nn.ConvTranspose2d(filters[3], filters[2], 3, stride=2, padding=0, output_padding=out_pad,
-                                          bias=bias)
-        out_pad = 1 if input_shape[0] // 2 // 2 % 2 == 0 else 0
-        self.deconv3 = nn.ConvTranspose2d(filters[2], filters[1], 5, stride=2, padding=2, output_padding=out_pad,
-                                          bias=bias)
-        out_pad = 1 if input_shape[0] // 2 % 2 == 0 else 0
-        self.deconv2 = nn.ConvTranspose2d(filters[1], filters[0], 5, stride=2, padding=2, output_padding=out_pad,
-                                          bias=bias)
-        out_pad = 1 if input_shape[0] % 2 == 0 else 0
-        self.deconv1 = nn.ConvTranspose2d(filters[0], input_shape[2], 5, stride=2, padding=2, output_padding=out_pad,
-                                          bias=bias)
+
+        for i in range(self.depth, 0, -1):
+            out_pad = 1 if input_shape[0] // 2 ** (i - 1) % 2 == 0 else 0
+            if i == self.depth:
+                deconv = nn.ConvTranspose2d(channels[i], channels[i - 1], 3, stride=2, padding=0, output_padding=out_pad, bias=bias)
+            else:
+                deconv = nn.ConvTranspose2d(channels[i], channels[i - 1], 5, stride=2, padding=2, output_padding=out_pad, bias=bias)
+            setattr(self, 'deconv%d' % i, deconv)
+            if bn and i > 1:
+                setattr(self, 'bn%d_2' % i, nn.BatchNorm2d(channels[i - 1]))
+
         self.clustering = ClusterlingLayer(num_clusters, num_clusters)
         # ReLU copies for graph representation in tensorboard
-        self.relu1_1 = copy.deepcopy(self.relu)
-        self.relu2_1 = copy.deepcopy(self.relu)
-        self.relu3_1 = copy.deepcopy(self.relu)
-        self.relu4_1 = copy.deepcopy(self.relu)
-        self.relu1_2 = copy.deepcopy(self.relu)
-        self.relu2_2 = copy.deepcopy(self.relu)
-        self.relu3_2 = copy.deepcopy(self.relu)
-        self.relu4_2 = copy.deepcopy(self.relu)
+        for i in range(1, self.depth + 1):
+            setattr(self, 'relu%d_1' % i, copy.deepcopy(self.relu))
+        for i in range(1, self.depth + 1):
+            setattr(self, 'relu%d_2' % i, copy.deepcopy(self.relu))
         self.sig = nn.Sigmoid()
         self.tanh = nn.Tanh()
 
-    def forward(self, x):
-        x = self.conv1(x)
-        x = self.relu1_1(x)
-        x = self.conv2(x)
-        x = self.relu2_1(x)
-        x = self.conv3(x)
-        x = self.relu3_1(x)
-        x = self.conv4(x)
+    # Encoder - latent space representation (embedding) of images
+    def encode(self, x):
+        for i in range(1, self.depth):
+            x = getattr(self, 'conv%d' % i)(x)
+            x = getattr(self, 'relu%d_1' % i)(x)
+            if self.bn:
+                x = getattr(self, 'bn%d_1' % i)(x)
+        x = getattr(self, 'conv%d' % self.depth)(x)
         if self.activations:
             x = self.sig(x)
         else:
-            x = self.relu4_1(x)
+            x = getattr(self, 'relu%d_1' % self.depth)(x)
         x = x.view(x.size(0), -1)
         x = self.embedding(x)
+        return x
+
+    def forward(self, x):
+        x = self.encode(x)
         extra_out = x
         clustering_out = self.clustering(x)
         x = self.deembedding(x)
-        x = self.relu4_2(x)
-        x = x.view(x.size(0), self.filters[3], ((self.input_shape[0]//2//2//2-1) // 2), ((self.input_shape[0]//2//2//2-1) // 2))
-        x = self.deconv4(x)
-        x = self.relu3_2(x)
-        x = self.deconv3(x)
-        x = self.relu2_2(x)
-        x = self.deconv2(x)
-        x = self.relu1_2(x)
+        x = getattr(self, 'relu%d_2' % self.depth)(x)
+        x = x.view(x.size(0), self.filters[-1], self.lin_size, self.lin_size)
+        for i in range(self.depth, 1, -1):
+            x = getattr(self, 'deconv%d' % i)(x)
+            x = getattr(self, 'relu%d_2' % (i - 1))(x)
+            if self.bn:
+                x = getattr(self, 'bn%d_2' % i)(x)
         x = self.deconv1(x)
         if self.activations:
             x = self.tanh(x)
         return x, clustering_out, extra_out
 
-# Convolutional autoencoder with 4 convolutional blocks (BN version)
-class CAE_bn4(nn.Module):
-    def __init__(self, input_shape=[128,128,3], num_clusters=10, filters=[32, 64, 128, 256], leaky=True, neg_slope=0.01, activations=False, bias=True):
-        super(CAE_bn4, self).__init__()
-        self.activations = activations
-        self.pretrained = False
-        self.num_clusters = num_clusters
-        self.input_shape = input_shape
-        self.filters = filters
-        if leaky:
-            self.relu = nn.LeakyReLU(negative_slope=neg_slope)
-        else:
-            self.relu = nn.ReLU(inplace=False)
 
-        self.conv1 = nn.Conv2d(input_shape[2], filters[0], 5, stride=2, padding=2, bias=bias)
-        self.bn1_1 = nn.BatchNorm2d(filters[0])
-        self.conv2 = nn.Conv2d(filters[0], filters[1], 5, stride=2, padding=2, bias=bias)
-        self.bn2_1 = nn.BatchNorm2d(filters[1])
-        self.conv3 = nn.Conv2d(filters[1], filters[2], 5, stride=2, padding=2, bias=bias)
-        self.bn3_1 = nn.BatchNorm2d(filters[2])
-        self.conv4 = nn.Conv2d(filters[2], filters[3], 3, stride=2, padding=0, bias=bias)
+# Convolutional autoencoder directly from DCEC article
+class CAE_3(CAE):
+    def __init__(self, input_shape=[128,128,3], num_clusters=10, filters=[32, 64, 128], leaky=True, neg_slope=0.01, activations=False, bias=True):
+        super(CAE_3, self).__init__(input_shape, num_clusters, filters, leaky, neg_slope, activations, bias, bn=False)
 
-        lin_features_len = ((input_shape[0] // 2 // 2 // 2 - 1) // 2) * ((input_shape[0] // 2 // 2 // 2 - 1) // 2) * \
-                           filters[3]
-        self.embedding = nn.Linear(lin_features_len, num_clusters, bias=bias)
-        self.deembedding = nn.Linear(num_clusters, lin_features_len, bias=bias)
-        out_pad = 1 if input_shape[0] // 2 // 2 // 2 % 2 == 0 else 0
-        self.deconv4 = nn.ConvTranspose2d(filters[3], filters[2], 3, stride=2, padding=0, output_padding=out_pad,
-                                          bias=bias)
-        self.bn4_2 = nn.BatchNorm2d(filters[2])
-        out_pad = 1 if input_shape[0] // 2 // 2 % 2 == 0 else 0
-        self.deconv3 = nn.ConvTranspose2d(filters[2], filters[1], 5, stride=2, padding=2, output_padding=out_pad,
-                                          bias=bias)
-        self.bn3_2 = nn.BatchNorm2d(filters[1])
-        out_pad = 1 if input_shape[0] // 2 % 2 == 0 else 0
-        self.deconv2 = nn.ConvTranspose2d(filters[1], filters[0], 5, stride=2, padding=2, output_padding=out_pad,
-                                          bias=bias)
-        self.bn2_2 = nn.BatchNorm2d(filters[0])
-        out_pad = 1 if input_shape[0] % 2 == 0 else 0
-        self.deconv1 = nn.ConvTranspose2d(filters[0], input_shape[2], 5, stride=2, padding=2, output_padding=out_pad,
-                                          bias=bias)
-        self.clustering = ClusterlingLayer(num_clusters, num_clusters)
-        # ReLU copies for graph representation in tensorboard
-        self.relu1_1 = copy.deepcopy(self.relu)
-        self.relu2_1 = copy.deepcopy(self.relu)
-        self.relu3_1 = copy.deepcopy(self.relu)
-        self.relu4_1 = copy.deepcopy(self.relu)
-        self.relu1_2 = copy.deepcopy(self.relu)
-        self.relu2_2 = copy.deepcopy(self.relu)
-        self.relu3_2 = copy.deepcopy(self.relu)
-        self.relu4_2 = copy.deepcopy(self.relu)
-        self.sig = nn.Sigmoid()
-        self.tanh = nn.Tanh()
 
-    def forward(self, x):
-        x = self.conv1(x)
-        x = self.relu1_1(x)
-        x = self.bn1_1(x)
-        x = self.conv2(x)
-        x = self.relu2_1(x)
-        x = self.bn2_1(x)
-        x = self.conv3(x)
-        x = self.relu3_1(x)
-        x = self.bn3_1(x)
-        x = self.conv4(x)
-        if self.activations:
-            x = self.sig(x)
-        else:
-            x = self.relu4_1(x)
-        x = x.view(x.size(0), -1)
-        x = self.embedding(x)
-        extra_out = x
-        clustering_out = self.clustering(x)
-        x = self.deembedding(x)
-        x = self.relu4_2(x)
-        x = x.view(x.size(0), self.filters[3], ((self.input_shape[0]//2//2//2-1) // 2), ((self.input_shape[0]//2//2//2-1) // 2))
-        x = self.deconv4(x)
-        x = self.relu3_2(x)
-        x = self.bn4_2(x)
-        x = self.deconv3(x)
-        x = self.relu2_2(x)
-        x = self.bn3_2(x)
-        x = self.deconv2(x)
-        x = self.relu1_2(x)
-        x = self.bn2_2(x)
-        x = self.deconv1(x)
-        if self.activations:
-            x = self.tanh(x)
-        return x, clustering_out, extra_out
+# Convolutional autoencoder from DCEC article with Batch Norms and Leaky ReLUs
+class CAE_bn3(CAE):
+    def __init__(self, input_shape=[128,128,3], num_clusters=10, filters=[32, 64, 128], leaky=True, neg_slope=0.01, activations=False, bias=True):
+        super(CAE_bn3, self).__init__(input_shape, num_clusters, filters, leaky, neg_slope, activations, bias, bn=True)
 
 
-# Convolutional autoencoder with 5 convolutional blocks
-class CAE_5(nn.Module):
-    def __init__(self, input_shape=[128,128,3], num_clusters=10, filters=[32, 64, 128, 256, 512], leaky=True, neg_slope=0.01, activations=False, bias=True):
-        super(CAE_5, self).__init__()
-        self.activations = activations
-        self.pretrained = False
-        self.num_clusters = num_clusters
-        self.input_shape = input_shape
-        self.filters = filters
-        self.relu = nn.ReLU(inplace=False)
-        if leaky:
-            self.relu = nn.LeakyReLU(negative_slope=neg_slope)
-        else:
-            self.relu = nn.ReLU(inplace=False)
+# Convolutional autoencoder with 4 convolutional blocks
+class CAE_4(CAE):
+    def __init__(self, input_shape=[128,128,3], num_clusters=10, filters=[32, 64, 128, 256], leaky=True, neg_slope=0.01, activations=False, bias=True):
+        super(CAE_4, self).__init__(input_shape, num_clusters, filters, leaky, neg_slope, activations, bias, bn=False)
 
-        self.conv1 = nn.Conv2d(input_shape[2], filters[0], 5, stride=2, padding=2, bias=bias)
-        self.conv2 = nn.Conv2d(filters[0], filters[1], 5, stride=2, padding=2, bias=bias)
-        self.conv3 = nn.Conv2d(filters[1], filters[2], 5, stride=2, padding=2, bias=bias)
-        self.conv4 = nn.Conv2d(filters[2], filters[3], 5, stride=2, padding=2, bias=bias)
-        self.conv5 = nn.Conv2d(filters[3], filters[4], 3, stride=2, padding=0, bias=bias)
 
-        lin_features_len = ((input_shape[0] // 2 // 2 // 2 // 2 - 1) // 2) * (
-                    (input_shape[0] // 2 // 2 // 2 // 2 - 1) // 2) * filters[4]
-        self.embedding = nn.Linear(lin_features_len, num_clusters, bias=bias)
-        self.deembedding = nn.Linear(num_clusters, lin_features_len, bias=bias)
-        out_pad = 1 if input_shape[0] // 2 // 2 // 2 // 2 % 2 == 0 else 0
-        self.deconv5 = nn.ConvTranspose2d(filters[4], filters[3], 3, stride=2, padding=0, output_padding=out_pad,
-                                          bias=bias)
-        out_pad = 1 if input_shape[0] // 2 // 2 // 2 % 2 == 0 else 0
-        self.deconv4 = nn.ConvTranspose2d(filters[3], filters[2], 5, stride=2, padding=2, output_padding=out_pad,
-                                          bias=bias)
-        out_pad = 1 if input_shape[0] // 2 // 2 % 2 == 0 else 0
-        self.deconv3 = nn.ConvTranspose2d(filters[2], filters[1], 5, stride=2, padding=2, output_padding=out_pad,
-                                          bias=bias)
-        out_pad = 1 if input_shape[0] // 2 % 2 == 0 else 0
-        self.deconv2 = nn.ConvTranspose2d(filters[1], filters[0], 5, stride=2, padding=2, output_padding=out_pad,
-                                          bias=bias)
-        out_pad = 1 if input_shape[0] % 2 == 0 else 0
-        self.deconv1 = nn.ConvTranspose2d(filters[0], input_shape[2], 5, stride=2, padding=2, output_padding=out_pad,
-                                          bias=bias)
-        self.clustering = ClusterlingLayer(num_clusters, num_clusters)
-        # ReLU copies for graph representation in tensorboard
-        self.relu1_1 = copy.deepcopy(self.relu)
-        self.relu2_1 = copy.deepcopy(self.relu)
-        self.relu3_1 = copy.deepcopy(self.relu)
-        self.relu4_1 = copy.deepcopy(self.relu)
-        self.relu5_1 = copy.deepcopy(self.relu)
-        self.relu1_2 = copy.deepcopy(self.relu)
-        self.relu2_2 = copy.deepcopy(self.relu)
-        self.relu3_2 = copy.deepcopy(self.relu)
-        self.relu4_2 = copy.deepcopy(self.relu)
-        self.relu5_2 = copy.deepcopy(self.relu)
-        self.sig = nn.Sigmoid()
-        self.tanh = nn.Tanh()
+# Convolutional autoencoder with 4 convolutional blocks (BN version)
+class CAE_bn4(CAE):
+    def __init__(self, input_shape=[128,128,3], num_clusters=10, filters=[32, 64, 128, 256], leaky=True, neg_slope=0.01, activations=False, bias=True):
+        super(CAE_bn4, self).__init__(input_shape, num_clusters, filters, leaky, neg_slope, activations, bias, bn=True)
 
-    def forward(self, x):
-        x = self.conv1(x)
-        x = self.relu1_1(x)
-        x = self.conv2(x)
-        x = self.relu2_1(x)
-        x = self.conv3(x)
-        x = self.relu3_1(x)
-        x = self.conv4(x)
-        x = self.relu4_1(x)
-        x = self.conv5(x)
-        if self.activations:
-            x = self.sig(x)
-        else:
-            x = self.relu5_1(x)
-        x = x.view(x.size(0), -1)
-        x = self.embedding(x)
-        extra_out = x
-        clustering_out = self.clustering(x)
-        x = self.deembedding(x)
-        x = self.relu4_2(x)
-        x = x.view(x.size(0), self.filters[4], ((self.input_shape[0]//2//2//2//2-1) // 2), ((self.input_shape[0]//2//2//2//2-1) // 2))
-        x = self.deconv5(x)
-        x = self.relu4_2(x)
-        x = self.deconv4(x)
-        x = self.relu3_2(x)
-        x = self.deconv3(x)
-        x = self.relu2_2(x)
-        x = self.deconv2(x)
-        x = self.relu1_2(x)
-        x = self.deconv1(x)
-        if self.activations:
-            x = self.tanh(x)
-        return x, clustering_out, extra_out
+
+# Convolutional autoencoder with 5 convolutional blocks
+class CAE_5(CAE):
+    def __init__(self, input_shape=[128,128,3], num_clusters=10, filters=[32, 64, 128, 256, 512], leaky=True, neg_slope=0.01, activations=False, bias=True):
+        super(CAE_5, self).__init__(input_shape, num_clusters, filters, leaky, neg_slope, activations, bias, bn=False)
 
 
 # Convolutional autoencoder with 5 convolutional blocks (BN version)
-class CAE_bn5(nn.Module):
+class CAE_bn5(CAE):
     def __init__(self, input_shape=[128,128,3], num_clusters=10, filters=[32, 64, 128, 256, 512], leaky=True, neg_slope=0.01, activations=False, bias=True):
-        super(CAE_bn5, self).__init__()
-        self.activations = activations
-        self.pretrained = False
-        self.num_clusters = num_clusters
-        self.input_shape = input_shape
-        self.filters = filters
-        self.relu = nn.ReLU(inplace=False)
-        if leaky:
-            self.relu = nn.LeakyReLU(negative_slope=neg_slope)
-        else:
-            self.relu = nn.ReLU(inplace=False)
+        super(CAE_bn5, self).__init__(input_shape, num_clusters, filters, leaky, neg_slope, activations, bias, bn=True)
 
-        self.conv1 = nn.Conv2d(input_shape[2], filters[0], 5, stride=2, padding=2, bias=bias)
-        self.bn1_1 = nn.BatchNorm2d(filters[0])
-        self.conv2 = nn.Conv2d(filters[0], filters[1], 5, stride=2, padding=2, bias=bias)
-        self.bn2_1 = nn.BatchNorm2d(filters[1])
-        self.conv3 = nn.Conv2d(filters[1], filters[2], 5, stride=2, padding=2, bias=bias)
-        self.bn3_1 = nn.BatchNorm2d(filters[2])
-        self.conv4 = nn.Conv2d(filters[2], filters[3], 5, stride=2, padding=2, bias=bias)
-        self.bn4_1 = nn.BatchNorm2d(filters[3])
-        self.conv5 = nn.Conv2d(filters[3], filters[4], 3, stride=2, padding=0, bias=bias)
-
-        lin_features_len = ((input_shape[0] // 2 // 2 // 2 // 2 - 1) // 2) * (
-                    (input_shape[0] // 2 // 2 // 2 // 2 - 1) // 2) * filters[4]
-        self.embedding = nn.Linear(lin_features_len, num_clusters, bias=bias)
-        self.deembedding = nn.Linear(num_clusters, lin_features_len, bias=bias)
-        out_pad = 1 if input_shape[0] // 2 // 2 // 2 // 2 % 2 == 0 else 0
-        self.deconv5 = nn.ConvTranspose2d(filters[4], filters[3], 3, stride=2, padding=0, output_padding=out_pad,
-                                          bias=bias)
-        self.bn5_2 = nn.BatchNorm2d(filters[3])
-        out_pad = 1 if input_shape[0] // 2 // 2 // 2 % 2 == 0 else 0
-        self.deconv4 = nn.ConvTranspose2d(filters[3], filters[2], 5, stride=2, padding=2, output_padding=out_pad,
-                                          bias=bias)
-        self.bn4_2 = nn.BatchNorm2d(filters[2])
-        out_pad = 1 if input_shape[0] // 2 // 2 % 2 == 0 else 0
-        self.deconv3 = nn.ConvTranspose2d(filters[2], filters[1], 5, stride=2, padding=2, output_padding=out_pad,
-                                          bias=bias)
-        self.bn3_2 = nn.BatchNorm2d(filters[1])
-        out_pad = 1 if input_shape[0] // 2 % 2 == 0 else 0
-        self.deconv2 = nn.ConvTranspose2d(filters[1], filters[0], 5, stride=2, padding=2, output_padding=out_pad,
-                                          bias=bias)
-        self.bn2_2 = nn.BatchNorm2d(filters[0])
-        out_pad = 1 if input_shape[0] % 2 == 0 else 0
-        self.deconv1 = nn.ConvTranspose2d(filters[0], input_shape[2], 5, stride=2, padding=2, output_padding=out_pad,
-                                          bias=bias)
-        self.clustering = ClusterlingLayer(num_clusters, num_clusters)
-        # ReLU copies for graph representation in tensorboard
-        self.relu1_1 = copy.deepcopy(self.relu)
-        self.relu2_1 = copy.deepcopy(self.relu)
-        self.relu3_1 = copy.deepcopy(self.relu)
-        self.relu4_1 = copy.deepcopy(self.relu)
-        self.relu5_1 = copy.deepcopy(self.relu)
-        self.relu1_2 = copy.deepcopy(self.relu)
-        self.relu2_2 = copy.deepcopy(self.relu)
-        self.relu3_2 = copy.deepcopy(self.relu)
-        self.relu4_2 = copy.deepcopy(self.relu)
-        self.relu5_2 = copy.deepcopy(self.relu)
-        self.sig = nn.Sigmoid()
-        self.tanh = nn.Tanh()
 
-    def forward(self, x):
-        x = self.conv1(x)
-        x = self.relu1_1(x)
-        x = self.bn1_1(x)
-        x = self.conv2(x)
-        x = self.relu2_1(x)
-        x = self.bn2_1(x)
-        x = self.conv3(x)
-        x = self.relu3_1(x)
-        x = self.bn3_1(x)
-        x = self.conv4(x)
-        x = self.relu4_1(x)
-        x = self.bn4_1(x)
-        x = self.conv5(x)
+# Inference version of a trained CAE (eval mode semantics, weights are frozen at construction)
+# - Batch Norms (placed after activations) are folded into the following convolution: conv(a * x + b) equals
+#   conv with input channels scaled by a plus a precomputed bias map conv(b), exact also at padded borders
+# - channels_last memory format, one in-place activation instead of per-layer copies
+class FoldedCAE(nn.Module):
+    def __init__(self, model):
+        super(FoldedCAE, self).__init__()
+        self.activations = model.activations
+        self.num_clusters = model.num_clusters
+        self.input_shape = model.input_shape
+        self.filters = model.filters
+        self.depth = model.depth
+        self.lin_size = model.lin_size
+        self.relu = copy.deepcopy(model.relu)
+        self.relu.inplace = True
+        self.clustering = copy.deepcopy(model.clustering)
+
+        # Input sizes of convolutions are needed for bias maps
+        sizes = {}
+        hooks = [getattr(model, name).register_forward_hook(
+            lambda module, inputs, output, name=name: sizes.__setitem__(name, inputs[0].shape[1:]))
+            for name in self._layers()]
+        was_training = model.training
+        model.eval()
+        with torch.no_grad():
+            model(torch.zeros([1, self.input_shape[2], self.input_shape[0], self.input_shape[1]],
+                              device=model.embedding.weight.device))
+        model.train(was_training)
+        for hook in hooks:
+            hook.remove()
+
+        with torch.no_grad():
+            for name in self._layers():
+                layer = copy.deepcopy(getattr(model, name))
+                bias_map = None
+                # Batch Norm preceding the layer (after activation of the previous block)
+                i = int(name[len('deconv'):] if name.startswith('deconv') else name[len('conv'):])
+                bn_name = 'bn%d_1' % (i - 1) if name.startswith('conv') else 'bn%d_2' % (i + 1)
+                if model.bn and hasattr(model, bn_name):
+                    bn = getattr(model, bn_name)
+                    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+                    shift = bn.bias - bn.running_mean * scale
+                    shift_map = shift.view(1, -1, 1, 1).expand((1,) + tuple(sizes[name]))
+                    bias_map = layer(shift_map)
+                    if name.startswith('conv'):
+                        layer.weight.mul_(scale.view(1, -1, 1, 1))
+                    else:
+                        layer.weight.mul_(scale.view(-1, 1, 1, 1))
+                    layer.bias = None
+                    bias_map = bias_map.contiguous(memory_format=torch.channels_last)
+                setattr(self, name, layer.to(memory_format=torch.channels_last))
+                self.register_buffer(name + '_bias', bias_map)
+
+            # Linear layers reordered for flattening of channels_last (H, W, C) feature maps
+            self.embedding = copy.deepcopy(model.embedding)
+            self.deembedding = copy.deepcopy(model.deembedding)
+            c, n = self.filters[-1], self.lin_size
+            self.embedding.weight.copy_(self.embedding.weight.view(-1, c, n, n).permute(0, 2, 3, 1).reshape(-1, c * n * n))
+            self.deembedding.weight.copy_(self.deembedding.weight.view(c, n, n, -1).permute(1, 2, 0, 3).reshape(c * n * n, -1))
+            if self.deembedding.bias is not None:
+                self.deembedding.bias.copy_(self.deembedding.bias.view(c, n, n).permute(1, 2, 0).reshape(-1))
+        self.eval()
+
+    def _layers(self):
+        return ['conv%d' % i for i in range(1, self.depth + 1)] + ['deconv%d' % i for i in range(self.depth, 0, -1)]
+
+    def _layer(self, name, x):
+        x = getattr(self, name)(x)
+        bias_map = getattr(self, name + '_bias')
+        if bias_map is not None:
+            x = x + bias_map
+        return x
+
+    def encode(self, x):
+        x = x.contiguous(memory_format=torch.channels_last)
+        for i in range(1, self.depth):
+            x = self.relu(self._layer('conv%d' % i, x))
+        x = self._layer('conv%d' % self.depth, x)
         if self.activations:
-            x = self.sig(x)
+            x = torch.sigmoid(x)
         else:
-            x = self.relu5_1(x)
-        x = x.view(x.size(0), -1)
-        x = self.embedding(x)
+            x = self.relu(x)
+        # channels_last tensor permuted to (N, H, W, C) is contiguous - flattened without copy
+        x = x.permute(0, 2, 3, 1).reshape(x.size(0), -1)
+        return self.embedding(x)
+
+    def forward(self, x):
+        x = self.encode(x)
         extra_out = x
         clustering_out = self.clustering(x)
-        x = self.deembedding(x)
-        x = self.relu5_2(x)
-        x = x.view(x.size(0), self.filters[4], ((self.input_shape[0]//2//2//2//2-1) // 2), ((self.input_shape[0]//2//2//2//2-1) // 2))
-        x = self.deconv5(x)
-        x = self.relu4_2(x)
-        x = self.bn5_2(x)
-        x = self.deconv4(x)
-        x = self.relu3_2(x)
-        x = self.bn4_2(x)
-        x = self.deconv3(x)
-        x = self.relu2_2(x)
-        x = self.bn3_2(x)
-        x = self.deconv2(x)
-        x = self.relu1_2(x)
-        x = self.bn2_2(x)
-        x = self.deconv1(x)
+        x = self.relu(self.deembedding(x))
+        x = x.view(x.size(0), self.lin_size, self.lin_size, self.filters[-1]).permute(0, 3, 1, 2)
+        for i in range(self.depth, 1, -1):
+            x = self.relu(self._layer('deconv%d' % i, x))
+        x = self._layer('deconv1', x)
         if self.activations:
-            x = self.tanh(x)
+            x = torch.tanh(x)
         return x, clustering_out, extra_out
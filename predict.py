@@ -0,0 +1,173 @@
+from __future__ import print_function
+import torch.utils.data as data
+from torchvision import transforms
+from torchvision.datasets import folder
+import os
+import json
+import time
+import numpy as np
+import torch
+import utils
+import nets
+import training_functions
+import centroid_index
+
+
+class ImageFiles(data.Dataset):
+    """Images found recursively in a directory (any structure), decoded on the fly.
+
+    Used for predictions on new data - nothing is cached on disk. Paths are kept in
+    a single numpy bytes array, so worker processes do not copy millions of Python
+    strings. Items are ``(image, index)``, the path of an index is ``path(index)``.
+
+    Args:
+        root (string): Directory with images.
+        img_size (list): Size of images [height, width, depth].
+        mean (sequence, optional): Means for normalisation of each channel.
+        std (sequence, optional): Standard deviations for normalisation of each channel.
+    """
+
+    def __init__(self, root, img_size, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        self.root = os.path.expanduser(root)
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(self.root, followlinks=True):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.lower().endswith(folder.IMG_EXTENSIONS):
+                    paths.append(os.path.relpath(os.path.join(dirpath, filename), self.root).encode())
+        self.paths = np.array(paths, dtype=bytes)
+        self.transform = transforms.Compose([
+            transforms.Resize(img_size[0:2]),
+            transforms.ToTensor(),
+            transforms.Normalize(mean, std)
+        ])
+
+    def path(self, index):
+        return np.char.decode(self.paths[index], 'utf-8')
+
+    def __getitem__(self, index):
+        img = folder.default_loader(os.path.join(self.root, self.paths[index].decode()))
+        return self.transform(img), index
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __repr__(self):
+        fmt_str = 'Dataset ' + self.__class__.__name__ + '\n'
+        fmt_str += '    Number of datapoints: {}\n'.format(self.__len__())
+        fmt_str += '    Root Location: {}'.format(self.root)
+        return fmt_str
+
+
+# Columnar output written in chunks of fixed number of rows (part_XXXXX.npz, one array per column)
+# Rows are buffered in arrays allocated once - memory does not depend on the number of images
+# extra(columns) returns additional columns computed once per chunk
+class ChunkWriter:
+    def __init__(self, directory, chunk_size, extra=None):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.extra = extra
+        self.buffers = None
+        self.pos = 0
+        self.chunks = []
+        self.rows = 0
+        os.makedirs(directory, exist_ok=True)
+        # Chunks of a previous run are not mixed with new ones
+        for name in os.listdir(directory):
+            if name.startswith('part_') and name.endswith('.npz'):
+                os.remove(os.path.join(directory, name))
+
+    def write(self, columns):
+        if self.buffers is None:
+            self.buffers = {k: np.empty((self.chunk_size,) + v.shape[1:], dtype=v.dtype) for k, v in columns.items()}
+        n = len(next(iter(columns.values())))
+        start = 0
+        while start < n:
+            m = min(n - start, self.chunk_size - self.pos)
+            for k, v in columns.items():
+                self.buffers[k][self.pos:self.pos + m] = v[start:start + m]
+            self.pos += m
+            start += m
+            if self.pos == self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        if self.pos == 0:
+            return
+        columns = {k: v[:self.pos] for k, v in self.buffers.items()}
+        if self.extra is not None:
+            columns.update(self.extra(columns))
+        name = 'part_{:05d}.npz'.format(len(self.chunks))
+        # Replaced atomically, readers never see partial chunks
+        tmp = os.path.join(self.directory, name + '.tmp')
+        with open(tmp, 'wb') as f:
+            np.savez(f, **columns)
+        os.replace(tmp, os.path.join(self.directory, name))
+        self.chunks.append(name)
+        self.rows += self.pos
+        self.pos = 0
+
+
+# Cluster assignments of all images in dataloader - writes index, cluster id, max q, embedding
+# (and path of image file or label) per image, only the encoder and clustering layer are run
+# With params['nprobe'] set clusters are found with approximate centroid index instead of clustering layer
+def predict(model, dataloader, params):
+    txt_file = params['txt_file']
+    print_freq = params['print_freq']
+    output_dir = params['predict_dir']
+    dataset = dataloader.dataset
+    files = isinstance(dataset, ImageFiles)
+
+    # Batch Norms folded into convolutions, channels_last
+    model = nets.FoldedCAE(model)
+
+    nprobe = params.get('nprobe')
+    index = None
+    if nprobe is not None:
+        index = centroid_index.CentroidIndex(model.clustering.weight, alpha=model.clustering.alpha)
+        utils.print_both(txt_file, 'Centroid index:\tCells: {0}\tProbed: {1}'.format(index.num_cells, nprobe))
+
+    # Paths of images resolved once per chunk
+    if files:
+        paths = lambda columns: {'path': dataset.path(columns['index'])}
+    else:
+        paths = None
+    writer = ChunkWriter(output_dir, params.get('chunk_size', 65536), extra=paths)
+
+    utils.print_both(txt_file, '\nPredictions for {} images'.format(len(dataset)))
+    since = time.time()
+    pos = 0
+    batch_num = 1
+    for clusters, extra_out, labels in training_functions.inference_batches(model, dataloader, params,
+                                                                            clustering=index is None):
+        n = extra_out.size(0)
+        if index is None:
+            q_max, cluster = torch.max(clusters, dim=1)
+        else:
+            cluster, q_max = index.search(extra_out, k=1, nprobe=nprobe)
+            cluster, q_max = cluster[:, 0], q_max[:, 0]
+        columns = {'cluster': cluster.to(torch.int32).cpu().numpy(), 'q_max': q_max.cpu().numpy(),
+                   'embedding': extra_out.cpu().numpy()}
+        if files:
+            columns['index'] = np.asarray(labels, dtype=np.int64)
+        else:
+            columns['index'] = np.arange(pos, pos + n, dtype=np.int64)
+            columns['label'] = np.asarray(labels, dtype=np.int64)
+        writer.write(columns)
+        pos += n
+
+        if batch_num % print_freq == 0:
+            elapsed = time.time() - since
+            utils.print_both(txt_file, 'Predictions: [{0}/{1}]\tImages/s: {2:.1f}'.format(pos, len(dataset),
+                                                                                        pos / elapsed))
+        batch_num += 1
+    writer.flush()
+
+    elapsed = time.time() - since
+    utils.print_both(txt_file, 'Predictions complete in {0:.0f}m {1:.0f}s\tImages: {2}\tImages/s: {3:.1f}'.format(
+        elapsed // 60, elapsed % 60, pos, pos / max(elapsed, 1e-9)))
+    utils.print_both(txt_file, 'Predictions written to: ' + output_dir)
+
+    with open(os.path.join(output_dir, 'index.json'), 'w') as f:
+        json.dump({'chunks': writer.chunks, 'rows': writer.rows, 'images_per_second': pos / max(elapsed, 1e-9)}, f)
+    return writer.rows
@@ -0,0 +1,144 @@
+import json
+import time
+import contextlib
+import torch
+import utils
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Phase timers - wall time, number of samples and peak memory of training phases (data loading, forward,
+# backward, optimizer step, target update, K-means, metrics, checkpoints, ...) accumulated over the run
+# Device work is asynchronous, so phases are timed on the host unless sync is set (--profile), then
+# the device is synchronised at the end of each phase and its time is attributed correctly
+
+
+class PhaseTimer:
+    def __init__(self, sync=False):
+        self.sync = sync
+        self.phases = {}
+        self.since = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name, samples=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync and torch.cuda.is_available():
+                torch.cuda.synchronize()
+            self.add(name, time.perf_counter() - start, samples)
+
+    def add(self, name, seconds, samples=0):
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = {'seconds': 0.0, 'count': 0, 'samples': 0, 'peak_rss_mb': None}
+        phase['seconds'] += seconds
+        phase['count'] += 1
+        phase['samples'] += samples
+        # Peak memory of the process reached by the end of the phase
+        phase['peak_rss_mb'] = peak_rss_mb()
+
+    # Items of iterable (batches of data loader) with time spent waiting for each of them
+    def iterate(self, iterable, name='data'):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(name, time.perf_counter() - start, len(item[0]))
+            yield item
+
+    def summary(self):
+        wall = time.perf_counter() - self.since
+        phases = {}
+        for name, phase in self.phases.items():
+            phases[name] = dict(phase, share=phase['seconds'] / wall if wall > 0 else 0.0,
+                                samples_per_second=phase['samples'] / phase['seconds']
+                                if phase['samples'] and phase['seconds'] > 0 else None)
+        summary = {'wall_seconds': wall, 'peak_rss_mb': peak_rss_mb(), 'phases': phases}
+        if torch.cuda.is_available():
+            summary['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+        return summary
+
+    # Table in report, scalars in tensorboard (writer), JSON file (path)
+    def report(self, txt_file, writer=None, path=None):
+        summary = self.summary()
+        utils.print_both(txt_file, '\nTime per phase (wall time {0:.1f}s, peak RSS {1}):'.format(
+            summary['wall_seconds'], _mb(summary['peak_rss_mb'])))
+        for name, phase in sorted(summary['phases'].items(), key=lambda p: -p[1]['seconds']):
+            rate = phase['samples_per_second']
+            utils.print_both(txt_file, '{0:<18}\t{1:8.2f}s\t{2:5.1f}%\tCalls: {3}\tSamples/s: {4}\tPeak RSS: {5}'.format(
+                name, phase['seconds'], 100 * phase['share'], phase['count'],
+                '-' if rate is None else '{:.1f}'.format(rate), _mb(phase['peak_rss_mb'])))
+        if writer is not None:
+            for name, phase in summary['phases'].items():
+                writer.add_scalar('Profile/' + name + '/Seconds', phase['seconds'])
+                if phase['samples_per_second'] is not None:
+                    writer.add_scalar('Profile/' + name + '/Samples_per_second', phase['samples_per_second'])
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(summary, f, indent=1)
+        return summary
+
+
+# Timer of the run (params['timer']), created on first use
+def timer(params):
+    if params.get('timer') is None:
+        params['timer'] = PhaseTimer()
+    return params['timer']
+
+
+# Peak resident memory of the process in MB (None where not available)
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _mb(value):
+    return '-' if value is None else '{:.0f} MB'.format(value)
+
+
+# torch.profiler over a window of training steps (optimizer steps of both phases counted together):
+# skips wait steps, warms up for one step and records active steps, Chrome trace written to path
+class StepProfiler:
+    def __init__(self, path, wait=10, active=5):
+        self.path = path
+        self.steps = 0
+        self.last = wait + 1 + active
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(activities=activities,
+                                               schedule=torch.profiler.schedule(wait=wait, warmup=1, active=active,
+                                                                                repeat=1),
+                                               on_trace_ready=self._export, record_shapes=True, profile_memory=True)
+        self.profiler.start()
+
+    def step(self):
+        if self.profiler is None:
+            return
+        self.profiler.step()
+        self.steps += 1
+        if self.steps >= self.last:
+            self.close()
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+    def _export(self, profiler):
+        profiler.export_chrome_trace(self.path)
+
+
+# Next training step for the profiler (if profiling)
+def step(params):
+    profiler = params.get('profiler')
+    if profiler is not None:
+        profiler.step()
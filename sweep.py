@@ -0,0 +1,165 @@
+from __future__ import print_function
+import os
+import sys
+import csv
+import json
+import math
+import time
+import random
+import itertools
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Hyperparameter sweep - every configuration is trained by a separate torch_DCEC.py process
+# Jobs run in parallel with a CPU thread budget each, read one dataset cache decoded before they start
+# and take their run indices atomically (see utils.reserve_index)
+# Logs, results of jobs and summary table (final NMI/ARI/ACC and wall time) go to sweeps/sweep_XXX
+
+# Swept options of torch_DCEC.py
+_space = [('net_architecture', str), ('gamma', float), ('update_interval', int), ('num_clusters', int),
+          ('rate', float), ('rate_pretrain', float)]
+_columns = ['job', 'name'] + [option for option, _ in _space] + ['nmi', 'ari', 'acc', 'time', 'returncode']
+
+
+# Configurations (dicts of options) - all combinations (grid) or random draws
+# Random search draws float options given as two values log-uniformly from the range, others from the lists
+def configurations(args):
+    values = [(option, getattr(args, option)) for option, _ in _space]
+    if args.search == 'grid':
+        return [dict(zip([o for o, _ in values], combination)) for combination in itertools.product(*[v for _, v in values])]
+    rng = random.Random(args.seed)
+    configs = []
+    for _ in range(args.samples):
+        config = {}
+        for (option, kind), (_, choices) in zip(_space, values):
+            if kind is float and len(choices) == 2:
+                low, high = math.log(min(choices)), math.log(max(choices))
+                config[option] = math.exp(rng.uniform(low, high))
+            else:
+                config[option] = rng.choice(choices)
+        configs.append(config)
+    return configs
+
+
+# New sweep directory (created atomically, concurrent sweeps get different ones)
+def sweep_directory(root='sweeps'):
+    os.makedirs(root, exist_ok=True)
+    idx = 1
+    while True:
+        path = os.path.join(root, 'sweep_' + str(idx).zfill(3))
+        try:
+            os.mkdir(path)
+            return path
+        except FileExistsError:
+            idx += 1
+
+
+# Dataset decoded once before jobs start (custom image cache, memory-mapped MNIST) - jobs only read it
+def prepare_dataset(args):
+    if args.dataset == 'custom':
+        if args.image_cache:
+            import image_cache
+            image_cache.CachedImageFolder(args.dataset_path, args.custom_img_size, cache_root=args.cache_dir,
+                                          workers=args.jobs * args.threads)
+    else:
+        import mnist
+        mnist.MNISTMemmap('../data', train=args.dataset == 'MNIST-train', full=args.dataset == 'MNIST-full',
+                          download=True)
+
+
+# One training run - returns a row of the summary
+def run_job(job, config, args, extra, directory):
+    name = 'job_' + str(job).zfill(3)
+    results_file = os.path.join(directory, name + '.json')
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'torch_DCEC.py'),
+               '--dataset', args.dataset, '--dataset_path', args.dataset_path,
+               '--custom_img_size'] + [str(s) for s in args.custom_img_size] + \
+              ['--image_cache', str(args.image_cache), '--cache_dir', args.cache_dir, '--results', results_file]
+    for option, value in sorted(config.items()):
+        command += ['--' + option, str(value)]
+    command += extra
+    # CPU thread budget of the job
+    env = dict(os.environ, OMP_NUM_THREADS=str(args.threads), MKL_NUM_THREADS=str(args.threads))
+
+    since = time.time()
+    with open(os.path.join(directory, name + '.log'), 'w') as log:
+        returncode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, env=env)
+    row = dict(config, job=job, name=None, nmi=None, ari=None, acc=None, time=time.time() - since,
+               returncode=returncode)
+    if returncode == 0 and os.path.exists(results_file):
+        with open(results_file) as f:
+            results = json.load(f)
+        row.update(name=results['name'], nmi=results['nmi'], ari=results['ari'], acc=results['acc'])
+    print('{0}\t{1}\tNMI: {2}\tARI: {3}\tAcc: {4}\tTime: {5:.0f}s{6}'.format(
+        name, row['name'], _fmt(row['nmi']), _fmt(row['ari']), _fmt(row['acc']), row['time'],
+        '' if returncode == 0 else '\tFailed (code {})'.format(returncode)))
+    sys.stdout.flush()
+    return row
+
+
+def _fmt(value):
+    return '-' if value is None else '{:.5f}'.format(value)
+
+
+def write_summary(rows, directory):
+    rows = sorted(rows, key=lambda r: r['job'])
+    with open(os.path.join(directory, 'summary.json'), 'w') as f:
+        json.dump(rows, f, indent=1)
+    with open(os.path.join(directory, 'summary.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=_columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+
+    # Translate string entries to bool for parser
+    def str2bool(v):
+        if v.lower() in ('yes', 'true', 't', 'y', '1'):
+            return True
+        elif v.lower() in ('no', 'false', 'f', 'n', '0'):
+            return False
+        else:
+            raise argparse.ArgumentTypeError('Boolean value expected.')
+
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep of DCEC (other options are passed to torch_DCEC.py)')
+    parser.add_argument('--search', default='grid', choices=['grid', 'random'], help='grid or random search')
+    parser.add_argument('--samples', default=10, type=int, help='number of random configurations')
+    parser.add_argument('--seed', default=0, type=int, help='seed of random search')
+    parser.add_argument('--net_architecture', default=['CAE_3'], nargs='+',
+                        choices=['CAE_3', 'CAE_bn3', 'CAE_4', 'CAE_bn4', 'CAE_5', 'CAE_bn5'])
+    parser.add_argument('--gamma', default=[0.1], nargs='+', type=float, help='clustering loss weights')
+    parser.add_argument('--update_interval', default=[80], nargs='+', type=int, help='target update intervals')
+    parser.add_argument('--num_clusters', default=[10], nargs='+', type=int, help='numbers of clusters')
+    parser.add_argument('--rate', default=[0.001], nargs='+', type=float, help='learning rates for clustering')
+    parser.add_argument('--rate_pretrain', default=[0.001], nargs='+', type=float, help='learning rates for pretraining')
+    parser.add_argument('--jobs', default=2, type=int, help='runs trained in parallel')
+    parser.add_argument('--threads', default=None, type=int, help='CPU threads per run (default: CPUs / jobs)')
+    parser.add_argument('--dataset', default='MNIST-train', choices=['MNIST-train', 'custom', 'MNIST-test', 'MNIST-full'])
+    parser.add_argument('--dataset_path', default='data', help='path to dataset')
+    parser.add_argument('--custom_img_size', default=[128, 128, 3], nargs=3, type=int, help='size of custom images')
+    parser.add_argument('--image_cache', default=True, type=str2bool, help='decode custom images once into on-disk cache')
+    parser.add_argument('--cache_dir', default='cache', help='directory for decoded images cache (shared by all runs)')
+    args, extra = parser.parse_known_args()
+    if args.threads is None:
+        args.threads = max(1, (os.cpu_count() or 1) // args.jobs)
+    args.cache_dir = os.path.abspath(args.cache_dir)
+
+    configs = configurations(args)
+    directory = sweep_directory()
+    print('Sweep: {0}\tConfigurations: {1}\tJobs: {2}\tThreads per job: {3}'.format(directory, len(configs),
+                                                                                    args.jobs, args.threads))
+    with open(os.path.join(directory, 'sweep.json'), 'w') as f:
+        json.dump({'args': vars(args), 'extra': extra, 'configurations': configs}, f, indent=1)
+
+    prepare_dataset(args)
+
+    since = time.time()
+    # Threads only wait for training processes
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        rows = list(pool.map(lambda job: run_job(job[0] + 1, job[1], args, extra, directory), enumerate(configs)))
+    write_summary(rows, directory)
+    print('Sweep complete in {0:.0f}m {1:.0f}s\tSummary: {2}'.format((time.time() - since) // 60,
+                                                                    (time.time() - since) % 60,
+                                                                    os.path.join(directory, 'summary.csv')))
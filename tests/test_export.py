@@ -0,0 +1,19 @@
+import pytest
+import torch
+import export
+import nets
+
+
+# Exported encoder with clustering layer gives the outputs of the eager model (batch size differs from export)
+@pytest.mark.parametrize('architecture', ['CAE_3', 'CAE_bn3'])
+def test_exported_matches_eager(tmp_path, architecture):
+    torch.manual_seed(0)
+    model = getattr(nets, architecture)([28, 28, 1], num_clusters=4)
+    model.eval()
+    path = str(tmp_path / 'model.pt2')
+    export.export_model(model, [28, 28, 1], path)
+    exported = export.load(path)
+    inputs = torch.rand(5, 1, 28, 28)
+    q_diff, embedding_diff = export.parity(model, exported, inputs)
+    assert q_diff < 1e-5
+    assert embedding_diff < 1e-4
@@ -0,0 +1,52 @@
+import io
+import re
+import pytest
+import torch
+import distributed
+import loaders
+import nets
+import training_functions
+
+
+# Images, labels and sample indices, as returned by the datasets of the repository
+class RandomImages(torch.utils.data.Dataset):
+    def __init__(self, size=192, num_classes=4):
+        generator = torch.Generator().manual_seed(0)
+        self.images = torch.rand(size, 1, 28, 28, generator=generator)
+        self.labels = torch.randint(num_classes, (size,), generator=generator)
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        return self.images[index], int(self.labels[index]), index
+
+
+def train(tmp_path, dataloader, epochs, **options):
+    torch.manual_seed(0)
+    model = nets.CAE_bn3([28, 28, 1], num_clusters=4)
+    criteria = [torch.nn.MSELoss(), torch.nn.KLDivLoss(reduction='sum')]
+    optimizers = [torch.optim.Adam(model.parameters(), 1e-3), torch.optim.Adam(model.parameters(), 1e-3)]
+    schedulers = [torch.optim.lr_scheduler.StepLR(optimizer, 200) for optimizer in optimizers]
+    report = io.StringIO()
+    params = dict(pretrain=True, model_files=[str(tmp_path / 'net'), str(tmp_path / 'pretrained.pt')],
+                  txt_file=report, writer=None, batch=dataloader.batch_size, print_freq=1,
+                  dataset_size=len(dataloader.dataset), device=torch.device('cpu'), pretrain_epochs=1, gamma=0.1,
+                  update_interval=2, tol=-1.0, optimizers=optimizers, schedulers=schedulers)
+    params.update(options)
+    training_functions.train_model(model, dataloader, criteria, optimizers, schedulers, epochs, params)
+    return report.getvalue()
+
+
+# Full passes of target updates must not cut short the epochs of the persistent training loader
+# (a shuffled loader is read in order by the same workers)
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_refresh_keeps_all_batches_with_workers(tmp_path, shuffle):
+    dataset = RandomImages()
+    dataloader = loaders.build(dataset, {'batch_size': 32, 'workers': 2, 'prefetch': 2})
+    dataloader = distributed.shard(dataloader, {}, shuffle=shuffle, seed=1)
+    report = train(tmp_path, dataloader, 3, refresh_interval=1).split('Begin clusters training')[1]
+    assert report.count('(full pass)') == 2
+    for epoch in range(1, 4):
+        batches = re.findall(r'Epoch: \[{}\]\[(\d+)/\d+\]'.format(epoch), report)
+        assert [int(b) for b in batches] == list(range(1, len(dataloader) + 1))
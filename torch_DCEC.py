@@ -7,13 +7,22 @@ if __name__ == "__main__":
     import torch.nn as nn
     import torch.optim as optim
     from torch.optim import lr_scheduler
-    from torchvision import datasets, models, transforms
+    from torchvision import transforms
     import os
+    import sys
     import math
-    import fnmatch
+    import json
+    import time
+    import shutil
     import nets
     import utils
     import training_functions
+    import checkpoint
+    import predict
+    import distributed
+    import logger
+    import profiling
+    import loaders
     from torch.utils.tensorboard import SummaryWriter
 
     # Translate string entries to bool for parser
@@ -26,7 +35,7 @@ if __name__ == "__main__":
             raise argparse.ArgumentTypeError('Boolean value expected.')
 
     parser = argparse.ArgumentParser(description='Use DCEC for clustering')
-    parser.add_argument('--mode', default='train_full', choices=['train_full', 'pretrain'], help='mode')
+    parser.add_argument('--mode', default='train_full', choices=['train_full', 'pretrain', 'predict'], help='mode')
     parser.add_argument('--tensorboard', default=True, type=bool, help='export training stats to tensorboard')
     parser.add_argument('--pretrain', default=True, type=str2bool, help='perform autoencoder pretraining')
     parser.add_argument('--pretrained_net', default=1, help='index or path of pretrained net')
@@ -35,7 +44,22 @@ if __name__ == "__main__":
                         choices=['MNIST-train', 'custom', 'MNIST-test', 'MNIST-full'],
                         help='custom or prepared dataset')
     parser.add_argument('--dataset_path', default='data', help='path to dataset')
+    parser.add_argument('--image_cache', default=True, type=str2bool, help='decode custom images once into on-disk cache')
+    parser.add_argument('--cache_dir', default='cache', help='directory for decoded images cache')
     parser.add_argument('--batch_size', default=256, type=int, help='batch size')
+    parser.add_argument('--micro_batch', default=None, type=int,
+                        help='samples per forward/backward pass, gradients accumulated over the batch (whole batch if not set)')
+    parser.add_argument('--scale_lr', default='none', choices=['none', 'linear', 'sqrt'],
+                        help='scale learning rates with batch size (of all processes) relative to --base_batch')
+    parser.add_argument('--base_batch', default=256, type=int, help='batch size of the given learning rates')
+    parser.add_argument('--workers', default=None, type=int,
+                        help='data loader worker processes (default: 4, with --tune_loader the most probed)')
+    parser.add_argument('--tune_loader', default=False, type=str2bool,
+                        help='choose workers, prefetch depth and batch size by probing the dataset (cached per machine)')
+    parser.add_argument('--tune_batch_sizes', default=None, nargs='+', type=int,
+                        help='batch sizes probed with --tune_loader (default: --batch_size only)')
+    parser.add_argument('--tune_batches', default=20, type=int, help='batches read for each probed configuration')
+    parser.add_argument('--shuffle', default=False, type=str2bool, help='shuffle training data every epoch')
     parser.add_argument('--rate', default=0.001, type=float, help='learning rate for clustering')
     parser.add_argument('--rate_pretrain', default=0.001, type=float, help='learning rate for pretraining')
     parser.add_argument('--weight', default=0.0, type=float, help='weight decay for clustering')
@@ -51,21 +75,67 @@ if __name__ == "__main__":
     parser.add_argument('--printing_frequency', default=10, type=int, help='training stats printing frequency')
     parser.add_argument('--gamma', default=0.1, type=float, help='clustering loss weight')
     parser.add_argument('--update_interval', default=80, type=int, help='update interval for target distribution')
+    parser.add_argument('--refresh_interval', default=0, type=int,
+                        help='epochs between full passes for target distribution (0 - cached soft assignments only)')
     parser.add_argument('--tol', default=1e-2, type=float, help='stop criterium tolerance')
+    parser.add_argument('--eval_fraction', default=0.0, type=float,
+                        help='fraction of samples (stratified by class) for estimated metrics and stop criterion (0 - all samples)')
+    parser.add_argument('--eval_confidence', default=0.95, type=float, help='confidence level of estimates')
+    parser.add_argument('--eval_bootstrap', default=50, type=int, help='bootstrap resamples for metrics intervals')
+    parser.add_argument('--metrics_workers', default=0, type=int,
+                        help='processes computing NMI/ARI/ACC in background (0 - computed in training loop)')
+    parser.add_argument('--kmeans_init', default='full', choices=['full', 'minibatch', 'reservoir'],
+                        help='K-means initialisation of clusters')
+    parser.add_argument('--kmeans_samples', default=50000, type=int, help='reservoir sample size for K-means')
     parser.add_argument('--num_clusters', default=10, type=int, help='number of clusters')
     parser.add_argument('--custom_img_size', default=[128, 128, 3], nargs=3, type=int, help='size of custom images')
     parser.add_argument('--leaky', default=True, type=str2bool)
     parser.add_argument('--neg_slope', default=0.01, type=float)
     parser.add_argument('--activations', default=False, type=str2bool)
     parser.add_argument('--bias', default=True, type=str2bool)
+    parser.add_argument('--best_criterion', default='last', choices=['last', 'loss'],
+                        help='weights kept after training: last epoch or lowest epoch loss')
+    parser.add_argument('--checkpoint', default=True, type=str2bool, help='save training state for resuming')
+    parser.add_argument('--checkpoint_interval', default=0, type=int,
+                        help='batches between checkpoints (0 - at the end of each epoch only)')
+    parser.add_argument('--resume', default=None, help='index or path of checkpoint of interrupted run to resume')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16', 'fp16'],
+                        help='precision of autoencoder forward and reconstruction loss (mixed precision with autocast)')
+    parser.add_argument('--compile', default=False, type=str2bool, help='compile the model with torch.compile')
+    parser.add_argument('--net', default=None, help='index or path of trained net (predict mode)')
+    parser.add_argument('--predict_dir', default=None,
+                        help='output directory of predict mode (default: predictions/(net_architecture_name)_(index))')
+    parser.add_argument('--chunk_size', default=65536, type=int, help='images per output file in predict mode')
+    parser.add_argument('--nprobe', default=None, type=int,
+                        help='predict mode: approximate centroid index probing given number of cells (exact if not set)')
+    parser.add_argument('--embedding_store', default=False, type=str2bool,
+                        help='keep embeddings, soft assignments and sample ids of inference passes next to the net')
+    parser.add_argument('--results', default=None,
+                        help='JSON file with name of the run, final NMI/ARI/ACC and time (used by sweep)')
+    parser.add_argument('--log_queue', default=1024, type=int,
+                        help='entries waiting for the logger thread (tensorboard scalars and images are dropped when full)')
+    parser.add_argument('--profile', default=False, type=str2bool,
+                        help='synchronised phase timers and torch.profiler Chrome trace of a window of training steps')
+    parser.add_argument('--profile_wait', default=10, type=int, help='training steps before profiled window')
+    parser.add_argument('--profile_steps', default=5, type=int, help='profiled training steps')
+    parser.add_argument('--memmap_dir', default=None, help='directory for memory-mapped inference buffers (kept in memory if not set)')
     args = parser.parse_args()
+    since = time.time()
+
+    # Data-parallel training in processes started by torchrun (single process otherwise)
+    rank, world_size = distributed.init()
+    if world_size > 1 and args.mode == 'predict':
+        parser.error('predict mode runs in a single process')
+    # Only rank 0 prints and writes reports
+    if rank > 0:
+        sys.stdout = open(os.devnull, 'w')
     print(args)
 
     if args.mode == 'pretrain' and not args.pretrain:
         print("Nothing to do :(")
         exit()
 
-    board = args.tensorboard
+    board = args.tensorboard and args.mode != 'predict' and rank == 0
 
     # Deal with pretraining option and way of showing network path
     pretrain = args.pretrain
@@ -77,7 +147,7 @@ if __name__ == "__main__":
             net_is_path = False
         except:
             pass
-    params = {'pretrain': pretrain}
+    params = {'pretrain': pretrain, 'rank': rank, 'world_size': world_size}
 
     # Directories
     # Create directories structure
@@ -86,22 +156,40 @@ if __name__ == "__main__":
 
     # Net architecture
     model_name = args.net_architecture
-    # Indexing (for automated reports saving) - allows to run many trainings and get all the reports collected
-    if pretrain or (not pretrain and net_is_path):
-        reports_list = sorted(os.listdir('reports'), reverse=True)
-        if reports_list:
-            for file in reports_list:
-                # print(file)
-                if fnmatch.fnmatch(file, model_name + '*'):
-                    idx = int(str(file)[-7:-4]) + 1
-                    break
+
+    # Resuming interrupted run - index or path of its checkpoint
+    resume_file = None
+    if args.resume is not None:
+        try:
+            idx = int(args.resume)
+            resume_file = os.path.join('nets', model_name + '_' + str(idx).zfill(3) + '_checkpoint.pt')
+        except ValueError:
+            resume_file = args.resume
+            idx = int(os.path.basename(resume_file).split('_checkpoint')[0][-3:])
+
+    # Predictions with trained net - index or path of its weights
+    predict_file = None
+    if args.mode == 'predict':
+        if args.net is None:
+            parser.error('--net is required in predict mode')
         try:
-            idx
-        except NameError:
-            idx = 1
+            idx = int(args.net)
+            predict_file = os.path.join('nets', model_name + '_' + str(idx).zfill(3) + '.pt')
+        except ValueError:
+            predict_file = args.net
+
+    # Indexing (for automated reports saving) - allows to run many trainings and get all the reports collected
+    # The report file is created when the index is chosen, so concurrent runs (e.g. sweeps) get different indices
+    if resume_file is None and predict_file is None and (pretrain or (not pretrain and net_is_path)):
+        idx = utils.reserve_index('reports', model_name) if rank == 0 else None
+        # The same index for all processes
+        idx = distributed.broadcast_object(idx, params)
 
     # Base filename
-    name = model_name + '_' + str(idx).zfill(3)
+    if predict_file is not None:
+        name = os.path.splitext(os.path.basename(predict_file))[0]
+    else:
+        name = model_name + '_' + str(idx).zfill(3)
 
     # Filenames for report and weights
     name_txt = name + '.txt'
@@ -121,25 +209,32 @@ if __name__ == "__main__":
     model_files = [name_net, pretrained]
     params['model_files'] = model_files
 
-    # Open file
-    if pretrain:
+    # Open file (report of predictions is kept with them)
+    if predict_file is not None:
+        params['predict_dir'] = args.predict_dir if args.predict_dir is not None else os.path.join('predictions', name)
+        params['chunk_size'] = args.chunk_size
+        params['nprobe'] = args.nprobe
+        os.makedirs(params['predict_dir'], exist_ok=True)
+        f = open(os.path.join(params['predict_dir'], 'report.txt'), 'w')
+    elif rank > 0:
+        f = open(os.devnull, 'w')
+    elif pretrain and resume_file is None:
         f = open(name_txt, 'w')
     else:
         f = open(name_txt, 'a')
-    params['txt_file'] = f
 
     # Delete tensorboard entry if exist (not to overlap as the charts become unreadable)
-    try:
-        os.system("rm -rf runs/" + name)
-    except:
-        pass
+    if resume_file is None and predict_file is None and rank == 0:
+        shutil.rmtree(os.path.join('runs', name), ignore_errors=True)
 
-    # Initialize tensorboard writer
+    # Report and tensorboard written by background thread of the logger
+    backends = [logger.FileBackend(f)]
     if board:
-        writer = SummaryWriter('runs/' + name)
-        params['writer'] = writer
-    else:
-        params['writer'] = None
+        backends.append(logger.TensorboardBackend(SummaryWriter('runs/' + name)))
+    f = logger.AsyncLogger(backends, maxsize=args.log_queue)
+    params['txt_file'] = f
+    # Initialize tensorboard writer (scalars and images go through the logger)
+    params['writer'] = f if board else None
 
     # Hyperparameters
 
@@ -149,8 +244,11 @@ if __name__ == "__main__":
     # Batch size
     batch = args.batch_size
     params['batch'] = batch
-    # Number of workers (typically 4*num_of_GPUs)
-    workers = 4
+    # Micro-batches of a batch (memory footprint) - gradients accumulated, one optimisation step per batch
+    params['micro_batch'] = args.micro_batch
+    # Number of workers (typically 4*num_of_GPUs), one loader with persistent workers is shared by all phases
+    # (tuned with the data loader configuration if requested)
+    workers = args.workers if args.workers is not None else 4
     # Learning rate
     rate = args.rate
     rate_pretrain = args.rate_pretrain
@@ -182,13 +280,36 @@ if __name__ == "__main__":
     update_interval = args.update_interval
     params['update_interval'] = update_interval
 
+    # Full target distribution refresh interval (in epochs):
+    refresh_interval = args.refresh_interval
+    params['refresh_interval'] = refresh_interval
+
     # Tolerance for label changes:
     tol = args.tol
     params['tol'] = tol
 
+    # Evaluation on a subsample
+    params['eval_fraction'] = args.eval_fraction
+    params['eval_confidence'] = args.eval_confidence
+    params['eval_bootstrap'] = args.eval_bootstrap
+    params['metrics_workers'] = args.metrics_workers
+
+    # Memory-mapped buffers for inference passes (separate for each process)
+    if args.memmap_dir is not None and world_size > 1:
+        params['memmap_dir'] = os.path.join(args.memmap_dir, 'rank' + str(rank))
+    else:
+        params['memmap_dir'] = args.memmap_dir
+
+    # Mixed precision (clustering layer and KL loss always in fp32)
+    params['precision'] = args.precision
+
     # Number of clusters
     num_clusters = args.num_clusters
 
+    # K-means initialisation
+    params['kmeans_init'] = args.kmeans_init
+    params['kmeans_samples'] = args.kmeans_samples
+
     # Report for settings
     tmp = "Training the '" + model_name + "' architecture"
     utils.print_both(f, tmp)
@@ -198,6 +319,10 @@ if __name__ == "__main__":
     utils.print_both(f, tmp)
     tmp = "Number of workers:\t" + str(workers)
     utils.print_both(f, tmp)
+    tmp = "Micro-batch size:\t" + (str(args.micro_batch) if args.micro_batch else 'whole batch')
+    utils.print_both(f, tmp)
+    tmp = "Shuffled training data:\t" + str(args.shuffle)
+    utils.print_both(f, tmp)
     tmp = "Learning rate:\t" + str(rate)
     utils.print_both(f, tmp)
     tmp = "Pretraining learning rate:\t" + str(rate_pretrain)
@@ -222,10 +347,16 @@ if __name__ == "__main__":
     utils.print_both(f, tmp)
     tmp = "Update interval for target distribution:\t" + str(update_interval)
     utils.print_both(f, tmp)
+    tmp = "Full target distribution refresh interval:\t" + str(refresh_interval)
+    utils.print_both(f, tmp)
     tmp = "Stop criterium tolerance:\t" + str(tol)
     utils.print_both(f, tmp)
+    tmp = "Evaluation subsample:\t" + (str(args.eval_fraction) if args.eval_fraction > 0 else 'all samples')
+    utils.print_both(f, tmp)
     tmp = "Number of clusters:\t" + str(num_clusters)
     utils.print_both(f, tmp)
+    tmp = "K-means initialisation:\t" + args.kmeans_init
+    utils.print_both(f, tmp)
     tmp = "Leaky relu:\t" + str(args.leaky)
     utils.print_both(f, tmp)
     tmp = "Leaky slope:\t" + str(args.neg_slope)
@@ -234,10 +365,16 @@ if __name__ == "__main__":
     utils.print_both(f, tmp)
     tmp = "Bias:\t" + str(args.bias)
     utils.print_both(f, tmp)
+    tmp = "Precision:\t" + args.precision
+    utils.print_both(f, tmp)
+    tmp = "Compiled model:\t" + str(args.compile)
+    utils.print_both(f, tmp)
+    tmp = "Number of processes:\t" + str(world_size)
+    utils.print_both(f, tmp)
 
     # Data preparation
     if dataset == 'MNIST-train':
-        # Uses slightly modified torchvision MNIST class
+        # Uses slightly modified torchvision MNIST class (memory-mapped, batches served without PIL)
         import mnist
         tmp = "\nData preparation\nReading data from: MNIST train dataset"
         utils.print_both(f, tmp)
@@ -245,14 +382,12 @@ if __name__ == "__main__":
         tmp = "Image size used:\t{0}x{1}".format(img_size[0], img_size[1])
         utils.print_both(f, tmp)
 
-        dataset = mnist.MNIST('../data', train=True, download=True,
-                              transform=transforms.Compose([
-                                                           transforms.ToTensor(),
-                                                           # transforms.Normalize((0.1307,), (0.3081,))
-                                                           ]))
+        dataset = mnist.MNISTMemmap('../data', train=True, download=True,
+                                    # transform=transforms.Normalize((0.1307,), (0.3081,))
+                                    )
 
-        dataloader = torch.utils.data.DataLoader(dataset,
-            batch_size=batch, shuffle=False, num_workers=workers)
+        # Whole batches served by the dataset
+        collate_fn = utils.batch_collate
 
         dataset_size = len(dataset)
         tmp = "Training set size:\t" + str(dataset_size)
@@ -266,14 +401,11 @@ if __name__ == "__main__":
         tmp = "Image size used:\t{0}x{1}".format(img_size[0], img_size[1])
         utils.print_both(f, tmp)
 
-        dataset = mnist.MNIST('../data', train=False, download=True,
-                              transform=transforms.Compose([
-                                  transforms.ToTensor(),
-                                  # transforms.Normalize((0.1307,), (0.3081,))
-                              ]))
+        dataset = mnist.MNISTMemmap('../data', train=False, download=True,
+                                    # transform=transforms.Normalize((0.1307,), (0.3081,))
+                                    )
 
-        dataloader = torch.utils.data.DataLoader(dataset,
-                                                 batch_size=batch, shuffle=False, num_workers=workers)
+        collate_fn = utils.batch_collate
 
         dataset_size = len(dataset)
         tmp = "Training set size:\t" + str(dataset_size)
@@ -287,14 +419,11 @@ if __name__ == "__main__":
         tmp = "Image size used:\t{0}x{1}".format(img_size[0], img_size[1])
         utils.print_both(f, tmp)
 
-        dataset = mnist.MNIST('../data', full=True, download=True,
-                               transform=transforms.Compose([
-                                   transforms.ToTensor(),
-                                   # transforms.Normalize((0.1307,), (0.3081,))
-                               ]))
+        dataset = mnist.MNISTMemmap('../data', full=True, download=True,
+                                    # transform=transforms.Normalize((0.1307,), (0.3081,))
+                                    )
 
-        dataloader = torch.utils.data.DataLoader(dataset,
-                                                 batch_size=batch, shuffle=False, num_workers=workers)
+        collate_fn = utils.batch_collate
 
         dataset_size = len(dataset)
         tmp = "Training set size:\t" + str(dataset_size)
@@ -315,42 +444,102 @@ if __name__ == "__main__":
         tmp = "Image size used:\t{0}x{1}".format(img_size[0], img_size[1])
         utils.print_both(f, tmp)
 
-        # Transformations
-        data_transforms = transforms.Compose([
-                transforms.Resize(img_size[0:2]),
-                # transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-            ])
-
-        # Read data from selected folder and apply transformations
-        image_dataset = datasets.ImageFolder(data_dir, data_transforms)
-        # Prepare data for network: schuffle and arrange batches
-        dataloader = torch.utils.data.DataLoader(image_dataset, batch_size=batch,
-                                                      shuffle=False, num_workers=workers)
+        if args.mode == 'predict':
+            # New images streamed from any directory structure, nothing is cached
+            image_dataset = predict.ImageFiles(data_dir, img_size, mean=[0.485, 0.456, 0.406],
+                                               std=[0.229, 0.224, 0.225])
+            collate_fn = None
+        elif args.image_cache:
+            # Images decoded and resized once into on-disk cache, normalised per batch
+            import image_cache
+            image_dataset = image_cache.CachedImageFolder(data_dir, img_size, cache_root=args.cache_dir,
+                                                          mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225],
+                                                          workers=workers)
+            tmp = "Decoded images cache:\t" + image_dataset.cache_dir
+            utils.print_both(f, tmp)
+            collate_fn = utils.batch_collate
+        else:
+            # Transformations
+            data_transforms = transforms.Compose([
+                    transforms.Resize(img_size[0:2]),
+                    # transforms.RandomHorizontalFlip(),
+                    transforms.ToTensor(),
+                    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+                ])
+
+            # Read data from selected folder and apply transformations (samples come with their indices)
+            import image_cache
+            image_dataset = image_cache.IndexedImageFolder(data_dir, data_transforms)
+            collate_fn = None
 
         # Size of data sets
         dataset_size = len(image_dataset)
         tmp = "Training set size:\t" + str(dataset_size)
         utils.print_both(f, tmp)
-
-    params['dataset_size'] = dataset_size
+        dataset = image_dataset
+
+    # Data loader used by all phases - fixed configuration or the fastest one found by probing the dataset
+    # (the choice is cached per machine and dataset, one process probes in multi-process runs)
+    if args.tune_loader:
+        if rank == 0:
+            batch_sizes = args.tune_batch_sizes or [batch]
+            max_workers = args.workers if args.workers is not None else max(0, (os.cpu_count() or 1) // world_size - 1)
+            key = '{0}:{1}:{2}:{3}:{4}'.format(args.dataset, os.path.abspath(args.dataset_path),
+                                               'x'.join(str(s) for s in img_size), args.image_cache, args.mode)
+            loader_config, cached = loaders.tune(dataset, key, loaders.candidates(batch_sizes, max_workers),
+                                                 collate_fn, cache_file=os.path.join(args.cache_dir, 'loaders.json'),
+                                                 batches=args.tune_batches, report=lambda line: utils.print_both(f, line))
+            tmp = "Data loader configuration " + ("(cached)" if cached else "(probed)")
+            utils.print_both(f, tmp)
+        else:
+            loader_config = None
+        loader_config = distributed.broadcast_object(loader_config, params)
+    else:
+        loader_config = loaders.default(batch, args.workers if args.workers is not None else 4)
+    workers = loader_config['workers']
+    batch = loader_config['batch_size']
+    params['batch'] = batch
+    tmp = "Data loader:\tBatch size: {0}\tWorkers: {1}\tPrefetch: {2}\tPinned memory: {3}".format(
+        batch, workers, loader_config['prefetch'], loader_config['pin_memory'])
+    utils.print_both(f, tmp)
+    dataloader = loaders.build(dataset, loader_config, collate_fn)
+
+    # Each process reads its own shard of the dataset
+    # Training batches are reshuffled every epoch if requested, inference passes read the same loader in order
+    # (the order depends only on the seed and epoch, the seed is kept in checkpoints)
+    params['sampler_seed'] = None
+    if args.shuffle and args.mode != 'predict':
+        params['sampler_seed'] = distributed.broadcast_object(int(torch.randint(2 ** 31 - 1, ())), params)
+    dataloader = distributed.shard(dataloader, params, shuffle=params['sampler_seed'] is not None,
+                                   seed=params['sampler_seed'] or 0)
+    params['dataset_size'] = len(dataloader.sampler)
+    if world_size > 1:
+        tmp = "Shard size per process:\t" + str(params['dataset_size'])
+        utils.print_both(f, tmp)
 
     # GPU check
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    device = torch.device("cuda:" + str(local_rank) if torch.cuda.is_available() else "cpu")
     tmp = "\nPerforming calculations on:\t" + str(device)
     utils.print_both(f, tmp + '\n')
     params['device'] = device
+    # fp16 autocast on CPU is emulated and far slower than fp32 - bf16 is used instead
+    if args.precision == 'fp16' and device.type == 'cpu':
+        args.precision = params['precision'] = 'bf16'
+        utils.print_both(f, 'Warning:\tfp16 is not supported on CPU, bf16 precision is used instead\n')
 
     # Evaluate the proper model
-    to_eval = "nets." + model_name + "(img_size, num_clusters=num_clusters, leaky = args.leaky, neg_slope = args.neg_slope)"
-    model = eval(to_eval)
+    model = getattr(nets, model_name)(img_size, num_clusters=num_clusters, leaky=args.leaky, neg_slope=args.neg_slope,
+                                      activations=args.activations, bias=args.bias)
 
     # Tensorboard model representation
     # if board:
     #     writer.add_graph(model, torch.autograd.Variable(torch.Tensor(batch, img_size[2], img_size[0], img_size[1])))
 
     model = model.to(device)
+    # Compiled in place - parameter names (saved weights, checkpoints) stay the same as in eager mode
+    if args.compile:
+        model.compile()
     # Reconstruction loss
     criterion_1 = nn.MSELoss(size_average=True)
     # Clustering loss
@@ -358,6 +547,16 @@ if __name__ == "__main__":
 
     criteria = [criterion_1, criterion_2]
 
+    # Learning rates scaled with the batch of an optimisation step (all processes) relative to the base batch
+    if args.scale_lr != 'none':
+        factor = float(batch * world_size) / args.base_batch
+        if args.scale_lr == 'sqrt':
+            factor = math.sqrt(factor)
+        rate, rate_pretrain = rate * factor, rate_pretrain * factor
+        tmp = "Learning rates scaled ({0}, x{1:.4f}):\t{2}\t(pretraining: {3})".format(args.scale_lr, factor, rate,
+                                                                                    rate_pretrain)
+        utils.print_both(f, tmp)
+
     optimizer = optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr=rate, weight_decay=weight)
 
     optimizer_pretrain = optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr=rate_pretrain, weight_decay=weight_pretrain)
@@ -368,16 +567,85 @@ if __name__ == "__main__":
     scheduler_pretrain = lr_scheduler.StepLR(optimizer_pretrain, step_size=sched_step_pretrain, gamma=sched_gamma_pretrain)
 
     schedulers = [scheduler, scheduler_pretrain]
+    params['optimizers'] = optimizers
+    params['schedulers'] = schedulers
+    # Loss scaling for fp16 (disabled otherwise)
+    params['scaler'] = torch.amp.GradScaler(device.type, enabled=args.precision == 'fp16')
+
+    # Periodic checkpoints of the whole training state (written in background)
+    if args.checkpoint and predict_file is None:
+        # Training state of shards differs between processes - one checkpoint per process
+        params['checkpoint'] = checkpoint.Checkpointer(distributed.rank_file(name_net + '_checkpoint.pt', params))
+    else:
+        params['checkpoint'] = None
+    params['checkpoint_interval'] = args.checkpoint_interval
+    params['best_criterion'] = args.best_criterion
+    # Embeddings of inference passes (and of the final model) kept in memory-mapped store
+    if args.embedding_store and predict_file is None and world_size == 1:
+        params['embedding_store'] = name_net + '_embeddings'
+    else:
+        params['embedding_store'] = None
+
+    # Time of training phases (device synchronised after each phase when profiling)
+    params['timer'] = profiling.PhaseTimer(sync=args.profile)
+    params['profiler'] = None
+    if args.profile and predict_file is None:
+        trace_file = distributed.rank_file(os.path.join('reports', name + '_trace.json'), params)
+        params['profiler'] = profiling.StepProfiler(trace_file, wait=args.profile_wait, active=args.profile_steps)
+        tmp = "Profiled training steps:\t{0}-{1}\t(trace: {2})".format(args.profile_wait + 2,
+                                                                     args.profile_wait + 1 + args.profile_steps,
+                                                                     trace_file)
+        utils.print_both(f, tmp)
+
+    # Restore interrupted run
+    params['resume'] = None
+    if resume_file is not None:
+        resume_file = distributed.rank_file(resume_file, params)
+        state = checkpoint.load(resume_file, device)
+        model.load_state_dict(state['model'])
+        for optimizer_state, opt in zip(state['optimizers'], optimizers):
+            opt.load_state_dict(optimizer_state)
+        for scheduler_state, sched in zip(state['schedulers'], schedulers):
+            sched.load_state_dict(scheduler_state)
+        if 'scaler' in state:
+            params['scaler'].load_state_dict(state['scaler'])
+        # The same data order as in the interrupted run
+        if state.get('sampler_seed') is not None and params['sampler_seed'] is not None:
+            params['sampler_seed'] = dataloader.sampler.seed = state['sampler_seed']
+        params['resume'] = state
+        utils.print_both(f, 'Training state loaded from checkpoint: ' + resume_file)
+
+    # Gradients averaged over processes (weights of rank 0 are copied to all processes)
+    params['ddp'] = distributed.wrap(model, params)
 
     if args.mode == 'train_full':
         model = training_functions.train_model(model, dataloader, criteria, optimizers, schedulers, epochs, params)
     elif args.mode == 'pretrain':
         model = training_functions.pretraining(model, dataloader, criteria[0], optimizers[1], schedulers[1], epochs, params)
+    elif args.mode == 'predict':
+        model.load_state_dict(torch.load(predict_file, map_location=device))
+        utils.print_both(f, 'Weights loaded from file: ' + predict_file)
+        predict.predict(model, dataloader, params)
 
     # Save final model
-    torch.save(model.state_dict(), name_net + '.pt')
+    if args.mode != 'predict' and rank == 0:
+        torch.save(model.state_dict(), name_net + '.pt')
+        training_functions.update_embedding_store(model, dataloader, params)
+
+    # Time per phase - report, tensorboard and JSON summary
+    if params['profiler'] is not None:
+        params['profiler'].close()
+    if args.mode != 'predict' and rank == 0:
+        params['timer'].report(f, params['writer'], path=os.path.join('reports', name + '_profile.json'))
+
+    # Final metrics for sweeps
+    if args.results is not None and rank == 0:
+        nmi, ari, acc = params.get('metrics', (None, None, None))
+        with open(args.results, 'w') as results:
+            json.dump({'name': name, 'nmi': nmi, 'ari': ari, 'acc': acc, 'time': time.time() - since}, results)
 
     # Close files
+    if params['checkpoint'] is not None:
+        params['checkpoint'].close()
     f.close()
-    if board:
-        writer.close()
+    distributed.close(params)
@@ -1,9 +1,16 @@
 import utils
 import time
+import os
+import contextlib
 import torch
 import numpy as np
-import copy
-from sklearn.cluster import KMeans
+import kmeans_init
+import checkpoint
+import embedding_store
+import distributed
+import profiling
+import evaluation
+import metrics_pool
 
 
 # Training function (from my torch_DCEC implementation, kept for completeness)
@@ -14,31 +21,49 @@ def train_model(model, dataloader, criteria, optimizers, schedulers, num_epochs,
 
     # Unpack parameters
     writer = params['writer']
-    if writer is not None: board = True
+    board = writer is not None
     txt_file = params['txt_file']
     pretrained = params['model_files'][1]
     pretrain = params['pretrain']
     print_freq = params['print_freq']
-    dataset_size = params['dataset_size']
     device = params['device']
     batch = params['batch']
     pretrain_epochs = params['pretrain_epochs']
     gamma = params['gamma']
     update_interval = params['update_interval']
     tol = params['tol']
+    refresh_interval = params.get('refresh_interval', 0)
+    checkpoint_interval = params.get('checkpoint_interval', 0)
+    micro_batch = params.get('micro_batch')
+    scaler = grad_scaler(params)
+    # Training forward through DistributedDataParallel wrapper in multi-process runs
+    network = params.get('ddp') or model
+    timer = profiling.timer(params)
+
+    # Training state of an interrupted run (see checkpoint module)
+    resume = params.get('resume')
+    resume_clustering = resume is not None and resume['phase'] == 'clustering'
 
     dl = dataloader
+    # Clustering metrics computed by worker processes and logged when ready (the stop check stays synchronous)
+    pool = None
+    if params.get('metrics_workers', 0) > 0:
+        pool = metrics_pool.MetricsPool(params, workers=params['metrics_workers'])
 
     # Pretrain or load weights
-    if pretrain:
+    if resume_clustering:
+        utils.print_both(txt_file, 'Resuming clusters training from epoch {} batch {}'.format(resume['epoch'] + 1,
+                                                                                            resume['batch']))
+    elif pretrain:
         while True:
-            pretrained_model = pretraining(model, copy.deepcopy(dl), criteria[0], optimizers[1], schedulers[1], pretrain_epochs, params)
+            pretrained_model = pretraining(model, dl, criteria[0], optimizers[1], schedulers[1], pretrain_epochs, params)
             if pretrained_model:
                 break
             else:
                 for layer in model.children():
                     if hasattr(layer, 'reset_parameters'):
                         layer.reset_parameters()
+                distributed.broadcast_model(model, params)
         model = pretrained_model
     else:
         try:
@@ -47,78 +72,178 @@ def train_model(model, dataloader, criteria, optimizers, schedulers, num_epochs,
         except:
             print("Couldn't load pretrained weights")
 
-    # Initialise clusters
-    utils.print_both(txt_file, '\nInitializing cluster centers based on K-means')
-    kmeans(model, copy.deepcopy(dl), params)
-
-    utils.print_both(txt_file, '\nBegin clusters training')
-
-    # Prep variables for weights and accuracy of the best model
-    best_model_wts = copy.deepcopy(model.state_dict())
-    best_loss = 10000.0
-
-    # Initial target distribution
-    utils.print_both(txt_file, '\nUpdating target distribution')
-    output_distribution, labels, preds_prev = calculate_predictions(model, copy.deepcopy(dl), params)
-    target_distribution = target(output_distribution)
-    nmi = utils.metrics.nmi(labels, preds_prev)
-    ari = utils.metrics.ari(labels, preds_prev)
-    acc = utils.metrics.acc(labels, preds_prev)
-    utils.print_both(txt_file,
-                     'NMI: {0:.5f}\tARI: {1:.5f}\tAcc {2:.5f}\n'.format(nmi, ari, acc))
-
-    if board:
-        niter = 0
-        writer.add_scalar('/NMI', nmi, niter)
-        writer.add_scalar('/ARI', ari, niter)
-        writer.add_scalar('/Acc', acc, niter)
-
-    update_iter = 1
+    if resume_clustering:
+        # Model, optimizers and schedulers are already restored, the rest of the state comes from checkpoint
+        best = BestWeights(model, params.get('best_criterion', 'last'))
+        best.load_state(resume['best'])
+        output_distribution = resume['output_distribution']
+        labels = resume['labels']
+        preds_prev = resume['preds_prev']
+        target_distribution = resume['target_distribution']
+        update_iter = resume['update_iter']
+        start_epoch, start_batch = resume['epoch'], resume['batch']
+        checkpoint.set_rng_state(resume['rng'])
+    else:
+        # Initialise clusters
+        utils.print_both(txt_file, '\nInitializing cluster centers based on K-means')
+        kmeans(model, dataloader, params)
+
+        utils.print_both(txt_file, '\nBegin clusters training')
+
+        # Prep buffers for weights of the best model
+        best = BestWeights(model, params.get('best_criterion', 'last'))
+
+        # Initial target distribution
+        utils.print_both(txt_file, '\nUpdating target distribution')
+        output_distribution, labels, preds_prev = calculate_predictions(model, dataloader, params)
+        target_distribution = target(output_distribution, params)
+        if pool is not None:
+            pool.submit(labels, preds_prev, model.num_clusters, 0, 'initial')
+        else:
+            nmi, ari, acc = evaluate(model, labels, preds_prev, params)
+            params['metrics'] = (nmi, ari, acc)
+            utils.print_both(txt_file,
+                             'NMI: {0:.5f}\tARI: {1:.5f}\tAcc {2:.5f}\n'.format(nmi, ari, acc))
+
+            if board:
+                niter = 0
+                writer.add_scalar('/NMI', nmi, niter)
+                writer.add_scalar('/ARI', ari, niter)
+                writer.add_scalar('/Acc', acc, niter)
+
+        update_iter = 1
+        start_epoch, start_batch = 0, 1
+
+    # Stop criterion and metrics estimated on a fixed stratified subsample (sampled again the same way on resume)
+    evaluator = None
+    if params.get('eval_fraction', 0) > 0:
+        evaluator = evaluation.SubsampleEvaluator(labels, params['eval_fraction'], params,
+                                                  confidence=params.get('eval_confidence', 0.95),
+                                                  bootstrap=params.get('eval_bootstrap', 50))
+        utils.print_both(txt_file, 'Evaluation subsample:\t{0} samples ({1:.0f}% confidence intervals)'.format(
+            evaluator.size(), 100 * evaluator.confidence))
+
+    # Soft assignments and target distribution on device, rows gathered and updated by sample indices
+    assignments = torch.from_numpy(output_distribution).to(device)
+    target_tensor = torch.from_numpy(target_distribution).to(device)
+    # Rows of assignments written by training since the previous target update - only these can change cluster,
+    # so label divergence is measured over them (all rows after a full pass)
+    touched = torch.zeros(len(output_distribution), dtype=torch.bool, device=device)
+    if resume_clustering and resume.get('touched') is not None:
+        touched.copy_(torch.from_numpy(resume['touched']))
+
     finished = False
 
     # Go through all epochs
-    for epoch in range(num_epochs):
+    for epoch in range(start_epoch, num_epochs):
 
         utils.print_both(txt_file, 'Epoch {}/{}'.format(epoch + 1, num_epochs))
         utils.print_both(txt_file,  '-' * 10)
 
-        schedulers[0].step()
+        # Interrupted in the middle of this epoch - replay its data order and skip processed batches
+        resumed = epoch == start_epoch and start_batch > 1
+        if resumed:
+            epoch_rng = resume['epoch_rng']
+            checkpoint.set_rng_state(epoch_rng)
+            running = running_sums(resume['running'], device)
+        else:
+            schedulers[0].step()
+            epoch_rng = checkpoint.rng_state()
+            running = running_sums((0.0, 0.0, 0.0), device)
+        # Shuffled order of the epoch (different from epochs of pretraining)
+        distributed.set_epoch(dataloader, pretrain_epochs + epoch)
         model.train(True)  # Set model to training mode
 
-        running_loss = 0.0
-        running_loss_rec = 0.0
-        running_loss_clust = 0.0
+        # Full pass for the target update at the start of the epoch, done before the epoch is iterated -
+        # a nested pass over the same persistent data loader would reset the iterator of the epoch
+        full_pass = None
+        if refresh_interval > 0 and epoch > 0 and epoch % refresh_interval == 0 and not resumed:
+            full_pass = calculate_predictions(model, dataloader, params)
 
         # Keep the batch number for inter-phase statistics
         batch_num = 1
         img_counter = 0
 
         # Iterate over data.
-        for data in dataloader:
-            # Get the inputs and labels
-            inputs, _ = data
+        for data in timer.iterate(dataloader):
+            if resumed and batch_num < start_batch:
+                batch_num += 1
+                if batch_num == start_batch:
+                    checkpoint.set_rng_state(resume['rng'])
+                continue
+
+            # Get the inputs and sample indices
+            inputs, _, indices = data
 
-            inputs = inputs.to(device)
+            with timer.phase('to_device', inputs.size(0)):
+                inputs = inputs.to(device, non_blocking=True)
+                rows = distributed.rows(torch.as_tensor(indices), params).to(device)
 
             # Uptade target distribution, chack and print performance
             if (batch_num - 1) % update_interval == 0 and not (batch_num == 1 and epoch == 0):
-                utils.print_both(txt_file, '\nUpdating target distribution:')
-                output_distribution, labels, preds = calculate_predictions(model, dataloader, params)
-                target_distribution = target(output_distribution)
-                nmi = utils.metrics.nmi(labels, preds)
-                ari = utils.metrics.ari(labels, preds)
-                acc = utils.metrics.acc(labels, preds)
-                utils.print_both(txt_file,
-                                 'NMI: {0:.5f}\tARI: {1:.5f}\tAcc {2:.5f}\t'.format(nmi, ari, acc))
-                if board:
-                    niter = update_iter
-                    writer.add_scalar('/NMI', nmi, niter)
-                    writer.add_scalar('/ARI', ari, niter)
-                    writer.add_scalar('/Acc', acc, niter)
-                    update_iter += 1
+                # Soft assignments cached during training are used unless a full refresh is due
+                if full_pass is not None and batch_num == 1:
+                    utils.print_both(txt_file, '\nUpdating target distribution (full pass):')
+                    output_distribution, labels, preds = full_pass
+                    full_pass = None
+                    assignments = torch.from_numpy(output_distribution).to(device)
+                    updated = None
+                else:
+                    utils.print_both(txt_file, '\nUpdating target distribution:')
+                    output_distribution = assignments.cpu().numpy()
+                    preds = np.argmax(output_distribution, axis=1)
+                    updated = touched.cpu().numpy().copy()
+                touched.zero_()
+                with timer.phase('target', len(output_distribution)):
+                    target_distribution = target(output_distribution, params)
+                    target_tensor = torch.from_numpy(target_distribution).to(device)
+                niter = update_iter
+                update_iter += 1
+                update_name = 'epoch {0}, batch {1}'.format(epoch + 1, batch_num)
+                if evaluator is None and pool is not None:
+                    with timer.phase('metrics', len(preds)):
+                        pool.submit(labels, preds, model.num_clusters, niter, update_name)
+                else:
+                    if evaluator is None:
+                        with timer.phase('metrics', len(preds)):
+                            nmi, ari, acc = evaluate(model, labels, preds, params)
+                        utils.print_both(txt_file,
+                                         'NMI: {0:.5f}\tARI: {1:.5f}\tAcc {2:.5f}\t'.format(nmi, ari, acc))
+                    else:
+                        with timer.phase('metrics', len(evaluator.rows)):
+                            (nmi, ari, acc), low, high = evaluator.metrics(preds, model.num_clusters)
+                        utils.print_both(txt_file, 'NMI: {0:.5f} ({3:.5f}-{6:.5f})\tARI: {1:.5f} ({4:.5f}-{7:.5f})\t'
+                                                   'Acc {2:.5f} ({5:.5f}-{8:.5f})\t(estimates)'.format(nmi, ari, acc,
+                                                                                                      *(low + high)))
+                    params['metrics'] = (nmi, ari, acc)
+                    if board:
+                        writer.add_scalar('/NMI', nmi, niter)
+                        writer.add_scalar('/ARI', ari, niter)
+                        writer.add_scalar('/Acc', acc, niter)
 
                 # check stop criterion
-                delta_label = np.sum(preds != preds_prev).astype(np.float32) / preds.shape[0]
+                if evaluator is None:
+                    with timer.phase('metrics'):
+                        delta_label = label_divergence(preds, preds_prev, params, updated)
+                else:
+                    with timer.phase('metrics', len(evaluator.rows)):
+                        delta_label, low, high = evaluator.label_change(preds, preds_prev, updated)
+                    utils.print_both(txt_file, 'Label divergence: {0:.5f} ({1:.5f}-{2:.5f})\t(estimate)'.format(
+                        delta_label, low, high))
+                    # All samples are compared only if the interval does not decide the criterion
+                    if low < tol <= high:
+                        with timer.phase('metrics', len(preds)):
+                            delta_label = label_divergence(preds, preds_prev, params, updated)
+                        utils.print_both(txt_file, 'Close to tolerance, all samples:\tLabel divergence: {0:.5f}'.format(
+                            delta_label))
+                        if pool is not None:
+                            pool.submit(labels, preds, model.num_clusters, niter, update_name + ', all samples')
+                        else:
+                            with timer.phase('metrics', len(preds)):
+                                nmi, ari, acc = evaluate(model, labels, preds, params)
+                            params['metrics'] = (nmi, ari, acc)
+                            utils.print_both(txt_file, 'NMI: {0:.5f}\tARI: {1:.5f}\tAcc {2:.5f}\t(all samples)'.format(
+                                nmi, ari, acc))
                 preds_prev = np.copy(preds)
                 if delta_label < tol:
                     utils.print_both(txt_file, 'Label divergence ' + str(delta_label) + '< tol ' + str(tol))
@@ -126,36 +251,46 @@ def train_model(model, dataloader, criteria, optimizers, schedulers, num_epochs,
                     finished = True
                     break
 
-            tar_dist = target_distribution[((batch_num - 1) * batch):(batch_num*batch), :]
-            tar_dist = torch.from_numpy(tar_dist).to(device)
-            # print(tar_dist)
-
             # zero the parameter gradients
             optimizers[0].zero_grad()
 
-            # Calculate losses and backpropagate
-            with torch.set_grad_enabled(True):
-                outputs, clusters, _ = model(inputs)
-                loss_rec = criteria[0](outputs, inputs)
-                loss_clust = gamma *criteria[1](torch.log(clusters), tar_dist) / batch
-                loss = loss_rec + loss_clust
-                loss.backward()
-                optimizers[0].step()
-
-            # For keeping statistics
-            running_loss += loss.item() * inputs.size(0)
-            running_loss_rec += loss_rec.item() * inputs.size(0)
-            running_loss_clust += loss_rec.item() * inputs.size(0)
-
-            # Some current stats
-            loss_batch = loss.item()
-            loss_batch_rec = loss_rec.item()
-            loss_batch_clust = loss_clust.item()
-            loss_accum = running_loss / ((batch_num - 1) * batch + inputs.size(0))
-            loss_accum_rec = running_loss_rec / ((batch_num - 1) * batch + inputs.size(0))
-            loss_accum_clust = running_loss_clust / ((batch_num - 1) * batch + inputs.size(0))
+            # Calculate losses and backpropagate - gradients of micro-batches are accumulated, losses are
+            # weighted so that the step is the same as for the whole batch
+            losses = None
+            with torch.set_grad_enabled(True), bn_momentum(model, inputs.size(0), micro_batch):
+                for chunk, chunk_rows, weight, last in micro_batches(inputs, rows, micro_batch):
+                    with accumulate(network, last):
+                        with timer.phase('forward', chunk.size(0)):
+                            with autocast(params):
+                                outputs, clusters, _ = network(chunk)
+                                loss_rec = criteria[0](outputs, chunk) * weight
+                            # Clustering layer returns log of soft assignments (in fp32), KL term is kept in fp32 as well
+                            # Sum over the micro-batch normalised by the number of samples of the step
+                            loss_clust = gamma * criteria[1](clusters, target_tensor[chunk_rows]) / inputs.size(0)
+                            loss = loss_rec + loss_clust
+                        with timer.phase('backward', chunk.size(0)):
+                            scaler.scale(loss).backward()
+
+                    # Cache soft assignments of the batch for the next target update
+                    with timer.phase('assignments', chunk.size(0)):
+                        assignments[chunk_rows] = torch.exp(clusters.detach())
+                        touched[chunk_rows] = True
+
+                    # For keeping statistics (accumulated on device, synchronised only for printing)
+                    chunk_losses = torch.stack([loss.detach(), loss_rec.detach(), loss_clust.detach()]).double()
+                    losses = chunk_losses if losses is None else losses + chunk_losses
+                with timer.phase('optimizer', inputs.size(0)):
+                    scaler.step(optimizers[0])
+                    scaler.update()
+            profiling.step(params)
+
+            running += losses * inputs.size(0)
 
             if batch_num % print_freq == 0:
+                # Some current stats
+                loss_batch, loss_batch_rec, loss_batch_clust = losses.tolist()
+                loss_accum, loss_accum_rec, loss_accum_clust = \
+                    (running / ((batch_num - 1) * batch + inputs.size(0))).tolist()
                 utils.print_both(txt_file, 'Epoch: [{0}][{1}/{2}]\t'
                                            'Loss {3:.4f} ({4:.4f})\t'
                                            'Loss_recovery {5:.4f} ({6:.4f})\t'
@@ -173,20 +308,22 @@ def train_model(model, dataloader, criteria, optimizers, schedulers, num_epochs,
                     writer.add_scalar('/Loss_clustering', loss_accum_clust, niter)
             batch_num = batch_num + 1
 
-            # Print image to tensorboard
-            if batch_num == len(dataloader) and (epoch+1) % 5:
-                inp = utils.tensor2img(inputs)
-                out = utils.tensor2img(outputs)
-                if board:
-                    img = np.concatenate((inp, out), axis=1)
-                    writer.add_image('Clustering/Epoch_' + str(epoch + 1).zfill(3) + '/Sample_' + str(img_counter).zfill(2), img)
-                    img_counter += 1
+            if checkpoint_interval > 0 and (batch_num - 1) % checkpoint_interval == 0:
+                save_checkpoint(model, params, 'clustering', epoch, batch_num, epoch_rng,
+                                running=tuple(running.tolist()), best=best.state(),
+                                output_distribution=assignments.cpu().numpy(), touched=touched.cpu().numpy(),
+                                labels=labels, preds_prev=preds_prev, target_distribution=target_distribution,
+                                update_iter=update_iter)
+
+            # Print image to tensorboard (converted on the logger thread)
+            if batch_num == len(dataloader) and (epoch+1) % 5 and board:
+                writer.add_images('Clustering/Epoch_' + str(epoch + 1).zfill(3) + '/Sample_' + str(img_counter).zfill(2),
+                                  (chunk, outputs))
+                img_counter += 1
 
         if finished: break
 
-        epoch_loss = running_loss / dataset_size
-        epoch_loss_rec = running_loss_rec / dataset_size
-        epoch_loss_clust = running_loss_clust / dataset_size
+        epoch_loss, epoch_loss_rec, epoch_loss_clust = epoch_losses(params, *running.tolist())
 
         if board:
             writer.add_scalar('/Loss' + '/Epoch', epoch_loss, epoch + 1)
@@ -197,19 +334,27 @@ def train_model(model, dataloader, criteria, optimizers, schedulers, num_epochs,
                                                                                                             epoch_loss_rec,
                                                                                                             epoch_loss_clust))
 
-        # If wanted to do some criterium in the future (for now useless)
-        if epoch_loss < best_loss or epoch_loss >= best_loss:
-            best_loss = epoch_loss
-            best_model_wts = copy.deepcopy(model.state_dict())
+        # Keep weights of the best model (copied in place, only if the criterion improved)
+        best.update(model, epoch_loss)
+
+        save_checkpoint(model, params, 'clustering', epoch + 1, 1, None, best=best.state(),
+                        output_distribution=assignments.cpu().numpy(), touched=touched.cpu().numpy(), labels=labels,
+                        preds_prev=preds_prev, target_distribution=target_distribution, update_iter=update_iter)
 
         utils.print_both(txt_file, '')
 
+    # Metrics still being computed
+    if pool is not None:
+        latest = pool.close()
+        if latest is not None:
+            params['metrics'] = latest
+
     time_elapsed = time.time() - since
     utils.print_both(txt_file, 'Training complete in {:.0f}m {:.0f}s'.format(
         time_elapsed // 60, time_elapsed % 60))
 
     # load best model weights
-    model.load_state_dict(best_model_wts)
+    best.load(model)
     return model
 
 
@@ -220,56 +365,100 @@ def pretraining(model, dataloader, criterion, optimizer, scheduler, num_epochs,
 
     # Unpack parameters
     writer = params['writer']
-    if writer is not None: board = True
+    board = writer is not None
     txt_file = params['txt_file']
     pretrained = params['model_files'][1]
     print_freq = params['print_freq']
-    dataset_size = params['dataset_size']
     device = params['device']
     batch = params['batch']
+    checkpoint_interval = params.get('checkpoint_interval', 0)
+    micro_batch = params.get('micro_batch')
+    scaler = grad_scaler(params)
+    network = params.get('ddp') or model
+    timer = profiling.timer(params)
+
+    # Training state of an interrupted run (see checkpoint module), used only once
+    resume = params.get('resume')
+    if resume is not None and resume['phase'] == 'pretraining':
+        params['resume'] = None
+        utils.print_both(txt_file, 'Resuming pretraining from epoch {} batch {}'.format(resume['epoch'] + 1,
+                                                                                      resume['batch']))
+        start_epoch, start_batch = resume['epoch'], resume['batch']
+        first_loss = resume['first_loss']
+        checkpoint.set_rng_state(resume['rng'])
+    else:
+        resume = None
+        start_epoch, start_batch = 0, 1
 
-    # Prep variables for weights and accuracy of the best model
-    best_model_wts = copy.deepcopy(model.state_dict())
-    best_loss = 10000.0
+    # Prep buffers for weights of the best model
+    best = BestWeights(model, params.get('best_criterion', 'last'))
+    if resume is not None:
+        best.load_state(resume['best'])
 
     # Go through all epochs
-    for epoch in range(num_epochs):
+    for epoch in range(start_epoch, num_epochs):
         utils.print_both(txt_file, 'Pretraining:\tEpoch {}/{}'.format(epoch + 1, num_epochs))
         utils.print_both(txt_file, '-' * 10)
 
-        scheduler.step()
+        # Interrupted in the middle of this epoch - replay its data order and skip processed batches
+        resumed = epoch == start_epoch and start_batch > 1
+        if resumed:
+            epoch_rng = resume['epoch_rng']
+            checkpoint.set_rng_state(epoch_rng)
+            running = running_sums((resume['running'],), device)
+        else:
+            scheduler.step()
+            epoch_rng = checkpoint.rng_state()
+            running = running_sums((0.0,), device)
+        distributed.set_epoch(dataloader, epoch)
         model.train(True)  # Set model to training mode
 
-        running_loss = 0.0
-
         # Keep the batch number for inter-phase statistics
         batch_num = 1
         # Images to show
         img_counter = 0
 
         # Iterate over data.
-        for data in dataloader:
-            # Get the inputs and labels
-            inputs, _ = data
-            inputs = inputs.to(device)
+        for data in timer.iterate(dataloader, 'pretrain_data'):
+            if resumed and batch_num < start_batch:
+                batch_num += 1
+                if batch_num == start_batch:
+                    checkpoint.set_rng_state(resume['rng'])
+                continue
+
+            # Get the inputs
+            inputs = data[0]
+            with timer.phase('to_device', inputs.size(0)):
+                inputs = inputs.to(device, non_blocking=True)
 
             # zero the parameter gradients
             optimizer.zero_grad()
 
-            with torch.set_grad_enabled(True):
-                outputs, _, _ = model(inputs)
-                loss = criterion(outputs, inputs)
-                loss.backward()
-                optimizer.step()
-
-            # For keeping statistics
-            running_loss += loss.item() * inputs.size(0)
-
-            # Some current stats
-            loss_batch = loss.item()
-            loss_accum = running_loss / ((batch_num - 1) * batch + inputs.size(0))
+            # Gradients of micro-batches accumulated (mean loss of each weighted by its share of the batch)
+            loss_detached = None
+            with torch.set_grad_enabled(True), bn_momentum(model, inputs.size(0), micro_batch):
+                for chunk, _, weight, last in micro_batches(inputs, None, micro_batch):
+                    with accumulate(network, last):
+                        with timer.phase('pretrain_forward', chunk.size(0)):
+                            with autocast(params):
+                                outputs, _, _ = network(chunk)
+                                loss = criterion(outputs, chunk) * weight
+                        with timer.phase('pretrain_backward', chunk.size(0)):
+                            scaler.scale(loss).backward()
+                    # For keeping statistics (accumulated on device, synchronised only for printing)
+                    chunk_loss = loss.detach().double()
+                    loss_detached = chunk_loss if loss_detached is None else loss_detached + chunk_loss
+                with timer.phase('pretrain_optimizer', inputs.size(0)):
+                    scaler.step(optimizer)
+                    scaler.update()
+            profiling.step(params)
+
+            running += loss_detached * inputs.size(0)
 
             if batch_num % print_freq == 0:
+                # Some current stats
+                loss_batch = loss_detached.item()
+                loss_accum = running.item() / ((batch_num - 1) * batch + inputs.size(0))
                 utils.print_both(txt_file, 'Pretraining:\tEpoch: [{0}][{1}/{2}]\t'
                            'Loss {3:.4f} ({4:.4f})\t'.format(epoch + 1, batch_num, len(dataloader),
                                                              loss_batch,
@@ -279,15 +468,17 @@ def pretraining(model, dataloader, criterion, optimizer, scheduler, num_epochs,
                     writer.add_scalar('Pretraining/Loss', loss_accum, niter)
             batch_num = batch_num + 1
 
-            if batch_num in [len(dataloader), len(dataloader)//2, len(dataloader)//4, 3*len(dataloader)//4]:
-                inp = utils.tensor2img(inputs)
-                out = utils.tensor2img(outputs)
-                if board:
-                    img = np.concatenate((inp, out), axis=1)
-                    writer.add_image('Pretraining/Epoch_' + str(epoch + 1).zfill(3) + '/Sample_' + str(img_counter).zfill(2), img)
-                    img_counter += 1
+            if checkpoint_interval > 0 and (batch_num - 1) % checkpoint_interval == 0:
+                save_checkpoint(model, params, 'pretraining', epoch, batch_num, epoch_rng, running=running.item(),
+                                first_loss=first_loss if epoch > 0 else None, best=best.state())
+
+            # Print image to tensorboard (converted on the logger thread)
+            if batch_num in [len(dataloader), len(dataloader)//2, len(dataloader)//4, 3*len(dataloader)//4] and board:
+                writer.add_images('Pretraining/Epoch_' + str(epoch + 1).zfill(3) + '/Sample_' + str(img_counter).zfill(2),
+                                  (chunk, outputs))
+                img_counter += 1
 
-        epoch_loss = running_loss / dataset_size
+        epoch_loss, = epoch_losses(params, *running.tolist())
         if epoch == 0: first_loss = epoch_loss
         if epoch == 4 and epoch_loss / first_loss > 1:
             utils.print_both(txt_file, "\nLoss not converging, starting pretraining again\n")
@@ -298,10 +489,10 @@ def pretraining(model, dataloader, criterion, optimizer, scheduler, num_epochs,
 
         utils.print_both(txt_file, 'Pretraining:\t Loss: {:.4f}'.format(epoch_loss))
 
-        # If wanted to add some criterium in the future
-        if epoch_loss < best_loss or epoch_loss >= best_loss:
-            best_loss = epoch_loss
-            best_model_wts = copy.deepcopy(model.state_dict())
+        # Keep weights of the best model (copied in place, only if the criterion improved)
+        best.update(model, epoch_loss)
+
+        save_checkpoint(model, params, 'pretraining', epoch + 1, 1, None, first_loss=first_loss, best=best.state())
 
         utils.print_both(txt_file, '')
 
@@ -310,62 +501,292 @@ def pretraining(model, dataloader, criterion, optimizer, scheduler, num_epochs,
         time_elapsed // 60, time_elapsed % 60))
 
     # load best model weights
-    model.load_state_dict(best_model_wts)
+    best.load(model)
     model.pretrained = True
-    torch.save(model.state_dict(), pretrained)
+    if distributed.is_main(params):
+        torch.save(model.state_dict(), pretrained)
 
     return model
 
 
+# Weights of the best model according to criterion:
+# 'last' - weights after the last epoch (nothing is copied), 'loss' - lowest epoch loss
+# Buffers are allocated once and overwritten in place
+class BestWeights:
+    def __init__(self, model, criterion='last'):
+        self.criterion = criterion
+        self.best_loss = float('inf')
+        self.buffers = None
+        if criterion == 'loss':
+            self.buffers = {k: v.detach().clone() for k, v in model.state_dict().items()}
+
+    def update(self, model, loss):
+        if self.criterion == 'loss' and loss < self.best_loss:
+            self.best_loss = loss
+            with torch.no_grad():
+                for k, v in model.state_dict().items():
+                    self.buffers[k].copy_(v)
+
+    def load(self, model):
+        if self.buffers is not None:
+            model.load_state_dict(self.buffers)
+
+    def state(self):
+        return {'best_loss': self.best_loss, 'buffers': self.buffers}
+
+    def load_state(self, state):
+        self.best_loss = state['best_loss']
+        if self.buffers is not None and state['buffers'] is not None:
+            for k, v in state['buffers'].items():
+                self.buffers[k].copy_(v)
+
+
+# Save training state asynchronously (see checkpoint module) - batch_num is the next batch to process
+def save_checkpoint(model, params, phase, epoch, batch_num, epoch_rng, **state):
+    checkpointer = params.get('checkpoint')
+    if checkpointer is None:
+        return
+    with profiling.timer(params).phase('checkpoint'):
+        _save_checkpoint(checkpointer, model, params, phase, epoch, batch_num, epoch_rng, **state)
+
+
+def _save_checkpoint(checkpointer, model, params, phase, epoch, batch_num, epoch_rng, **state):
+    state.update(phase=phase, epoch=epoch, batch=batch_num, epoch_rng=epoch_rng, rng=checkpoint.rng_state(),
+                 model=model.state_dict(),
+                 optimizers=[optimizer.state_dict() for optimizer in params['optimizers']],
+                 schedulers=[scheduler.state_dict() for scheduler in params['schedulers']])
+    if params.get('scaler') is not None:
+        state['scaler'] = params['scaler'].state_dict()
+    state['sampler_seed'] = params.get('sampler_seed')
+    checkpointer.save(state)
+
+
+# Mixed precision - autocast region for the autoencoder forward and reconstruction loss
+# params['precision']: 'fp32' (autocast disabled), 'bf16' or 'fp16'
+_precisions = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def autocast(params):
+    precision = params.get('precision', 'fp32')
+    return torch.autocast(params['device'].type, dtype=_precisions[precision], enabled=precision != 'fp32')
+
+
+# Micro-batches of a batch for gradient accumulation: (inputs, rows, weight, last)
+# weight - share of the batch (for mean losses), rows - rows of the samples (None if not given)
+# The whole batch is one micro-batch if micro_batch is not set
+def micro_batches(inputs, rows, micro_batch=None):
+    size = inputs.size(0)
+    if not micro_batch or micro_batch >= size:
+        yield inputs, rows, 1.0, True
+        return
+    for start in range(0, size, micro_batch):
+        end = min(start + micro_batch, size)
+        yield inputs[start:end], None if rows is None else rows[start:end], (end - start) / size, end == size
+
+
+# Gradients are all-reduced between processes only after the last micro-batch of a step
+def accumulate(network, last):
+    if last or not hasattr(network, 'no_sync'):
+        return contextlib.nullcontext()
+    return network.no_sync()
+
+
+# Batch Norm running statistics updated once per micro-batch - momentum lowered so that the micro-batches
+# of a step move them as much as one update with the whole batch would: 1 - (1 - momentum) ** (1 / micro-batches)
+@contextlib.contextmanager
+def bn_momentum(model, size, micro_batch=None):
+    chunks = (size + micro_batch - 1) // micro_batch if micro_batch else 1
+    layers = [m for m in model.modules() if isinstance(m, torch.nn.modules.batchnorm._BatchNorm)
+              and m.momentum is not None] if chunks > 1 else []
+    momenta = [m.momentum for m in layers]
+    for m in layers:
+        m.momentum = 1 - (1 - m.momentum) ** (1.0 / chunks)
+    try:
+        yield
+    finally:
+        for m, momentum in zip(layers, momenta):
+            m.momentum = momentum
+
+
+# Gradient scaler shared by both phases - only active for fp16 (bf16 has the fp32 exponent range)
+def grad_scaler(params):
+    if params.get('scaler') is None:
+        params['scaler'] = torch.amp.GradScaler(params['device'].type,
+                                                enabled=params.get('precision', 'fp32') == 'fp16')
+    return params['scaler']
+
+
 # K-means clusters initialisation
 def kmeans(model, dataloader, params):
-    km = KMeans(n_clusters=model.num_clusters, n_init=20)
+    with profiling.timer(params).phase('kmeans', len(dataloader.sampler)):
+        _kmeans(model, dataloader, params)
+
+
+def _kmeans(model, dataloader, params):
+    txt_file = params['txt_file']
+    mode = params.get('kmeans_init', 'full')
+    samples = params.get('kmeans_samples', 50000)
     output_array = None
-    model.eval()
-    # Itarate throught the data and concatenate the latent space representations of images
-    for data in dataloader:
-        inputs, _ = data
-        inputs = inputs.to(params['device'])
-        _, _, outputs = model(inputs)
-        if output_array is not None:
-            output_array = np.concatenate((output_array, outputs.cpu().detach().numpy()), 0)
-        else:
-            output_array = outputs.cpu().detach().numpy()
-        # print(output_array.shape)
-        if output_array.shape[0] > 50000: break
+    if distributed.enabled(params):
+        # Embeddings of all shards gathered on rank 0, K-means runs there once and centres are broadcast
+        _, output_array, _ = inference(model, dataloader, params, name='kmeans')
+        output_array = distributed.gather_rows(output_array, params)
+
+    # Seeded from the global generator, so runs (and resumed runs) are reproducible
+    seed = np.random.randint(2 ** 31 - 1)
 
     # Perform K-means
-    km.fit_predict(output_array)
+    centres = np.zeros((model.num_clusters, model.clustering.in_features), dtype=np.float32)
+    if distributed.is_main(params):
+        if mode in ('minibatch', 'reservoir'):
+            # Latent space representations of images, streamed batch by batch (soft assignments are not needed)
+            if output_array is not None:
+                batches = _split(output_array, params['batch'])
+            else:
+                batches = (extra_out.cpu().numpy() for _, extra_out, _ in
+                           inference_batches(model, dataloader, params, clustering=False))
+        if mode == 'minibatch':
+            centres, inertia, seconds = kmeans_init.minibatch(batches, model.num_clusters, seed=seed)
+        elif mode == 'reservoir':
+            centres, inertia, seconds = kmeans_init.reservoir(batches, model.num_clusters, sample_size=samples,
+                                                              seed=seed)
+        else:
+            if output_array is None:
+                _, output_array, _ = inference(model, dataloader, params, name='kmeans')
+            centres, inertia, seconds = kmeans_init.full(output_array, model.num_clusters, seed=seed)
+        utils.print_both(txt_file, 'K-means ({0}):\tInertia: {1:.4f}\tTime: {2:.1f}s'.format(mode, inertia, seconds))
+
     # Update clustering layer weights
-    weights = torch.from_numpy(km.cluster_centers_)
+    weights = distributed.broadcast(torch.from_numpy(centres).float(), params)
     model.clustering.set_weight(weights.to(params['device']))
     # torch.cuda.empty_cache()
 
 
 # Function forwarding data through network, collecting clustering weight output and returning prediciotns and labels
 def calculate_predictions(model, dataloader, params):
-    output_array = None
-    label_array = None
-    model.eval()
-    for data in dataloader:
-        inputs, labels = data
-        inputs = inputs.to(params['device'])
-        labels = labels.to(params['device'])
-        _, outputs, _ = model(inputs)
-        if output_array is not None:
-            output_array = np.concatenate((output_array, outputs.cpu().detach().numpy()), 0)
-            label_array = np.concatenate((label_array, labels.cpu().detach().numpy()), 0)
-        else:
-            output_array = outputs.cpu().detach().numpy()
-            label_array = labels.cpu().detach().numpy()
-
-    preds = np.argmax(output_array.data, axis=1)
-    # print(output_array.shape)
+    with profiling.timer(params).phase('predictions', len(dataloader.sampler)):
+        output_array, _, label_array = inference(model, dataloader, params, name='predictions')
+    preds = np.argmax(output_array, axis=1)
     return output_array, label_array, preds
 
 
+# Inference engine - forwards the data without autograd and yields (soft assignments, embeddings, labels) per batch
+# With clustering=False only embeddings are computed (soft assignments are None)
+# The data is read in order (a shuffled training loader too) - rows of outputs follow sample indices
+def inference_batches(model, dataloader, params, clustering=True):
+    device = params['device']
+    was_training = model.training
+    model.eval()
+    try:
+        with distributed.ordered(dataloader):
+            for data in dataloader:
+                inputs, labels = data[0], data[1]
+                inputs = inputs.to(device, non_blocking=True)
+                # Only the encoder and clustering layer are needed
+                with torch.inference_mode():
+                    extra_out = model.encode(inputs)
+                    clusters = model.clustering(extra_out, log=False) if clustering else None
+                yield clusters, extra_out, labels
+    finally:
+        model.train(was_training)
+
+
+# Inference engine - writes the whole pass into preallocated arrays sized from the dataset
+# (memory-mapped .npy files if params['memmap_dir'] is set) and returns them without copying
+# Passes are also written to the embedding store if params['embedding_store'] is set
+def inference(model, dataloader, params, name='inference'):
+    # Samples of this rank only in multi-process runs, with Batch Norm statistics of rank 0
+    size = len(dataloader.sampler)
+    distributed.broadcast_model(model, params, buffers_only=True)
+    memmap_dir = params.get('memmap_dir')
+    output_array = _allocate(memmap_dir, name + '_q', (size, model.num_clusters), np.float32)
+    embedding_array = _allocate(memmap_dir, name + '_embeddings', (size, model.clustering.in_features), np.float32)
+    label_array = _allocate(memmap_dir, name + '_labels', (size,), np.int64)
+    store = None
+    if params.get('embedding_store') is not None:
+        store = embedding_store.EmbeddingWriter(params['embedding_store'], model, model.clustering.in_features,
+                                                model.num_clusters)
+
+    pos = 0
+    for clusters, extra_out, labels in inference_batches(model, dataloader, params):
+        n = clusters.size(0)
+        output_array[pos:pos + n] = clusters.cpu().numpy()
+        embedding_array[pos:pos + n] = extra_out.cpu().numpy()
+        label_array[pos:pos + n] = np.asarray(labels)
+        if store is not None:
+            store.append(np.arange(pos, pos + n), embedding_array[pos:pos + n], output_array[pos:pos + n])
+        pos += n
+    if store is not None:
+        store.close()
+
+    return output_array[:pos], embedding_array[:pos], label_array[:pos]
+
+
+# Embedding store written with weights of the model (one inference pass unless it is up to date)
+def update_embedding_store(model, dataloader, params):
+    path = params.get('embedding_store')
+    if path is None:
+        return
+    try:
+        if not embedding_store.EmbeddingStore(path).stale(model):
+            return
+    except (OSError, ValueError):
+        pass
+    inference(model, dataloader, params, name='embeddings')
+    utils.print_both(params['txt_file'], 'Embeddings written to: ' + path)
+
+
+# Output buffer for the inference engine - in memory or memory-mapped file
+def _allocate(memmap_dir, name, shape, dtype):
+    if memmap_dir is None:
+        return np.empty(shape, dtype=dtype)
+    os.makedirs(memmap_dir, exist_ok=True)
+    return np.lib.format.open_memmap(os.path.join(memmap_dir, name + '.npy'), mode='w+', dtype=dtype, shape=shape)
+
+
+# Rows of an array as batches
+def _split(array, batch):
+    for start in range(0, len(array), batch):
+        yield array[start:start + batch]
+
+
+# Clustering metrics of predictions (of all ranks in multi-process runs)
+def evaluate(model, labels, preds, params):
+    valid = distributed.valid(params)
+    return distributed.evaluate(labels[:valid], preds[:valid], model.num_clusters, params)
+
+
+# Fraction of samples that changed cluster since the previous target update (all ranks)
+# Only rows of updated (boolean mask) are compared if given - samples trained on since the previous update
+def label_divergence(preds, preds_prev, params, updated=None):
+    valid = distributed.valid(params)
+    changed = preds[:valid] != preds_prev[:valid]
+    if updated is not None:
+        updated = updated[:valid]
+        counts = distributed.all_reduce(np.array([np.sum(changed[updated]), np.sum(updated)]), params)
+        if counts[1] > 0:
+            return counts[0].astype(np.float32) / int(counts[1])
+    counts = distributed.all_reduce(np.array([np.sum(changed), changed.shape[0]]), params)
+    return counts[0].astype(np.float32) / int(counts[1])
+
+
+# Running sums of losses weighted by batch sizes - on device in float64 (the same sums as in Python floats)
+def running_sums(values, device):
+    return torch.tensor(values, dtype=torch.float64, device=device)
+
+
+# Epoch losses from running sums (summed over ranks, padding samples of shards included)
+def epoch_losses(params, *running):
+    totals = distributed.all_reduce(np.array(running + (params['dataset_size'],), dtype=np.float64), params)
+    return tuple(float(total) / totals[-1] for total in totals[:-1])
+
+
 # Calculate target distribution
-def target(out_distr):
-    tar_dist = out_distr ** 2 / np.sum(out_distr, axis=0)
+# Cluster frequencies are summed over the whole dataset (all ranks) if params are given
+def target(out_distr, params=None):
+    frequencies = np.sum(out_distr, axis=0)
+    if params is not None:
+        frequencies = distributed.all_reduce(np.sum(out_distr[:distributed.valid(params)], axis=0), params)
+    tar_dist = out_distr ** 2 / frequencies
     tar_dist = np.transpose(np.transpose(tar_dist) / np.sum(tar_dist, axis=1))
     return tar_dist
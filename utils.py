@@ -1,6 +1,7 @@
-import numpy as np
-import sklearn.metrics
+import os
+import re
 import torch
+import metrics as clustering_metrics
 from torchvision import transforms
 
 mean = (0.485, 0.456, 0.406)
@@ -13,32 +14,45 @@ inv_normalize = transforms.Normalize(
 
 # Simple tensor to image translation
 def tensor2img(tensor):
-    img = tensor.cpu().data[0]
+    img = tensor.cpu().data[0].float()
     if img.shape[0] != 1:
         img = inv_normalize(img)
     img = torch.clamp(img, 0, 1)
     return img
 
 
-# Define printing to console and file
+# Collate function for datasets serving whole batches (__getitems__) - the batch is already assembled
+def batch_collate(batch):
+    return batch
+
+
+# Define printing to console and file (asynchronous logger prints on its background thread)
 def print_both(f, text):
+    if hasattr(f, 'print'):
+        f.print(text)
+        return
     print(text)
     f.write(text + '\n')
 
 
+# Next free run index for prefix (directory/prefix_XXX.txt), reserved atomically by creating the file
+# Concurrent runs never get the same index
+def reserve_index(directory, prefix, suffix='.txt'):
+    pattern = re.compile(re.escape(prefix) + r'_(\d{3,})' + re.escape(suffix) + '$')
+    used = [int(m.group(1)) for m in map(pattern.match, os.listdir(directory)) if m]
+    idx = max(used, default=0) + 1
+    while True:
+        try:
+            os.close(os.open(os.path.join(directory, prefix + '_' + str(idx).zfill(3) + suffix),
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return idx
+        except FileExistsError:
+            idx += 1
+
+
 # Metrics class was copied from DCEC article authors repository (link in README)
+# Now computed from a vectorised contingency table (see metrics module)
 class metrics:
-    nmi = sklearn.metrics.normalized_mutual_info_score
-    ari = sklearn.metrics.adjusted_rand_score
-
-    @staticmethod
-    def acc(labels_true, labels_pred):
-        labels_true = labels_true.astype(np.int64)
-        assert labels_pred.size == labels_true.size
-        D = max(labels_pred.max(), labels_true.max()) + 1
-        w = np.zeros((D, D), dtype=np.int64)
-        for i in range(labels_pred.size):
-            w[labels_pred[i], labels_true[i]] += 1
-        from sklearn.utils.linear_assignment_ import linear_assignment
-        ind = linear_assignment(w.max() - w)
-        return sum([w[i, j] for i, j in ind]) * 1.0 / labels_pred.size
+    nmi = staticmethod(clustering_metrics.nmi)
+    ari = staticmethod(clustering_metrics.ari)
+    acc = staticmethod(clustering_metrics.acc)